@@ -1,33 +1,258 @@
-import os, time, sys
+import os, itertools
 from pathlib import Path
 from panda3d.core import Shader, ShaderAttrib, TextureStage, TexGenAttrib, NodePath
 from panda3d.core import Texture, ATS_none, Vec3, Vec4, AuxBitplaneAttrib, PNMImage, AntialiasAttrib
-from panda3d.core import load_prc_file_data
-from direct.stdpy import threading2
+from panda3d.core import load_prc_file_data, SamplerState, LightAttrib, GraphicsOutput, GeomEnums, PTA_int
 from direct.filter.FilterManager import FilterManager
 from panda3d.core import PointLight, Spotlight, AmbientLight, PerspectiveLens
-from importlib import resources 
 from importlib.resources import files
+from .brdf_lut import get_brdf_lut_texture
+from .shader_cache import ShaderCache, make_shader_key
+from .shader_template import load_template, split_stage_mods, format_defines
+from .cubemap_scheduler import CubemapScheduler, CUBEMAP_UPDATE_MODES
+from .env_prefilter import EnvPrefilter
+from .sh_irradiance import ShIrradiance
+from .light_clusters import LightClusters
+from .motion_vectors import MotionVectors
+from .screenspace import BloomPyramid, SSAOPass, HiZPyramid, SSRPass, TemporalAA, SCREENSPACE_SHADER_FILES, shader_input_value, make_scene_fbprops
+from .render_graph import RenderGraph
+from .shadow_atlas import ShadowAtlas, SHADOW_ATLAS_SHADER_FILES
+from .capture_filter import CaptureFilter, CAPTURE_MASK
+from .reflection_probes import ReflectionProbes
+from .quality_governor import QualityGovernor, QUALITY_TIERS
+from .frame_stats import FrameStats, connect_pstats
+from .program_cache import ProgramCache
+from .shader_warmup import ShaderWarmup
+from .env_bake import save_env_texture, read_env_file, fill_env_texture, load_equirect_cubemap
 
 
 complexpbr_init = True
+rig_prc_loaded = False
+shader_cache = ShaderCache()
+# the rig's shader inputs as one ShaderAttrib (plus its TexGenAttrib) per LUT and scalar setting, shared by every
+# node apply_shader() is called on, see rig_attribs()
+rig_attrib_cache = {}
+# nodes whose vertex variants are looked at again ahead of the next frame, see request_vertex_variants()
+vertex_variant_requests = []
+# apply_shader(features=...) flags and their defaults, each maps to a #define in ibl_v.vert/ibl_f.frag
+# displacement and skinning only allow those vertex variants, which are picked per GeomNode, see select_vertex_variants(),
+# as is the light loop length with 'max_lights': 'auto'
+SHADER_FEATURES = {'displacement': True, 'skinning': True, 'emission': True, 'shadows': True, 'direct_lights': True,
+                   'clustered_lights': True, 'shadow_atlas': True, 'reflection_probes': True, 'motion_vectors': True, 'max_lights': 20}
+# min_f.frag #defines, one per screenspace effect, see compile_screenspace_shader()
+SCREENSPACE_EFFECT_DEFINES = ('SSAO', 'SSR', 'BLOOM', 'TAA')
+# shaders besides the ibl/min pairs which copy_to_dist() also copies
+dist_shader_files = ['prefilter_c.comp', 'sh_project_c.comp', 'capture_f.frag'] + SCREENSPACE_SHADER_FILES + SHADOW_ATLAS_SHADER_FILES
 
 def set_cubebuff_inactive():
-    def set_thread():
-        time.sleep(.5)
-        base.cube_buffer.set_active(0)
-    return threading2._start_new_thread(set_thread,())
+    # finish one last capture of all faces, then stop rendering the cube buffer
+    restore_live_environment()
+    base.complexpbr_cube_scheduler.configure(mode='manual')
+    base.complexpbr_cube_scheduler.capture_now()
 
 def set_cubebuff_active():
-    def set_thread():
-        time.sleep(.5)
-        base.cube_buffer.set_active(1)
-    return threading2._start_new_thread(set_thread,())
+    restore_live_environment()
+    base.complexpbr_cube_scheduler.configure(mode='always')
+
+def set_cubemap_update(mode=None,faces_per_frame=None,update_hz=None,move_threshold=None,angle_threshold=None):
+    # modes: 'always', 'round_robin' (faces_per_frame faces each frame), 'motion' (rig moved or rotated
+    # past the thresholds), 'interval' (update_hz full refreshes per second), 'manual' (capture_cubemap_now())
+    if mode is not None and mode != 'manual':
+        restore_live_environment()
+    base.complexpbr_cube_scheduler.configure(mode, faces_per_frame, update_hz, move_threshold, angle_threshold)
+
+def environment_targets(probe=None):
+    if probe is not None:
+        return probe.scheduler, probe.prefilter, probe.sh_irradiance
+
+    return base.complexpbr_cube_scheduler, base.complexpbr_env_prefilter, base.complexpbr_sh_irradiance
+
+def save_environment(path,probe=None,dtype='half',compression=None,include_sh=True):
+    # writes the prefiltered environment of the camera rig, or of probe, with every mip level and its SH9 to path;
+    # dtype 'half' or 'float', compression None (memory-mapped on load) or 'zlib'
+    scheduler, prefilter, sh_irradiance = environment_targets(probe)
+    if prefilter is None:
+        env_tex, levels = base.complexpbr_env_tex, int(base.complexpbr_env_max_lod) + 1
+    else:
+        env_tex, levels = prefilter.env_tex, prefilter.levels
+
+    # the camera rig's capture follows the view, files are stored in world axes like the probes
+    rotation = None
+    if probe is None and base.complexpbr_env_space[0] == 0:
+        rig_mat = base.render.get_mat(base.complexpbr_map)
+        rotation = [list(rig_mat.get_row3(i)) for i in range(3)]
+
+    save_env_texture(path, env_tex, levels, rotation, include_sh, dtype, compression)
+
+def load_environment(path,probe=None):
+    # a file from save_environment() replaces the live capture of the camera rig, or of probe, until
+    # set_cubebuff_active(), capture_cubemap_now() (probe.capture()) or a set_cubemap_update() mode other than 'manual'
+    scheduler, prefilter, sh_irradiance = environment_targets(probe)
+    if prefilter is None:
+        print('complexpbr message: load_environment() needs the prefiltered environment, apply_shader(prefilter_env=True).')
+        return
+
+    levels, sh, dtype = read_env_file(path)
+    if len(levels) != prefilter.levels:
+        print('complexpbr message: ' + str(path) + ' holds ' + str(len(levels)) + ' mip levels, the shader expects '
+              + str(prefilter.levels) + ' (prefilter_levels), roughness will be mapped differently.')
+
+    scheduler.cancel()
+    scheduler.configure(mode='manual')
+    prefilter.cancel()
+    fill_env_texture(prefilter.env_tex, levels, dtype)
+    if sh is not None:
+        sh_irradiance.set_coefficients(sh, immediate=True)
+    sh_irradiance.cancel()
+    if probe is None:
+        base.complexpbr_env_space[0] = 1
+
+def load_skybox(path,size=None):
+    # an equirectangular image (IE .hdr, .exr or .pfm) as the camera rig's environment in place of the live
+    # capture, converted to a cubemap once and cached, then prefiltered like a capture
+    if base.complexpbr_env_prefilter is None:
+        print('complexpbr message: load_skybox() needs the prefiltered environment, apply_shader(prefilter_env=True).')
+        return
+
+    prefilter = base.complexpbr_env_prefilter
+    faces, sh = load_equirect_cubemap(path, prefilter.size if size is None else size)
+    base.complexpbr_cube_scheduler.cancel()
+    base.complexpbr_cube_scheduler.configure(mode='manual')
+    prefilter.cancel()
+    prefilter.set_source(fill_env_texture(Texture('complexpbr_skybox'), [faces]))
+    base.complexpbr_sh_irradiance.set_coefficients(sh, immediate=True)
+    base.complexpbr_sh_irradiance.cancel()
+    base.complexpbr_env_space[0] = 1
+
+def restore_live_environment():
+    # back to the camera rig's own capture after load_environment() or load_skybox()
+    prefilter = base.complexpbr_env_prefilter
+    if prefilter is not None and prefilter.source_tex != base.cube_buffer.get_texture():
+        prefilter.set_source(base.cube_buffer.get_texture())
+    base.complexpbr_env_space[0] = 0
+
+def exclude_from_capture(node):
+    # keeps node out of the cubemap capture, IE small props, particles or characters nobody sees reflected
+    base.complexpbr_capture_filter.exclude(node)
+
+def include_in_capture(node):
+    base.complexpbr_capture_filter.include(node)
+
+def set_capture_proxy(node,proxy):
+    # the cubemap capture draws proxy, IE a low-LOD copy placed alongside node, and the main camera draws node
+    base.complexpbr_capture_filter.add_proxy(node, proxy)
+
+def set_capture_culling(far=None,min_pixels=None,shading=None,cull_hz=None):
+    # far: capture distance (0 restores the lens default), min_pixels: GeomNodes projecting to fewer pixels in a
+    # cube face are skipped (0 is off), shading: 'full' or 'unlit', cull_hz: how often min_pixels is re-evaluated
+    base.complexpbr_capture_filter.configure(far, min_pixels, shading, cull_hz)
+
+def get_capture_shader(shading, skinned):
+    # the cube cameras' override shader, ibl_v.vert without motion vectors and displacement under capture_f.frag
+    defines = {'SKINNING': int(skinned), 'DISPLACEMENT': 0, 'MOTION_VECTORS': 0}
+
+    return compose_shader('ibl_v.vert', 'capture_f.frag', base.complexpbr_shader_dir, (), defines)
+
+def add_reflection_probe(pos,size=(20,20,10),static=True,resolution=128,parallax=True,update_mode='always'):
+    # a cube capture placed in the world, size is its box, which is also the parallax correction box
+    # static probes capture once (and on probe.capture()), dynamic ones follow update_mode like set_cubemap_update()
+    return base.complexpbr_reflection_probes.add_probe(pos, size, static, resolution, parallax, update_mode)
+
+def remove_reflection_probe(probe):
+    base.complexpbr_reflection_probes.remove_probe(probe)
+
+def set_reflection_probes(node,mode='blend'):
+    # GeomNodes below node sample the probe(s) around them instead of the camera rig's environment,
+    # 'nearest' picks one probe, 'blend' up to two weighted by how deep inside their boxes each GeomNode is
+    base.complexpbr_reflection_probes.add_node(node, mode)
+
+def clear_reflection_probes(node):
+    base.complexpbr_reflection_probes.remove_node(node)
+
+def set_reflection_probe_options(update_hz=None,blend_distance=None):
+    # update_hz: how often GeomNodes pick their probes, blend_distance: the fade width inside a probe's box
+    base.complexpbr_reflection_probes.configure(update_hz, blend_distance)
+
+def set_sh_irradiance(update_hz=None,smoothing=None,coefficients=None):
+    # coefficients are radiance SH9 terms, IE from complexpbr.sh_irradiance.project_sh9(), and stay until the next projection
+    if update_hz is not None:
+        base.complexpbr_sh_irradiance.update_hz = max(0.001, float(update_hz))
+    if smoothing is not None:
+        base.complexpbr_sh_irradiance.smoothing = float(smoothing)
+    if coefficients is not None:
+        base.complexpbr_sh_irradiance.set_coefficients(coefficients, immediate=True)
+
+def add_clustered_light(light_np):
+    # PointLight or Spotlight NodePath, lit through the clustered forward+ path instead of set_light()
+    base.complexpbr_light_clusters.add_light(light_np)
+
+def remove_clustered_light(light_np):
+    base.complexpbr_light_clusters.remove_light(light_np)
+
+def cluster_scene_lights(node=None):
+    # moves the unshadowed point and spot lights set on node over to the clustered path,
+    # shadow casters stay in the p3d_LightSource loop which has their shadow maps
+    node = base.render if node is None else node
+    light_attrib = node.get_attrib(LightAttrib)
+    if light_attrib is None:
+        return
+
+    for light_np in list(light_attrib.get_on_lights()):
+        light = light_np.node()
+        if isinstance(light, (PointLight, Spotlight)) and not light.is_shadow_caster() and not base.complexpbr_shadow_atlas.has_light(light_np):
+            node.clear_light(light_np)
+            add_clustered_light(light_np)
+
+def set_light_clusters(dims=None,far=None,cutoff=None):
+    # dims: (x tiles, y tiles, depth slices), far: last slice distance, cutoff: light contribution treated as zero
+    base.complexpbr_light_clusters.configure(dims, far, cutoff)
+
+def add_shadow_light(light_np):
+    # Spotlight or DirectionalLight NodePath, still set_light() as usual, its shadows are drawn into the shared atlas
+    base.complexpbr_shadow_atlas.add_light(light_np)
+
+def remove_shadow_light(light_np):
+    base.complexpbr_shadow_atlas.remove_light(light_np)
+
+def add_dynamic_shadow_caster(node):
+    # moving or animated geometry, atlas shadows of everything else are cached until a light or static node moves
+    base.complexpbr_shadow_atlas.add_dynamic_caster(node)
+
+def remove_dynamic_shadow_caster(node):
+    base.complexpbr_shadow_atlas.remove_dynamic_caster(node)
+
+def invalidate_shadows():
+    # re-renders the cached static shadows, IE after editing geometry in place without moving a node
+    base.complexpbr_shadow_atlas.invalidate()
+
+def set_shadow_atlas(min_tile=None,max_tile=None):
+    # tiles are sized by the screen coverage of each light between min_tile and max_tile
+    base.complexpbr_shadow_atlas.configure(min_tile, max_tile)
+
+def add_motion_node(node):
+    # moving geometry, IE props and characters, writes its own screen motion for the temporal passes instead of the
+    # camera's alone; skinned GeomNodes drop their history either way
+    base.complexpbr_motion_vectors.add_node(node)
+
+def remove_motion_node(node):
+    base.complexpbr_motion_vectors.remove_node(node)
+
+def capture_cubemap_now():
+    restore_live_environment()
+    base.complexpbr_cube_scheduler.capture_now()
 
 def rotate_cubemap(task):
-    base.complexpbr_map.set_h(base.render,base.cam.get_h(base.render))
-    base.complexpbr_map.set_p(base.render,base.cam.get_p(base.render) + 90)
     cam_pos = base.cam.get_pos(base.render)
+    cam_hpr = base.cam.get_hpr(base.render)
+    env_cam_pos = Vec3(base.env_cam_pos) if base.env_cam_pos is not None else None
+    rig_state = (cam_pos, cam_hpr, env_cam_pos, base.complexpbr_map_z, base.complexpbr_z_tracking)
+
+    # leave the rig alone while the camera and the rig settings are unchanged
+    if rig_state == base.complexpbr_rig_state:
+        return task.cont
+
+    base.complexpbr_map.set_h(base.render,cam_hpr[0])
+    base.complexpbr_map.set_p(base.render,cam_hpr[1] + 90)
     if base.env_cam_pos is not None:
         base.complexpbr_map.set_pos(base.env_cam_pos[0],base.env_cam_pos[1],base.env_cam_pos[2]+base.complexpbr_map_z)
     else:
@@ -39,85 +264,118 @@ def rotate_cubemap(task):
         base.env_cam_pos = cam_relative_pos
 
     base.cam_pos = cam_pos
+    env_cam_pos = Vec3(base.env_cam_pos) if base.env_cam_pos is not None else None
+    base.complexpbr_rig_state = (cam_pos, cam_hpr, env_cam_pos, base.complexpbr_map_z, base.complexpbr_z_tracking)
     
     return task.cont
 
+def set_quality_governor(enabled=True,target_ms=16.6,tiers=None,down_delay=None,up_delay=None):
+    # steps ssao/ssr/bloom samples, the scene render scale and the cube faces per frame down a tier when frames run
+    # over target_ms and back up once they have stayed well under it, see complexpbr/quality_governor.py
+    governor = base.complexpbr_quality_governor
+    governor.configure(target_ms, tiers, down_delay, up_delay)
+    if enabled:
+        governor.start()
+    else:
+        governor.stop()
+
+def get_quality_tier():
+    # 0 is the lowest tier, len(tiers) - 1 the user's own settings
+    return base.complexpbr_quality_governor.tier
+
+def set_quality_tier(tier):
+    # IE from a graphics menu, the governor keeps stepping from there while it is enabled
+    base.complexpbr_quality_governor.set_tier(tier)
+
+def add_quality_callback(callback):
+    # callback(governor, tier) whenever the tier changes
+    base.complexpbr_quality_governor.add_callback(callback)
+
+def remove_quality_callback(callback):
+    base.complexpbr_quality_governor.remove_callback(callback)
+
+def set_profiling(enabled=True,window=120,pstats=False,gpu_timing=False):
+    # samples get_frame_stats() every frame; pstats=True connects to a running PStats server, where the tasks show
+    # up as App:Show code:complexpbr_* and each buffer as Draw:complexpbr_*, with GPU times if gpu_timing=True
+    frame_stats = base.complexpbr_frame_stats
+    frame_stats.configure(window)
+    if enabled:
+        frame_stats.start()
+    else:
+        frame_stats.stop()
+    if pstats and not connect_pstats(gpu_timing):
+        print('complexpbr message: could not connect to a PStats server')
+
+def get_frame_stats():
+    # rolling averages in milliseconds: frame_ms, cpu_ms per complexpbr task, draw_ms per stage (IE cube_capture,
+    # forward, ssao, ssr, bloom, taa, screen) and the per-frame counts; the first call starts sampling
+    frame_stats = base.complexpbr_frame_stats
+    frame_stats.start()
+
+    return frame_stats.get()
+
 def smooth_ssao(ssao_samples=16,ssao_radius=0.4,ssao_bias=0.01,ssao_intensity=0.5,ssao_step_time=0.1):
+    # SSAO is blurred and upsampled in its own pass now, so the sample count no longer needs to be
+    # ramped over time to hide noise; this applies the settings once, ssao_step_time is unused
     if base.complexpbr_screenspace_init:
-        base.ssao_samples_half = int(ssao_samples/2)
-        base.ssao_current_samples = base.ssao_samples_half
-        base.ssao_down_bool = True
-        base.ssao_bias = ssao_bias
-        base.ssao_current_bias = base.ssao_bias
-        base.ssao_step_time = ssao_step_time
-        base.ssao_radius = ssao_radius
-        
+        base.screen_quad.set_shader_input('ssao_samples', ssao_samples)
+        base.screen_quad.set_shader_input('ssao_radius', ssao_radius)
+        base.screen_quad.set_shader_input('ssao_bias', ssao_bias)
         base.screen_quad.set_shader_input('ssao_intensity', ssao_intensity)
-        base.screen_quad.set_shader_input("ssao_radius", base.ssao_radius)
-        
-        def smooth_task(task, name='smooth_ssao_task'):
-            if base.ssao_down_bool and base.ssao_current_samples < ssao_samples:
-                base.ssao_current_samples += 1
-                base.screen_quad.set_shader_input('ssao_samples', base.ssao_current_samples)
-                base.ssao_current_bias += (base.ssao_bias/base.ssao_samples_half)
-                base.screen_quad.set_shader_input('ssao_bias', base.ssao_current_bias)
-                
-            else:
-                base.ssao_current_samples -= 1
-                base.screen_quad.set_shader_input('ssao_samples', base.ssao_current_samples)
-                base.ssao_current_bias -= (base.ssao_bias/base.ssao_samples_half)
-                base.screen_quad.set_shader_input('ssao_bias', base.ssao_current_bias)
-                base.ssao_down_bool = False
-                
-            if base.ssao_current_samples < base.ssao_samples_half:
-                base.ssao_down_bool = True
-            
-            # print(base.ssao_current_samples, base.ssao_current_bias)
-            task.delay_time = base.ssao_step_time
-            return task.again
-        
-        base.task_mgr.add(smooth_task)
     else:
         print('smooth_ssao failed to start up, did you call screenspace_init() yet?')
     
 def remove_smooth_ssao():
     if base.complexpbr_screenspace_init:
-        try:
-            base.task_mgr.remove('smooth_ssao_task')
-
-            ssao_samples = 12
-            ssao_radius = 0.4
-            ssao_bias = 0.01
-            ssao_intensity = 0.5
-            
-            base.screen_quad.set_shader_input('ssao_samples', ssao_samples)
-            base.screen_quad.set_shader_input('ssao_radius', ssao_radius)
-            base.screen_quad.set_shader_input('ssao_bias', ssao_bias)
-            base.screen_quad.set_shader_input('ssao_intensity', ssao_intensity)
-            
-        except:
-            print('smooth_ssao_task not found.')
+        ssao_samples = 12
+        ssao_radius = 0.4
+        ssao_bias = 0.01
+        ssao_intensity = 0.5
+        
+        base.screen_quad.set_shader_input('ssao_samples', ssao_samples)
+        base.screen_quad.set_shader_input('ssao_radius', ssao_radius)
+        base.screen_quad.set_shader_input('ssao_bias', ssao_bias)
+        base.screen_quad.set_shader_input('ssao_intensity', ssao_intensity)
     else:
         print('remove_smooth_ssao failed to start up, did you call screenspace_init() yet?')
 
-def screenspace_init(dist=False):
+def screenspace_init(dist=False,bloom_levels=5,ssao_scale=2,ssr_scale=2,scene_format='rgba8',linear_depth=False):
+    # scene_format: 'rgba8', 'r11g11b10' (packed HDR) or 'rgba16' (half float HDR) scene color,
+    # linear_depth: SSAO reads a linear depth target written once per frame instead of linearizing every tap
+    scene_fbprops = make_scene_fbprops(scene_format)
     auxbits = 0
     auxbits |= AuxBitplaneAttrib.ABOAuxNormal
 
     filter_manager = FilterManager(base.win, base.cam)
     scene_tex = Texture("scene_tex")
     depth_tex = Texture("depth_tex")
+    # the packed octahedral view space normal and screen motion written by ibl_f.frag, both read unfiltered
     normal_tex = Texture("normal_tex")
-    all_tex = {}
+    velocity_tex = Texture("velocity_tex")
+    for aux_tex in (normal_tex, velocity_tex):
+        aux_tex.set_minfilter(SamplerState.FT_nearest)
+        aux_tex.set_magfilter(SamplerState.FT_nearest)
     # prevent edge artifacts when rendering the screen_quad scene_tex
     scene_tex.set_wrap_u(Texture.WM_clamp)
     scene_tex.set_wrap_v(Texture.WM_clamp)
     
-    screen_quad = filter_manager.render_scene_into(colortex=scene_tex,
-                                                   auxbits=auxbits,
-                                                   depthtex=depth_tex,
-                                                   auxtex=normal_tex,
-                                                   textures=all_tex)
+    if scene_fbprops is None:
+        aux_slots = (GraphicsOutput.RTP_aux_rgba_0, GraphicsOutput.RTP_aux_rgba_1)
+        all_tex = {'color': scene_tex, 'depth': depth_tex, 'aux0': normal_tex, 'aux1': velocity_tex}
+        screen_quad = filter_manager.render_scene_into(auxbits=auxbits,
+                                                       textures=all_tex)
+    else:
+        # Panda gives the aux rgba targets the color format, the packed normal and velocity go to the half float ones
+        aux_slots = (GraphicsOutput.RTP_aux_hrgba_0, GraphicsOutput.RTP_aux_hrgba_1)
+        scene_fbprops.set_aux_hrgba(2)
+        screen_quad = filter_manager.render_scene_into(auxbits=auxbits, textures={'color': scene_tex, 'depth': depth_tex},
+                                                       fbprops=scene_fbprops)
+        for aux_tex, slot in zip((normal_tex, velocity_tex), aux_slots):
+            filter_manager.buffers[0].add_render_texture(aux_tex, GraphicsOutput.RTM_bind_or_copy, slot)
+    # geometry without the ibl shader keeps the clear values, which decode to no normal and no motion
+    for slot, clear_value in zip(aux_slots, ((0, 0, 0, 0), (128 / 255, 0, 128 / 255, 0))):
+        filter_manager.buffers[0].set_clear_active(slot, True)
+        filter_manager.buffers[0].set_clear_value(slot, clear_value)
     Texture.set_textures_power_2(ATS_none)
     window_size = [base.win.get_x_size(),base.win.get_y_size()]
     camera_near = base.camLens.get_near()
@@ -128,16 +386,17 @@ def screenspace_init(dist=False):
     bloom_samples = 6
     bloom_threshold = 0.7
     ssr_intensity = 0.5
-    ssr_step = 4.0
     ssr_fresnel_pow = 3.0
     ssr_samples = 0  # default SSR to 0.0 / off
-    screen_ray_factor = 0.1
-    ssr_depth_cutoff = 0.6
-    ssr_depth_min = 0.5
+    ssr_thickness = 0.5
+    ssr_max_distance = 50.0
+    ssr_temporal_blend = 0.9
+    taa_blend = 0.0  # default TAA to 0.0 / off
     ssao_samples = 0
     ssao_radius = 0.99
     ssao_bias = 0.005
     ssao_intensity = 0.5
+    ssao_temporal_blend = 0.9
     reflection_threshold = 0.1
     hsv_r = 1.0
     hsv_g = 1.0
@@ -155,6 +414,7 @@ def screenspace_init(dist=False):
         frag = (shader_dir / 'min_f.frag')
         
     shader = Shader.load(Shader.SL_GLSL, vert, frag)
+    base.complexpbr_screenspace_dir = Path('.') if dist else files('complexpbr')
     screen_quad.set_shader(shader)
     screen_quad.set_shader_input("window_size", window_size)
     screen_quad.set_shader_input("scene_tex", scene_tex)
@@ -167,27 +427,100 @@ def screenspace_init(dist=False):
     screen_quad.set_shader_input("bloom_blur_width", bloom_blur_width)
     screen_quad.set_shader_input("bloom_samples", bloom_samples)
     screen_quad.set_shader_input("ssr_intensity", ssr_intensity)
-    screen_quad.set_shader_input("ssr_step", ssr_step)
     screen_quad.set_shader_input("ssr_fresnel_pow", ssr_fresnel_pow)
     screen_quad.set_shader_input("ssr_samples", ssr_samples)
-    screen_quad.set_shader_input("screen_ray_factor", screen_ray_factor)
-    screen_quad.set_shader_input("ssr_depth_cutoff", ssr_depth_cutoff)
-    screen_quad.set_shader_input("ssr_depth_min", ssr_depth_min)
+    screen_quad.set_shader_input("ssr_thickness", ssr_thickness)
+    screen_quad.set_shader_input("ssr_max_distance", ssr_max_distance)
+    screen_quad.set_shader_input("ssr_temporal_blend", ssr_temporal_blend)
     screen_quad.set_shader_input("ssao_samples", ssao_samples)
     screen_quad.set_shader_input("ssao_radius", ssao_radius)
     screen_quad.set_shader_input("ssao_bias", ssao_bias)
     screen_quad.set_shader_input("ssao_intensity", ssao_intensity)
+    screen_quad.set_shader_input("ssao_temporal_blend", ssao_temporal_blend)
+    screen_quad.set_shader_input("taa_blend", taa_blend)
     screen_quad.set_shader_input("reflection_threshold", reflection_threshold)
     screen_quad.set_shader_input("hsv_r", hsv_r)
     screen_quad.set_shader_input("hsv_g", hsv_g)  # HSV saturation adjustment
     screen_quad.set_shader_input("hsv_b", hsv_b)
     screen_quad.set_shader_input("final_brightness", final_brightness)
     
+    # the effects are passes of a render graph, which skips whatever the final screen_quad does not read
+    # and lets passes that never run at the same time share their render targets
+    base.complexpbr_filter_manager = filter_manager
+    graph = RenderGraph(filter_manager)
+    graph.add_resource('scene', scene_tex)
+    graph.add_resource('depth', depth_tex)
+    graph.add_resource('normal', normal_tex)
+    graph.add_resource('velocity', velocity_tex)
+    base.complexpbr_render_graph = graph
+    # bloom runs as its own downsampled pyramid, the knobs above are read back off screen_quad
+    base.complexpbr_bloom = BloomPyramid(graph, base.complexpbr_screenspace_dir, levels=bloom_levels)
+    # min/max depth pyramid, built only while a pass such as SSR reads it
+    base.complexpbr_hiz = HiZPyramid(graph, depth_tex, base.complexpbr_screenspace_dir)
+    # SSAO runs at 1/ssao_scale resolution, blurred, then upsampled by min_f.frag
+    motion_vectors = base.complexpbr_motion_vectors
+    base.complexpbr_ssao = SSAOPass(graph, motion_vectors.frame_index_input, base.complexpbr_screenspace_dir, scale=ssao_scale,
+                                    linear_depth=linear_depth)
+    # SSR marches the depth pyramid at 1/ssr_scale resolution
+    base.complexpbr_ssr = SSRPass(graph, base.complexpbr_hiz, motion_vectors.frame_index_input, base.complexpbr_screenspace_dir, scale=ssr_scale)
+    # temporal AA resolves the jittered scene against its reprojected history ahead of min_f.frag
+    base.complexpbr_taa = TemporalAA(graph, motion_vectors, base.complexpbr_screenspace_dir)
+
+    graph.add_sink(screen_quad, {'scene_tex': 'scene_out', 'ssao_tex': 'ssao_blur_v', 'ssr_tex': 'ssr_out', 'bloom_tex': 'bloom'})
+    graph.compile_callbacks.append(compile_screenspace_shader)
     base.screen_quad = screen_quad
+    base.complexpbr_screenspace_mods = ([], None, False)
+    base.complexpbr_screenspace_variant = None
+    # the graph first compiles in this task, ahead of the first frame
+    base.task_mgr.add(screenspace_sync, 'complexpbr_screenspace_sync', sort=46)
+
     base.render.set_antialias(AntialiasAttrib.MMultisample)
     base.complexpbr_screenspace_init = True
 
-def complexpbr_rig_init(node, intensity, lut_fill, shadow_boost):
+def screenspace_sync(task):
+    base.complexpbr_bloom.sync(base.screen_quad)
+    base.complexpbr_ssao.sync(base.screen_quad, base.camLens)
+    base.complexpbr_ssr.sync(base.screen_quad, base.camLens)
+    base.complexpbr_hiz.sync()
+    base.complexpbr_taa.sync(base.screen_quad)
+    base.complexpbr_render_graph.update()
+
+    return task.cont
+
+def compile_screenspace_shader(graph):
+    # min_f.frag is compiled for the set of live effects, so a disabled effect costs nothing in the final pass
+    defines = {'SSAO': int(graph.is_live('ssao_blur_v')), 'SSR': int(graph.is_live('ssr_out')),
+               'BLOOM': int(graph.is_live('bloom')), 'TAA': int(graph.is_live('taa'))}
+    mods, user_defines, write_files = base.complexpbr_screenspace_mods
+    variant = (tuple(sorted(defines.items())), id(mods), id(user_defines))
+    if variant == base.complexpbr_screenspace_variant:
+        return
+    base.complexpbr_screenspace_variant = variant
+
+    base.screen_quad.set_shader(get_screenspace_variant(defines))
+
+def get_screenspace_variant(defines):
+    mods, user_defines, write_files = base.complexpbr_screenspace_mods
+
+    return compose_shader('min_v.vert', 'min_f.frag', base.complexpbr_screenspace_dir, mods, {**defines, **(user_defines or {})},
+                          write_files, write_names=('min_v', 'min_f'))
+
+def make_fill_lut(lut_fill):
+    # a constant LUT only needs a single texel
+    brdf_lut_tex = Texture("complexpbr_lut")
+    brdf_lut_image = PNMImage(1, 1, 3)
+    brdf_lut_image.fill(red=lut_fill[0],green=lut_fill[1],blue=lut_fill[2])
+    brdf_lut_tex.load(brdf_lut_image)
+
+    return brdf_lut_tex
+
+def load_rig_prc():
+    global rig_prc_loaded
+
+    if rig_prc_loaded:
+        return
+    rig_prc_loaded = True
+
     load_prc_file_data('', 'hardware-animated-vertices #t')
     load_prc_file_data('', 'framebuffer-srgb #t')
     load_prc_file_data('', 'framebuffer-depth-32 1')
@@ -195,44 +528,115 @@ def complexpbr_rig_init(node, intensity, lut_fill, shadow_boost):
     load_prc_file_data('', 'gl-cube-map-seamless 1')
     load_prc_file_data('', 'framebuffer-multisample 1')
     load_prc_file_data('', 'multisamples 4')
-    
-    brdf_lut_tex = Texture("complexpbr_lut")
-    brdf_lut_image = PNMImage()
-    brdf_lut_image.clear(x_size=base.win.get_x_size(),y_size=base.win.get_y_size(),num_channels=4)
-    brdf_lut_image.fill(red=lut_fill[0],green=lut_fill[1],blue=lut_fill[2])
-    # brdf_lut_image.alpha_fill(1.0)
-    brdf_lut_tex.load(brdf_lut_image)
-    brdf_lut_ext_tex = Path('output_brdf_lut.png')
-    
-    if brdf_lut_ext_tex.is_file():
-        brdf_lut_tex = loader.load_texture('output_brdf_lut.png')
+
+def rig_attribs(intensity, lut_fill, shadow_boost, brdf_lut_size=128, brdf_lut_samples=512, brdf_lut_model='ggx'):
+    # built once per setting on a bare NodePath, IE 2,000 level nodes share a single attrib instead of each
+    # holding its own copy of every input
+    key = (float(intensity), None if lut_fill is None else tuple(lut_fill), float(shadow_boost),
+           brdf_lut_size, brdf_lut_samples, brdf_lut_model)
+    if key in rig_attrib_cache:
+        return rig_attrib_cache[key]
+
+    if lut_fill is not None:
+        brdf_lut_tex = make_fill_lut(lut_fill)
     else:
-        brdf_lut_tex.load(brdf_lut_image)
+        try:
+            brdf_lut_tex = get_brdf_lut_texture(brdf_lut_size, brdf_lut_samples, brdf_lut_model)
+        except Exception as e:
+            print('complexpbr message: BRDF LUT baking failed (' + str(e) + '), falling back to a constant LUT.')
+            brdf_lut_tex = make_fill_lut([1.0,0.0,0.0])
 
-    shader_cam_pos = Vec3(base.cam.get_pos(base.render))
     displacement_scale_val = 0.0  # default to 0 to avoid having to check for displacement
     displacement_map = Texture()
     specular_factor = 1.0
 
-    node.set_shader(base.complexpbr_shader)
+    inputs_np = NodePath('complexpbr_rig_inputs')
+    inputs_np.set_shader(base.complexpbr_shader)
+
+    inputs_np.set_tex_gen(TextureStage.get_default(), TexGenAttrib.MWorldCubeMap)
+    inputs_np.set_shader_input("cubemaptex", base.cube_buffer.get_texture())
+    inputs_np.set_shader_input("prefiltered_envmap", base.complexpbr_env_tex)
+    inputs_np.set_shader_input("prefilter_max_lod", base.complexpbr_env_max_lod)
+    inputs_np.set_shader_input("sh_irradiance", base.complexpbr_sh_irradiance.sh_input)
+    inputs_np.set_shader_input("env_world_space", base.complexpbr_env_space)
+    base.complexpbr_light_clusters.set_shader_inputs(inputs_np)
+    base.complexpbr_motion_vectors.set_shader_inputs(inputs_np)
+    base.complexpbr_shadow_atlas.set_shader_inputs(inputs_np)
+    base.complexpbr_reflection_probes.set_shader_inputs(inputs_np, base.complexpbr_env_tex)
+    inputs_np.set_shader_input("brdfLUT", brdf_lut_tex)
+    inputs_np.set_shader_input("ao", intensity)
+    inputs_np.set_shader_input("shadow_boost", shadow_boost)
+    inputs_np.set_shader_input("displacement_scale", displacement_scale_val)
+    inputs_np.set_shader_input("displacement_map", displacement_map)
+    inputs_np.set_shader_input("specular_factor", specular_factor)
+
+    rig_attrib_cache[key] = (inputs_np.get_attrib(ShaderAttrib), inputs_np.get_attrib(TexGenAttrib))
+
+    return rig_attrib_cache[key]
+
+def complexpbr_rig_init(node, intensity, lut_fill, shadow_boost, brdf_lut_size=128, brdf_lut_samples=512, brdf_lut_model='ggx'):
+    load_rig_prc()
+
+    shader_attrib, tex_gen_attrib = rig_attribs(intensity, lut_fill, shadow_boost, brdf_lut_size, brdf_lut_samples, brdf_lut_model)
+    # inputs already on the node are overridden by the rig's, like set_shader_input() did
+    node_shader_attrib = node.get_attrib(ShaderAttrib)
+    node.set_attrib(shader_attrib if node_shader_attrib is None else node_shader_attrib.compose(shader_attrib))
+    node_tex_gen_attrib = node.get_attrib(TexGenAttrib)
+    node.set_attrib(tex_gen_attrib if node_tex_gen_attrib is None else node_tex_gen_attrib.compose(tex_gen_attrib))
 
-    node.set_tex_gen(TextureStage.get_default(), TexGenAttrib.MWorldCubeMap)
-    node.set_shader_input("cubemaptex", base.cube_buffer.get_texture())
-    node.set_shader_input("brdfLUT", brdf_lut_tex)
-    node.set_shader_input("ao", intensity)
-    node.set_shader_input("shadow_boost", shadow_boost)
-    node.set_shader_input("displacement_scale", displacement_scale_val)
-    node.set_shader_input("displacement_map", displacement_map)
-    node.set_shader_input("specular_factor", specular_factor)
-
-    base.task_mgr.add(rotate_cubemap)
+def skin(node):
+    # GPU skinning for every GeomNode under node, animated vertex data is also picked up by apply_shader() on its own
+    select_vertex_variants(node, skinned=True)
+
+def bound_light_slots(node):
+    # the light loop length for the lights bound on node, rounded up to a power of 2 to keep the variants few
+    light_attrib = node.get_net_state().get_attrib(LightAttrib)
+    light_count = light_attrib.get_num_non_ambient_lights() if light_attrib is not None else 0
+
+    return min(1 << max(0, light_count - 1).bit_length(), SHADER_FEATURES['max_lights'])
+
+def select_vertex_variants(node, skinned=False):
+    # static geometry gets the vertex shader without the p3d_TransformTable skinning and the displacement_map fetch,
+    # animated vertex data the skinned variant and a nonzero displacement_scale the displaced one
+    for geom_np in node.find_all_matches('**/+GeomNode'):
+        features = geom_np.get_net_python_tag('complexpbr_features')
+        light_slots = bound_light_slots(geom_np) if features and features.get('max_lights') == 'auto' else None
+        geom_skinned = skinned or geom_np.has_python_tag('complexpbr_skinned') or any(
+            geom.get_vertex_data().get_format().get_animation().get_animation_type() != GeomEnums.AT_none
+            for geom in geom_np.node().get_geoms())
+        shader_attrib = geom_np.get_net_state().get_attrib(ShaderAttrib)
+        displaced = shader_attrib is not None and shader_input_value(shader_attrib, 'displacement_scale') != 0.0
+
+        if geom_skinned or displaced or light_slots is not None:
+            variant = get_shader_variant(features, geom_skinned, displaced, geom_np.get_net_python_tag('complexpbr_mods'), light_slots=light_slots)
+            node_attrib = geom_np.node().get_attrib(ShaderAttrib) or ShaderAttrib.make()
+            geom_np.node().set_attrib(node_attrib.set_shader(variant).set_flag(ShaderAttrib.F_hardware_skinning, geom_skinned))
+            geom_np.set_python_tag('complexpbr_vertex_variant', True)
+            if geom_skinned:
+                geom_np.set_python_tag('complexpbr_skinned', True)
+                # also a plain tag, which the capture cameras key their skinned override state on
+                geom_np.set_tag('complexpbr_skinned', '1')
+        elif geom_np.has_python_tag('complexpbr_vertex_variant'):
+            # back to the static variant of the nearest node above, keeping inputs set on the GeomNode
+            geom_attrib = geom_np.node().get_attrib(ShaderAttrib)
+            geom_np.node().set_attrib(geom_attrib.clear_shader().clear_flag(ShaderAttrib.F_hardware_skinning))
+            geom_np.clear_python_tag('complexpbr_vertex_variant')
+
+def request_vertex_variants(node):
+    # inputs such as displacement_scale are usually set after apply_shader(), so look again ahead of the first frame,
+    # in one task however many nodes asked
+    select_vertex_variants(node)
+    if not vertex_variant_requests:
+        base.task_mgr.add(select_requested_variants, 'complexpbr_vertex_variants', sort=-10)
+    vertex_variant_requests.append(node)
+
+def select_requested_variants(task):
+    for node in vertex_variant_requests:
+        if not node.is_empty():
+            select_vertex_variants(node)
+    vertex_variant_requests.clear()
 
-    base.complexpbr_skin_attrib = ShaderAttrib.make(base.complexpbr_shader)
-    base.complexpbr_skin_attrib = base.complexpbr_skin_attrib.set_flag(ShaderAttrib.F_hardware_skinning, True)
 
-def skin(node):
-    node.set_attrib(base.complexpbr_skin_attrib)
-    
 def copy_to_dist():
     shader_dir = files('complexpbr')
     # shader_dir = os.getcwd()
@@ -245,9 +649,22 @@ def copy_to_dist():
     (Path('ibl_f.frag')).write_text(r_frag)
     (Path('min_v.vert')).write_text(s_vert)
     (Path('min_f.frag')).write_text(s_frag)
+
+    for extra_shader in dist_shader_files:
+        (Path(extra_shader)).write_text((shader_dir / extra_shader).read_text())
             
-def apply_shader(node=None,intensity=1.0,env_cam_pos=None,env_res=256,lut_fill=[1.0,0.0,0.0],complexpbr_z_tracking=False,
-custom_dir='',default_lighting=False,shadow_boost=0.0,dist=False):
+def apply_shader_batch(nodes,**kwargs):
+    # apply_shader() over many nodes, IE level chunks, with the same keyword arguments; the nodes share one
+    # ShaderAttrib of rig inputs, the rig task and the vertex variant pass ahead of the first frame
+    nodes = list(nodes)
+    if nodes:
+        apply_shader(nodes, **kwargs)
+
+def apply_shader(node=None,intensity=1.0,env_cam_pos=None,env_res=256,lut_fill=None,complexpbr_z_tracking=False,
+custom_dir='',default_lighting=False,shadow_boost=0.0,dist=False,brdf_lut_size=128,brdf_lut_samples=512,brdf_lut_model='ggx',
+cube_update_mode='always',cube_faces_per_frame=6,cube_update_hz=10.0,prefilter_env=True,prefilter_levels=5,prefilter_samples=32,
+sh_update_hz=2.0,sh_smoothing=0.5,cluster_dims=(16,9,24),cluster_far=None,shadow_atlas_size=4096,capture_far=None,capture_min_pixels=0.0,capture_shading='full',
+features=None):
     global complexpbr_init
     
     base.complexpbr_custom_dir = custom_dir
@@ -265,17 +682,58 @@ custom_dir='',default_lighting=False,shadow_boost=0.0,dist=False):
             vert = (shader_dir / 'ibl_v.vert')
             frag = (shader_dir / 'ibl_f.frag')
         
-        base.complexpbr_shader = Shader.load(Shader.SL_GLSL, vert, frag)
+        base.complexpbr_shader_dir = Path('.') if dist else files('complexpbr')
+        base.complexpbr_shader = get_shader_variant()
 
         base.complexpbr_map = NodePath('cuberig')
-        base.cube_buffer = base.win.make_cube_map('cubemap', env_res, base.complexpbr_map)
+        base.cube_buffer = base.win.make_cube_map('complexpbr_cubemap', env_res, base.complexpbr_map)
         base.complexpbr_map.reparent_to(base.render)
         base.complexpbr_map_z = 0
         base.env_cam_pos = env_cam_pos
         base.complexpbr_z_tracking = complexpbr_z_tracking
-        base.complexpbr_append_shader_count = 0
-
-    complexpbr_rig_init(node, intensity=intensity, lut_fill=lut_fill, shadow_boost=shadow_boost)
+        base.complexpbr_rig_state = None
+        base.complexpbr_cube_scheduler = CubemapScheduler(base.cube_buffer, base.complexpbr_map, mode=cube_update_mode,
+                                                          faces_per_frame=cube_faces_per_frame, update_hz=cube_update_hz)
+        base.complexpbr_capture_filter = CaptureFilter(base.cube_buffer, base.complexpbr_map, get_capture_shader, far=capture_far,
+                                                       min_pixels=capture_min_pixels, shading=capture_shading)
+
+        if prefilter_env:
+            base.complexpbr_env_prefilter = EnvPrefilter(base.cube_buffer.get_texture(), size=env_res, levels=prefilter_levels,
+                                                         sample_count=prefilter_samples, shader_dir=base.complexpbr_shader_dir)
+            base.complexpbr_cube_scheduler.add_capture_callback(base.complexpbr_env_prefilter.on_capture)
+            base.complexpbr_env_tex = base.complexpbr_env_prefilter.env_tex
+            base.complexpbr_env_max_lod = base.complexpbr_env_prefilter.max_lod
+        else:
+            # without prefiltering, sample the hardware mips of the live capture
+            base.complexpbr_env_prefilter = None
+            base.complexpbr_env_tex = base.cube_buffer.get_texture()
+            base.complexpbr_env_tex.set_minfilter(SamplerState.FT_linear_mipmap_linear)
+            base.complexpbr_env_max_lod = 4.0
+
+        # 1 while a baked environment or skybox stands in for the capture, see load_environment()
+        base.complexpbr_env_space = PTA_int.empty_array(1)
+        base.complexpbr_sh_irradiance = ShIrradiance(base.cube_buffer.get_texture(), update_hz=sh_update_hz,
+                                                     smoothing=sh_smoothing, shader_dir=base.complexpbr_shader_dir)
+        base.complexpbr_cube_scheduler.add_capture_callback(base.complexpbr_sh_irradiance.on_capture)
+        base.complexpbr_light_clusters = LightClusters(base.cam, dims=cluster_dims, far=cluster_far)
+        base.complexpbr_motion_vectors = MotionVectors(base.cam)
+        base.complexpbr_shadow_atlas = ShadowAtlas(shadow_atlas_size, shader_dir=base.complexpbr_shader_dir)
+        base.complexpbr_reflection_probes = ReflectionProbes(levels=prefilter_levels, sample_count=prefilter_samples,
+                                                             shader_dir=base.complexpbr_shader_dir)
+        base.complexpbr_quality_governor = QualityGovernor()
+        base.complexpbr_frame_stats = FrameStats()
+        # one rig task however many nodes are shaded
+        base.task_mgr.add(rotate_cubemap, 'complexpbr_rotate_cubemap')
+
+    # apply_shader_batch() passes a list of nodes
+    for rig_node in (node if isinstance(node, list) else [node]):
+        complexpbr_rig_init(rig_node, intensity=intensity, lut_fill=lut_fill, shadow_boost=shadow_boost,
+                            brdf_lut_size=brdf_lut_size, brdf_lut_samples=brdf_lut_samples, brdf_lut_model=brdf_lut_model)
+
+        if features is not None:
+            set_shader_features(rig_node, features)
+        else:
+            request_vertex_variants(rig_node)
     
     if default_lighting:
         try:
@@ -283,184 +741,159 @@ custom_dir='',default_lighting=False,shadow_boost=0.0,dist=False):
         except:
             print('complexpbr message: Default lighting setup failed.')
     
-def append_shader(node=None,frag_body_mod='',frag_main_mod='',vert_body_mod='',vert_main_mod='',intensity=1.0,env_cam_pos=None,
-env_res=256,lut_fill=[1.0,0.0,0.0],complexpbr_z_tracking=False,shadow_boost=0.0):
+def locate_shader_source(name, default_dir):
+    custom_path = Path(base.complexpbr_custom_dir + name)
 
-    vert = base.complexpbr_custom_dir + "ibl_v.vert"
-    frag = base.complexpbr_custom_dir + "ibl_f.frag"
+    if custom_path.is_file():
+        return custom_path
 
-    extant_append_shaders = []
-    if base.complexpbr_custom_dir == '':
-        local_shader_dir = os.listdir()
-    else:
-        local_shader_dir = os.listdir(base.complexpbr_custom_dir)
+    return Path(str(default_dir / name))
 
-    for item in local_shader_dir:
-        if 'ibl_f_' in item:
-            item = item.strip('ibl_f_').strip('.frag')
-            extant_append_shaders.append(int(item))
+def compose_shader(vert_name, frag_name, default_dir, mods=(), defines=None, write_files=False, write_names=('ibl_v', 'ibl_f')):
+    # mods are dicts keyed by stage and slot, IE {'frag_functions': ..., 'vert_main_end': ...}
+    vert_path = locate_shader_source(vert_name, default_dir)
+    frag_path = locate_shader_source(frag_name, default_dir)
+    if isinstance(mods, dict):
+        mods = [mods]
+    key = make_shader_key(shader_cache.source_digest(vert_path), shader_cache.source_digest(frag_path),
+                          [sorted(mod.items()) for mod in mods], defines or {})
 
-    extant_append_shaders = sorted(extant_append_shaders)
-    
-    try:
-        top_extant_shader_val = extant_append_shaders.pop()
-        base.complexpbr_append_shader_count = top_extant_shader_val + 1
-    except:
-        base.complexpbr_append_shader_count = 1
-
-    append_shader_file = ''
-    input_body_reached = False
-    main_reached = False
-    end_reached = False
-    
-    input_frag_body_mod = frag_body_mod
-    input_frag_main_mod = frag_main_mod
-    
-    input_vert_body_mod = vert_body_mod
-    input_vert_main_mod = vert_main_mod
-    
-    # fragment modification begins
-    if input_frag_body_mod != '' or input_frag_main_mod != '':
-        with open(frag) as shaderfile:
-            shaderstr = shaderfile.read()
-            for line in shaderstr.split('\n'):
-                append_shader_file += (line + '\n')
-                if 'uniform float shadow_boost' in line:
-                    break
-                    
-            append_shader_file += (input_frag_body_mod + '\n')
-            # print(append_shader_file)
-            
-            for line in shaderstr.split('\n'):
-                if 'const float LIGHT_CUTOFF' in line:
-                    # print(line)
-                    # print('input body reached')
-                    input_body_reached = True
-                    
-                if 'void main' in line:
-                    main_reached = True
-                                       
-                if input_body_reached and not main_reached:
-                    append_shader_file += (line + '\n')
-                    
-            main_reached = False
-                    
-            for line in shaderstr.split('\n'):
-                if 'void main' in line:
-                    main_reached = True
-                    
-                if 'outputNormal = texture(p3d_Texture2, v_texcoord).rgb * 0.5 + vec3(0.5);' in line:
-                    end_reached = True
-                    # print(line)
-                    # print('end reached')
-                    
-                if main_reached and not end_reached:
-                    append_shader_file += (line + '\n')
-                    
-            append_shader_file += (input_frag_main_mod + '\n')
-            
-            end_reached = False
-            
-            for line in shaderstr.split('\n'):
-                if 'outputNormal = texture(p3d_Texture2, v_texcoord).rgb * 0.5 + vec3(0.5);' in line:
-                    end_reached = True
-                    # print('end reached')
-                    
-                if end_reached:
-                    append_shader_file += (line + '\n')
-                        
-            out_v = open(base.complexpbr_custom_dir + 'ibl_f_' + str(base.complexpbr_append_shader_count) + '.frag', 'w')
-            
-            for line in append_shader_file.split('\n'):
-                out_v.write(line)
-                out_v.write('\n')
-                
-            out_v.close()
-                
-            frag = base.complexpbr_custom_dir + 'ibl_f_' + str(base.complexpbr_append_shader_count) + '.frag'
-    
-    # vertex modification begins
-    append_shader_file = ''
-    input_body_reached = False
-    main_reached = False
-    end_reached = False
-    
-    if input_vert_body_mod != '' or input_vert_main_mod != '':
-        extant_append_shaders = []
+    def build():
+        stage_mods = split_stage_mods(mods)
+        define_mod = {'defines': format_defines(defines)}
+        composed_vert = load_template(shader_cache, vert_path).compose([define_mod] + stage_mods['vert'])
+        composed_frag = load_template(shader_cache, frag_path).compose([define_mod] + stage_mods['frag'])
 
-        for item in local_shader_dir:
-            if 'ibl_v_' in item:
-                item = item.strip('ibl_v_').strip('.vert')
-                extant_append_shaders.append(int(item))
+        return composed_vert, composed_frag
 
-        extant_append_shaders = sorted(extant_append_shaders)
-        
-        try:
-            top_extant_shader_val = extant_append_shaders.pop()
-            base.complexpbr_append_shader_count = top_extant_shader_val + 1
-        except:
-            base.complexpbr_append_shader_count = 1
-            
-        with open(vert) as shaderfile:
-            shaderstr = shaderfile.read()
-            for line in shaderstr.split('\n'):
-                append_shader_file += (line + '\n')
-                if 'uniform float displacement_scale;' in line:
-                    break
-                    
-            append_shader_file += (input_vert_body_mod + '\n')
-            # print(append_shader_file)
-            
-            for line in shaderstr.split('\n'):
-                if 'uniform struct p3d_LightSourceParameters {' in line:
-                    # print(line)
-                    # print('input body reached')
-                    input_body_reached = True
-                    
-                if 'void main' in line:
-                    main_reached = True
-                                       
-                if input_body_reached and not main_reached:
-                    append_shader_file += (line + '\n')
-                    
-            main_reached = False
-                    
-            for line in shaderstr.split('\n'):
-                if 'void main' in line:
-                    main_reached = True
-                    
-                if 'gl_Position = p3d_ProjectionMatrix * model_view_displaced_vertex;' in line:
-                    end_reached = True
-                    # print(line)
-                    # print('end reached')
-                    
-                if main_reached and not end_reached:
-                    append_shader_file += (line + '\n')
-                    
-            append_shader_file += (input_vert_main_mod + '\n')
-            
-            end_reached = False
-            
-            for line in shaderstr.split('\n'):
-                if 'gl_Position = p3d_ProjectionMatrix * model_view_displaced_vertex;' in line:
-                    end_reached = True
-                    # print('end reached')
-                    
-                if end_reached:
-                    append_shader_file += (line + '\n')
-                        
-            out_v = open(base.complexpbr_custom_dir + 'ibl_v_' + str(base.complexpbr_append_shader_count) + '.vert', 'w')
-            
-            for line in append_shader_file.split('\n'):
-                out_v.write(line)
-                out_v.write('\n')
-                
-            out_v.close()
-                
-            vert = base.complexpbr_custom_dir + 'ibl_v_' + str(base.complexpbr_append_shader_count) + '.vert'
+    write_dir = None
+    if write_files:
+        write_dir = Path(base.complexpbr_custom_dir or '.')
+
+    return shader_cache.get(key, build, write_dir=write_dir, write_names=write_names)
+
+def append_shader(node=None,frag_body_mod='',frag_main_mod='',vert_body_mod='',vert_main_mod='',intensity=1.0,env_cam_pos=None,
+env_res=256,lut_fill=None,complexpbr_z_tracking=False,shadow_boost=0.0,mods=None,defines=None,write_files=False,features=None):
+    # the classic body/main modifications map onto the functions and main_end template slots
+    all_mods = [{'frag_functions': frag_body_mod, 'frag_main_end': frag_main_mod,
+                 'vert_functions': vert_body_mod, 'vert_main_end': vert_main_mod}]
+    if mods is not None:
+        all_mods += [mods] if isinstance(mods, dict) else list(mods)
+
+    if features is not None:
+        node.set_python_tag('complexpbr_features', dict(features))
+
+    # the skinned and displaced GeomNodes below node get the same modifications
+    node.set_python_tag('complexpbr_mods', (all_mods, defines))
+    node.set_shader(get_shader_variant(node.get_net_python_tag('complexpbr_features'), mods=(all_mods, defines), write_files=write_files))
+    request_vertex_variants(node)
+
+def append_screenspace_shader(frag_body_mod='',frag_main_mod='',mods=None,defines=None,write_files=False):
+    if not getattr(base, 'complexpbr_screenspace_init', False):
+        print('append_screenspace_shader failed to start up, did you call screenspace_init() yet?')
+        return
+
+    all_mods = [{'frag_functions': frag_body_mod, 'frag_main_end': frag_main_mod}]
+    if mods is not None:
+        all_mods += [mods] if isinstance(mods, dict) else list(mods)
+
+    # kept for the variants the render graph compiles whenever the live effects change
+    base.complexpbr_screenspace_mods = (all_mods, defines, write_files)
+    base.complexpbr_screenspace_variant = None
+    compile_screenspace_shader(base.complexpbr_render_graph)
+
+def shader_feature_defines(features=None):
+    # 'ibl_only': True is shorthand for no direct lights, which also drops shadows and clustered lights
+    features = dict(features or {})
+    if features.pop('ibl_only', False):
+        features['direct_lights'] = False
+
+    unknown = set(features) - set(SHADER_FEATURES)
+    if unknown:
+        raise ValueError('unknown shader features ' + str(sorted(unknown)) + ', expected some of ' + str(sorted(SHADER_FEATURES)))
+
+    features = {**SHADER_FEATURES, **features}
+    direct_lights = bool(features['direct_lights'])
+
+    return {'DISPLACEMENT': int(bool(features['displacement'])),
+            'EMISSION': int(bool(features['emission'])),
+            'DIRECT_LIGHTS': int(direct_lights),
+            'SHADOWS': int(direct_lights and bool(features['shadows'])),
+            'SHADOW_ATLAS': int(direct_lights and bool(features['shadows']) and bool(features['shadow_atlas'])),
+            'CLUSTERED_LIGHTS': int(direct_lights and bool(features['clustered_lights'])),
+            'MOTION_VECTORS': int(bool(features['motion_vectors'])),
+            'REFLECTION_PROBES': int(bool(features['reflection_probes'])),
+            'SKINNING': int(bool(features['skinning'])),
+            'MAX_LIGHTS': max(1, int(features['max_lights']))}
+
+def get_shader_variant(features=None, skinned=False, displaced=False, mods=None, write_files=False, light_slots=None):
+    # one compiled permutation per unique feature set and vertex variant, shared through the shader cache
+    features = dict(features or {})
+    features['skinning'] = features.get('skinning', True) and skinned
+    features['displacement'] = features.get('displacement', True) and displaced
+    if features.get('max_lights') == 'auto':
+        features['max_lights'] = light_slots or SHADER_FEATURES['max_lights']
+    mods, defines = mods or ([], None)
+
+    return compose_shader('ibl_v.vert', 'ibl_f.frag', base.complexpbr_shader_dir, mods,
+                          {**shader_feature_defines(features), **(defines or {})}, write_files)
+
+def set_shader_features(node, features=None):
+    # features=None returns the node to the full shader
+    if features is None:
+        node.clear_python_tag('complexpbr_features')
+    else:
+        node.set_python_tag('complexpbr_features', dict(features))
+    node.set_shader(get_shader_variant(node.get_net_python_tag('complexpbr_features'), mods=node.get_net_python_tag('complexpbr_mods')))
+    request_vertex_variants(node)
+
+def set_shader_cache_size(max_variants):
+    shader_cache.set_max_variants(max_variants)
+
+def clear_shader_cache():
+    shader_cache.clear()
+
+def set_program_cache(enabled=True,cache_dir=None):
+    # linked ibl and screenspace programs are kept on disk per driver, so later runs link them from the binary instead
+    # of compiling them; call it before apply_shader() to cover the first variant too
+    if shader_cache.program_cache is not None:
+        shader_cache.program_cache.destroy()
+        shader_cache.program_cache = None
+    if enabled:
+        shader_cache.program_cache = ProgramCache(cache_dir)
+
+def clear_program_cache():
+    if shader_cache.program_cache is not None:
+        shader_cache.program_cache.clear()
+
+def warm_up_shaders(shaders=None,per_frame=2,callback=None,done_callback=None):
+    # compiles and links shaders during a loading screen, per_frame of them each frame; entries are Shader objects,
+    # feature sets as passed to apply_shader(features=...), which cover their skinned and displaced variants, or
+    # 'screenspace' for min_f.frag with every combination of effects. shaders=None takes every shader built so far.
+    # callback(done, total) reports progress, done_callback() runs once all are linked
+    if shaders is None:
+        resolved = list(shader_cache.variants.values())
+        if getattr(base, 'complexpbr_screenspace_init', False):
+            resolved += [quad.get_shader() for graph_pass in base.complexpbr_render_graph.passes for quad in graph_pass.quads
+                         if quad.get_shader() is not None]
+    else:
+        resolved = []
+        for entry in shaders:
+            if isinstance(entry, Shader):
+                resolved.append(entry)
+            elif entry == 'screenspace':
+                if not getattr(base, 'complexpbr_screenspace_init', False):
+                    print('complexpbr message: screenspace shaders are not warmed up, did you call screenspace_init() yet?')
+                    continue
+                for flags in itertools.product((0, 1), repeat=len(SCREENSPACE_EFFECT_DEFINES)):
+                    resolved.append(get_screenspace_variant(dict(zip(SCREENSPACE_EFFECT_DEFINES, flags))))
+            else:
+                for skinned, displaced in ((False, False), (True, False), (False, True)):
+                    resolved.append(get_shader_variant(entry, skinned, displaced))
+
+    base.complexpbr_shader_warmup = ShaderWarmup(resolved, per_frame, callback, done_callback)
 
-    append_shader = Shader.load(Shader.SL_GLSL, vert, frag)
-    node.set_shader(append_shader)
+    return base.complexpbr_shader_warmup
 
 def create_locate_base_dir():
     if base.complexpbr_custom_dir == '':
@@ -472,7 +905,7 @@ def create_locate_base_dir():
 
 def remove_shader_files():
     local_shader_dir = create_locate_base_dir()
-    shader_file_strings = ['ibl_f', 'ibl_v', 'min_f', 'min_v']
+    shader_file_strings = ['ibl_f', 'ibl_v', 'min_f', 'min_v'] + dist_shader_files
 
     for item in local_shader_dir:
         for fs in shader_file_strings:
@@ -505,7 +938,6 @@ def complexpbr_default_lighting():
 
     slight_1 = Spotlight('slight_1')
     slight_1.set_color(Vec4(Vec3(5),1))
-    slight_1.set_shadow_caster(True, 8192, 8192)
     # slight_1.set_attenuation((0.5,0,0.000005))
     lens = PerspectiveLens()
     slight_1.set_lens(lens)
@@ -514,6 +946,7 @@ def complexpbr_default_lighting():
     slight_1_node.set_pos(50, 50, 90)
     slight_1_node.look_at(0,0,0.5)
     base.render.set_light(slight_1_node)
+    add_shadow_light(slight_1_node)
 
     env_light_1 = PointLight('env_light_1')
     env_light_1.set_color(Vec4(Vec3(1),1))
@@ -0,0 +1,334 @@
+# Headless benchmarks for complexpbr. Each group runs in its own process with an offscreen buffer (Mesa/llvmpipe
+# is fine on machines without a GPU) and the results are written as JSON, so releases can be compared.
+#
+# python -m complexpbr.benchmark --output bench.json
+# python -m complexpbr.benchmark --quick --output bench.json --compare bench_previous.json
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from statistics import mean, median
+
+
+# the default length of the ibl_f.frag light loop
+MAX_LIGHTS = 20
+NODE_COUNTS = (1, 10, 100, 1000, 10000)
+QUICK_NODE_COUNTS = (1, 10, 100, 1000)
+ENV_RESOLUTIONS = (64, 256)
+QUICK_ENV_RESOLUTIONS = (64,)
+LIGHT_COUNTS = (0, 4, MAX_LIGHTS)
+ACTOR_COUNTS = (0, 8, 32)
+# shader inputs on screen_quad turning each effect on, the rest of the settings are screenspace_init()'s defaults
+SCREENSPACE_EFFECTS = {'ssr': ('ssr_samples', 32, 0), 'ssao': ('ssao_samples', 8, 0), 'bloom': ('bloom_intensity', 0.5, 0.0)}
+BENCHMARK_GROUPS = ('cpu', 'apply', 'scene', 'frame')
+
+def elapsed_ms(function, *args, **kwargs):
+    start = time.perf_counter()
+    function(*args, **kwargs)
+
+    return (time.perf_counter() - start) * 1000.0
+
+def summarize(times):
+    times = sorted(times)
+
+    return {'median_ms': median(times), 'mean_ms': mean(times), 'p95_ms': times[min(len(times) - 1, int(len(times) * 0.95))],
+            'samples': len(times)}
+
+def grid_egg_text(segments=4, skinned=False):
+    # a subdivided unit square standing up in the xz plane; skinned grids have two joints blended from bottom to top
+    vertices = []
+    for j, i in itertools.product(range(segments + 1), range(segments + 1)):
+        u, v = i / segments, j / segments
+        vertices.append('<Vertex> ' + str(len(vertices)) + ' { ' + str(u - 0.5) + ' 0 ' + str(v - 0.5)
+                        + ' <UV> { ' + str(u) + ' ' + str(v) + ' } <Normal> { 0 -1 0 } }')
+
+    polygons = []
+    for j, i in itertools.product(range(segments), range(segments)):
+        a = j * (segments + 1) + i
+        polygons.append('<Polygon> { <VertexRef> { ' + ' '.join(str(x) for x in (a, a + 1, a + segments + 2, a + segments + 1))
+                        + ' <Ref> { grid } } }')
+
+    joints = ''
+    if skinned:
+        memberships = [[], []]
+        for index in range(len(vertices)):
+            v = (index // (segments + 1)) / segments
+            memberships[0].append((index, 1.0 - v))
+            memberships[1].append((index, v))
+        refs = ['\n'.join('<VertexRef> { ' + str(index) + ' <Scalar> membership { ' + str(weight) + ' } <Ref> { grid } }'
+                          for index, weight in membership if weight > 0.0) for membership in memberships]
+        joints = ('<Joint> root { ' + refs[0] + '\n<Joint> tip { <Transform> { <Translate> { 0 0 0.5 } } '
+                  + refs[1] + ' } }')
+
+    return ('<CoordinateSystem> { Z-up }\n<Group> grid_model { ' + ('<Dart> { 1 }\n' if skinned else '')
+            + '<VertexPool> grid {\n' + '\n'.join(vertices) + '\n}\n' + '\n'.join(polygons) + '\n' + joints + ' }\n')
+
+def load_grid_model(segments=4, skinned=False):
+    from panda3d.core import NodePath, StringStream, GlobPattern
+    from panda3d.egg import EggData, load_egg_data
+
+    egg = EggData()
+    egg.read(StringStream(grid_egg_text(segments, skinned).encode('utf-8')))
+    egg.recompute_tangent_binormal(GlobPattern('*'))
+
+    return NodePath(load_egg_data(egg))
+
+def make_scene(root, nodes=100, lights=0, actors=0, spacing=1.5):
+    # nodes static grids and actors skinned ones on a square layout, lights point lights above it
+    from panda3d.core import PointLight
+
+    static_model = load_grid_model()
+    skinned_model = load_grid_model(skinned=True)
+    side = max(1, int((nodes + actors) ** 0.5 + 0.999))
+    for index in range(nodes + actors):
+        model = (static_model if index < nodes else skinned_model).copy_to(root)
+        model.set_pos((index % side - side / 2) * spacing, 0, (index // side - side / 2) * spacing)
+
+    for index in range(lights):
+        light = root.attach_new_node(PointLight('benchmark_light_' + str(index)))
+        light.node().set_color((2, 2, 2, 1))
+        light.set_pos((index % 5 - 2) * side * spacing / 4, -4, (index // 5 - 2) * side * spacing / 4)
+        root.set_light(light)
+
+    return root
+
+def open_offscreen(size):
+    # falls back to the EGL headless display where pandagl cannot open one, IE without an X server
+    from panda3d.core import load_prc_file_data
+    load_prc_file_data('', 'window-type offscreen\naux-display p3headlessgl\naudio-library-name null\nsync-video false\n'
+                       'win-size ' + str(size[0]) + ' ' + str(size[1]))
+    from direct.showbase.ShowBase import ShowBase
+
+    showbase = ShowBase()
+    showbase.disable_mouse()
+    showbase.cam.set_pos(0, -30, 0)
+
+    return showbase
+
+def run_frames(showbase, frames, warmup):
+    for _ in range(warmup):
+        showbase.task_mgr.step()
+
+    return summarize([elapsed_ms(showbase.task_mgr.step) for _ in range(frames)])
+
+def renderer_info(showbase):
+    gsg = showbase.win.get_gsg()
+
+    return {'vendor': gsg.get_driver_vendor(), 'renderer': gsg.get_driver_renderer(), 'version': gsg.get_driver_version()}
+
+def bench_cpu(args):
+    # no window: the BRDF LUT bake and the shader template parsing and composition
+    from importlib.resources import files
+    from .brdf_lut import bake_brdf_lut
+    from .shader_cache import ShaderCache, make_shader_key
+    from .shader_template import ShaderTemplate, split_stage_mods, format_defines
+    import complexpbr
+
+    results = {'lut_bake': {}}
+    for size, samples in ((32, 64), (64, 128)) if args.quick else ((32, 64), (64, 128), (128, 512)):
+        results['lut_bake'][str(size) + 'x' + str(samples)] = summarize([elapsed_ms(bake_brdf_lut, size, samples)
+                                                                          for _ in range(args.repeat)])
+
+    shader_dir = files('complexpbr')
+    vert_src = (shader_dir / 'ibl_v.vert').read_text()
+    frag_src = (shader_dir / 'ibl_f.frag').read_text()
+    results['template_parse'] = summarize([elapsed_ms(ShaderTemplate, frag_src) + elapsed_ms(ShaderTemplate, vert_src)
+                                           for _ in range(args.repeat * 5)])
+
+    vert_template, frag_template = ShaderTemplate(vert_src), ShaderTemplate(frag_src)
+    mods = split_stage_mods([{'frag_functions': 'vec3 benchmark_tint(vec3 c) { return c * 0.5; }',
+                              'frag_main_end': 'o_color.rgb = benchmark_tint(o_color.rgb);'}])
+    feature_sets = [dict(zip(('emission', 'shadows', 'direct_lights', 'clustered_lights'), flags))
+                    for flags in itertools.product((True, False), repeat=4)]
+
+    def compose_permutations():
+        # every feature permutation composed and made into a Shader through a fresh cache, IE a cold start
+        shader_cache = ShaderCache()
+        for features in feature_sets:
+            define_mod = {'defines': format_defines(complexpbr.shader_feature_defines(features))}
+            key = make_shader_key(sorted(features.items()))
+            shader_cache.get(key, lambda: (vert_template.compose([define_mod] + mods['vert']),
+                                           frag_template.compose([define_mod] + mods['frag'])))
+
+    results['compose_permutations'] = summarize([elapsed_ms(compose_permutations) for _ in range(args.repeat)])
+    results['compose_permutations']['permutations'] = len(feature_sets)
+
+    return results
+
+def bench_apply(args):
+    # apply_shader() called once per node on fresh nodes each round, then append_shader() on nodes apply_shader() has
+    # already set up, as it only swaps their shader
+    import complexpbr
+
+    showbase = open_offscreen(args.size)
+    results = {'renderer': renderer_info(showbase)}
+    results['apply_shader_init_ms'] = elapsed_ms(complexpbr.apply_shader, make_scene(showbase.render.attach_new_node('init'), 1),
+                                                 env_res=args.env_res[0])
+    showbase.task_mgr.step()
+
+    mod = 'vec3 benchmark_tint(vec3 c) { return c * 0.5; }'
+    for name, apply in (('apply_shader', complexpbr.apply_shader),
+                        ('append_shader', lambda node: complexpbr.append_shader(node, frag_body_mod=mod))):
+        results[name] = {}
+        for count in QUICK_NODE_COUNTS if args.quick else NODE_COUNTS:
+            root = make_scene(showbase.render.attach_new_node('benchmark_scene'), count)
+            nodes = root.get_children()
+            if name == 'append_shader':
+                for node in nodes:
+                    complexpbr.apply_shader(node)
+                showbase.task_mgr.step()
+            apply_ms = elapsed_ms(lambda: [apply(node) for node in nodes])
+            # the vertex variants are picked, and anything new compiled, ahead of the first frame
+            first_frame_ms = elapsed_ms(showbase.task_mgr.step)
+            results[name][str(count)] = {'apply_ms': apply_ms, 'per_node_us': apply_ms * 1000.0 / count,
+                                         'first_frame_ms': first_frame_ms}
+            root.remove_node()
+            showbase.task_mgr.step()
+
+    return results
+
+def bench_scene(args):
+    # frame time against the light count and the skinned actor count, without the screenspace stage
+    import complexpbr
+
+    showbase = open_offscreen(args.size)
+    results = {'renderer': renderer_info(showbase), 'nodes': args.nodes, 'lights': {}, 'actors': {}}
+    complexpbr.apply_shader(showbase.render, env_res=args.env_res[0])
+
+    for group, counts in (('lights', LIGHT_COUNTS), ('actors', ACTOR_COUNTS)):
+        for count in counts[:2] if args.quick else counts:
+            root = showbase.render.attach_new_node('benchmark_scene')
+            make_scene(root, args.nodes, count if group == 'lights' else 0, count if group == 'actors' else 0)
+            complexpbr.select_vertex_variants(root)
+            results[group][str(count)] = run_frames(showbase, args.frames, args.warmup)
+            root.remove_node()
+
+    return results
+
+def bench_frame(args):
+    # screenspace_init() startup and the frame time of every combination of SSR, SSAO and bloom at one env_res
+    import complexpbr
+
+    showbase = open_offscreen(args.size)
+    results = {'renderer': renderer_info(showbase), 'env_res': args.env_res[0], 'nodes': args.nodes, 'lights': args.lights}
+    make_scene(showbase.render.attach_new_node('benchmark_scene'), args.nodes, args.lights)
+    results['apply_shader_ms'] = elapsed_ms(complexpbr.apply_shader, showbase.render, env_res=args.env_res[0])
+    results['no_screenspace'] = run_frames(showbase, args.frames, args.warmup)
+    results['screenspace_init_ms'] = elapsed_ms(complexpbr.screenspace_init)
+    results['first_frame_ms'] = elapsed_ms(showbase.task_mgr.step)
+
+    results['effects'] = {}
+    for flags in itertools.product((False, True), repeat=len(SCREENSPACE_EFFECTS)):
+        enabled = [name for name, on in zip(SCREENSPACE_EFFECTS, flags) if on]
+        for name, (input_name, on_value, off_value) in SCREENSPACE_EFFECTS.items():
+            showbase.screen_quad.set_shader_input(input_name, on_value if name in enabled else off_value)
+        complexpbr.set_profiling(window=args.frames)
+        timing = run_frames(showbase, args.frames, args.warmup)
+        timing['draw_ms'] = complexpbr.get_frame_stats()['draw_ms']
+        results['effects']['+'.join(enabled) or 'none'] = timing
+
+    return results
+
+def run_group(group, args, **overrides):
+    # every group gets a process of its own, so the globals complexpbr keeps on base start out fresh
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        output = Path(tmp_dir) / 'result.json'
+        command = [sys.executable, '-m', 'complexpbr.benchmark', '--worker', group, '--worker-output', str(output),
+                   '--frames', str(args.frames), '--warmup', str(args.warmup), '--repeat', str(args.repeat),
+                   '--nodes', str(args.nodes), '--lights', str(args.lights), '--size', str(args.size[0]), str(args.size[1]),
+                   '--env-res'] + [str(value) for value in overrides.get('env_res', args.env_res)] + (['--quick'] if args.quick else [])
+        process = subprocess.run(command, capture_output=True, text=True, timeout=args.timeout)
+        if process.returncode != 0 or not output.is_file():
+            print('complexpbr message: benchmark group ' + group + ' failed')
+            return {'error': process.stderr.strip().splitlines()[-20:]}
+
+        return json.loads(output.read_text())
+
+def flatten(results, prefix=''):
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + '.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[prefix + key] = value
+
+    return flat
+
+def compare(results, previous):
+    # timings only, a ratio above 1 is slower than before
+    current, before = flatten(results['results']), flatten(previous['results'])
+    for key in sorted(current):
+        if key in before and key.endswith('_ms') and before[key] > 0.0:
+            ratio = current[key] / before[key]
+            print(key + ': ' + format(before[key], '.3f') + ' -> ' + format(current[key], '.3f') + ' ms (x' + format(ratio, '.2f') + ')')
+
+def package_version():
+    try:
+        from importlib.metadata import version
+        return version('panda3d-complexpbr')
+    except Exception:
+        return 'unknown'
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the complexpbr benchmarks and write the results as JSON.')
+    parser.add_argument('--output', default=None, help='write the results to this .json file')
+    parser.add_argument('--compare', default=None, help='print the timings against those of an earlier results file')
+    parser.add_argument('--groups', nargs='+', choices=BENCHMARK_GROUPS, default=list(BENCHMARK_GROUPS))
+    parser.add_argument('--quick', action='store_true', help='fewer node counts, env_res values and frames')
+    parser.add_argument('--frames', type=int, default=None)
+    parser.add_argument('--warmup', type=int, default=None)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--nodes', type=int, default=100, help='scene size of the scene and frame groups')
+    parser.add_argument('--lights', type=int, default=4, help='point lights in the frame group, up to ' + str(MAX_LIGHTS))
+    parser.add_argument('--env-res', type=int, nargs='+', default=None)
+    parser.add_argument('--size', type=int, nargs=2, default=(640, 360))
+    parser.add_argument('--timeout', type=float, default=1800.0, help='seconds per benchmark group')
+    parser.add_argument('--worker', choices=BENCHMARK_GROUPS, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--worker-output', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    args.frames = args.frames or (20 if args.quick else 120)
+    args.warmup = args.warmup if args.warmup is not None else (5 if args.quick else 20)
+    args.env_res = args.env_res or list(QUICK_ENV_RESOLUTIONS if args.quick else ENV_RESOLUTIONS)
+    args.lights = max(0, min(MAX_LIGHTS, args.lights))
+
+    if args.worker is not None:
+        workers = {'cpu': bench_cpu, 'apply': bench_apply, 'scene': bench_scene, 'frame': bench_frame}
+        Path(args.worker_output).write_text(json.dumps(workers[args.worker](args)))
+        os._exit(0)
+
+    results = {}
+    for group in args.groups:
+        print('Running ' + group + ' benchmarks...')
+        if group == 'frame':
+            results[group] = {str(env_res): run_group(group, args, env_res=[env_res]) for env_res in args.env_res}
+        else:
+            results[group] = run_group(group, args)
+
+    report = {'complexpbr': package_version(), 'python': platform.python_version(), 'platform': platform.platform(),
+              'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'quick': args.quick, 'results': results}
+    try:
+        from panda3d.core import PandaSystem
+        report['panda3d'] = PandaSystem.get_version_string()
+    except ImportError:
+        pass
+
+    text = json.dumps(report, indent=2)
+    if args.output is not None:
+        Path(args.output).write_text(text)
+        print('Saved benchmark results as ' + args.output)
+    else:
+        print(text)
+
+    if args.compare is not None:
+        compare(report, json.loads(Path(args.compare).read_text()))
+
+if __name__ == '__main__':
+    main()
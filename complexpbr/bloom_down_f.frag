@@ -0,0 +1,52 @@
+#version 430
+
+// one level of the bloom pyramid, 13-tap box downsample of the level above
+// the first level also applies the bloom threshold to scene_tex
+
+uniform sampler2D source_tex;
+uniform int prefilter;
+uniform float bloom_threshold;
+
+in vec2 texcoord;
+
+out vec4 o_color;
+
+vec3 thresholded(vec3 color)
+{
+    // brightness weighted like the original full-res bloom, pixels under the threshold do not bloom
+    float brightness = dot(color, vec3(0.2126, 0.7152, 0.0722));
+    return brightness > bloom_threshold ? color * brightness : vec3(0.0);
+}
+
+vec3 tap(vec2 uv)
+{
+    vec3 color = texture(source_tex, uv).rgb;
+    return prefilter == 1 ? thresholded(color) : color;
+}
+
+void main()
+{
+    vec2 texel = 1.0 / vec2(textureSize(source_tex, 0));
+
+    vec3 a = tap(texcoord + texel * vec2(-2.0, 2.0));
+    vec3 b = tap(texcoord + texel * vec2(0.0, 2.0));
+    vec3 c = tap(texcoord + texel * vec2(2.0, 2.0));
+    vec3 d = tap(texcoord + texel * vec2(-2.0, 0.0));
+    vec3 e = tap(texcoord);
+    vec3 f = tap(texcoord + texel * vec2(2.0, 0.0));
+    vec3 g = tap(texcoord + texel * vec2(-2.0, -2.0));
+    vec3 h = tap(texcoord + texel * vec2(0.0, -2.0));
+    vec3 i = tap(texcoord + texel * vec2(2.0, -2.0));
+    vec3 j = tap(texcoord + texel * vec2(-1.0, 1.0));
+    vec3 k = tap(texcoord + texel * vec2(1.0, 1.0));
+    vec3 l = tap(texcoord + texel * vec2(-1.0, -1.0));
+    vec3 m = tap(texcoord + texel * vec2(1.0, -1.0));
+
+    // overlapping 2x2 boxes, the center box weighted highest, which keeps the pyramid from flickering
+    vec3 color = e * 0.125;
+    color += (a + c + g + i) * 0.03125;
+    color += (b + d + f + h) * 0.0625;
+    color += (j + k + l + m) * 0.125;
+
+    o_color = vec4(color, 1.0);
+}
@@ -0,0 +1,29 @@
+#version 430
+
+// one level of the bloom pyramid, 3x3 tent upsample of the level below added onto this level
+
+uniform sampler2D lower_tex;
+uniform sampler2D current_tex;
+uniform float filter_radius;
+uniform float output_scale;
+
+in vec2 texcoord;
+
+out vec4 o_color;
+
+void main()
+{
+    vec2 texel = filter_radius / vec2(textureSize(lower_tex, 0));
+
+    vec3 upsampled = texture(lower_tex, texcoord).rgb * 4.0;
+    upsampled += (texture(lower_tex, texcoord + vec2(-texel.x, 0.0)).rgb
+                + texture(lower_tex, texcoord + vec2(texel.x, 0.0)).rgb
+                + texture(lower_tex, texcoord + vec2(0.0, -texel.y)).rgb
+                + texture(lower_tex, texcoord + vec2(0.0, texel.y)).rgb) * 2.0;
+    upsampled += texture(lower_tex, texcoord + vec2(-texel.x, -texel.y)).rgb
+               + texture(lower_tex, texcoord + vec2(texel.x, -texel.y)).rgb
+               + texture(lower_tex, texcoord + vec2(-texel.x, texel.y)).rgb
+               + texture(lower_tex, texcoord + vec2(texel.x, texel.y)).rgb;
+
+    o_color = vec4((texture(current_tex, texcoord).rgb + upsampled / 16.0) * output_scale, 1.0);
+}
@@ -0,0 +1,139 @@
+import os
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from panda3d.core import Texture, SamplerState
+
+
+BRDF_MODELS = ('ggx', 'ggx_correlated')
+
+# textures already handed out this session, keyed like the disk cache
+_lut_textures = {}
+
+def default_cache_dir():
+    cache_root = os.environ.get('XDG_CACHE_HOME', '')
+    if cache_root == '':
+        cache_root = Path.home() / '.cache'
+
+    return Path(cache_root) / 'complexpbr'
+
+def hammersley(samples):
+    # van der Corput radical inverse in base 2, vectorized over all sample indices
+    bits = np.arange(samples, dtype=np.uint32)
+    bits = (bits << np.uint32(16)) | (bits >> np.uint32(16))
+    bits = ((bits & np.uint32(0x55555555)) << np.uint32(1)) | ((bits & np.uint32(0xAAAAAAAA)) >> np.uint32(1))
+    bits = ((bits & np.uint32(0x33333333)) << np.uint32(2)) | ((bits & np.uint32(0xCCCCCCCC)) >> np.uint32(2))
+    bits = ((bits & np.uint32(0x0F0F0F0F)) << np.uint32(4)) | ((bits & np.uint32(0xF0F0F0F0)) >> np.uint32(4))
+    bits = ((bits & np.uint32(0x00FF00FF)) << np.uint32(8)) | ((bits & np.uint32(0xFF00FF00)) >> np.uint32(8))
+    xi_x = np.arange(samples, dtype=np.float64) / samples
+    xi_y = bits.astype(np.float64) * 2.3283064365386963e-10
+
+    return xi_x, xi_y
+
+def _bake_rows(args):
+    row_start, row_end, size, samples, model = args
+    # rows are roughness, columns are NdotV -- matches texture(brdfLUT, vec2(NdotV, roughness))
+    roughness = ((np.arange(row_start, row_end) + 0.5) / size)[:, None, None]
+    n_dot_v = ((np.arange(size) + 0.5) / size)[None, :, None]
+    v_x = np.sqrt(1.0 - n_dot_v * n_dot_v)
+    v_z = n_dot_v
+
+    xi_x, xi_y = hammersley(samples)
+    a = roughness * roughness
+    a2 = a * a
+    phi = 2.0 * np.pi * xi_x[None, None, :]
+    cos_theta = np.sqrt((1.0 - xi_y[None, None, :]) / (1.0 + (a2 - 1.0) * xi_y[None, None, :]))
+    sin_theta = np.sqrt(1.0 - cos_theta * cos_theta)
+    h_x = np.cos(phi) * sin_theta
+    h_z = cos_theta
+
+    # N is +Z and V lies in the XZ plane, so H.y never contributes to V.H
+    v_dot_h = v_x * h_x + v_z * h_z
+    n_dot_l = np.clip(2.0 * v_dot_h * h_z - v_z, 0.0, 1.0)
+    n_dot_h = np.maximum(h_z, 1e-8)
+    v_dot_h = np.maximum(v_dot_h, 0.0)
+
+    if model == 'ggx_correlated':
+        vis_v = n_dot_l * np.sqrt(n_dot_v * n_dot_v * (1.0 - a2) + a2)
+        vis_l = n_dot_v * np.sqrt(n_dot_l * n_dot_l * (1.0 - a2) + a2)
+        vis = 0.5 / np.maximum(vis_v + vis_l, 1e-8)
+        g_vis = 4.0 * vis * n_dot_l * v_dot_h / n_dot_h
+    else:
+        # Schlick-GGX with the IBL remapping k = a / 2
+        k = a / 2.0
+        g_v = n_dot_v / (n_dot_v * (1.0 - k) + k)
+        g_l = n_dot_l / (n_dot_l * (1.0 - k) + k)
+        g_vis = g_v * g_l * v_dot_h / (n_dot_h * n_dot_v)
+
+    g_vis = np.where(n_dot_l > 0.0, g_vis, 0.0)
+    fc = (1.0 - v_dot_h) ** 5
+    lut_a = ((1.0 - fc) * g_vis).sum(axis=2) / samples
+    lut_b = (fc * g_vis).sum(axis=2) / samples
+
+    return np.stack((lut_a, lut_b), axis=-1).astype(np.float32)
+
+def bake_brdf_lut(size=128, samples=512, model='ggx', processes=0, chunk_elements=1 << 21):
+    if model not in BRDF_MODELS:
+        raise ValueError('unknown BRDF model ' + repr(model) + ', expected one of ' + str(BRDF_MODELS))
+
+    # bound the temporaries of each chunk to roughly chunk_elements float64 values
+    chunk_rows = max(1, min(size, chunk_elements // (size * samples)))
+    jobs = [(row, min(row + chunk_rows, size), size, samples, model) for row in range(0, size, chunk_rows)]
+
+    if processes > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            rows = list(pool.map(_bake_rows, jobs))
+    else:
+        rows = [_bake_rows(job) for job in jobs]
+
+    return np.concatenate(rows, axis=0)
+
+def brdf_lut_cache_path(size, samples, model, cache_dir=None):
+    if cache_dir is None:
+        cache_dir = default_cache_dir()
+
+    return Path(cache_dir) / ('brdf_lut_' + model + '_' + str(size) + 'x' + str(size) + '_' + str(samples) + '.npy')
+
+def load_brdf_lut(size=128, samples=512, model='ggx', cache_dir=None, processes=0):
+    cache_path = brdf_lut_cache_path(size, samples, model, cache_dir)
+
+    if cache_path.is_file():
+        try:
+            lut = np.load(cache_path)
+            if lut.shape == (size, size, 2):
+                return lut
+        except (OSError, ValueError):
+            pass
+
+    lut = bake_brdf_lut(size, samples, model, processes=processes).astype(np.float16)
+
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = cache_path.with_suffix('.tmp.npy')
+        np.save(tmp_path, lut)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        print('complexpbr message: could not write the BRDF LUT cache to ' + str(cache_path))
+
+    return lut
+
+def make_brdf_lut_texture(lut, name='complexpbr_lut'):
+    size_y, size_x = lut.shape[0], lut.shape[1]
+    lut_tex = Texture(name)
+    lut_tex.setup_2d_texture(size_x, size_y, Texture.T_half_float, Texture.F_rg16)
+    lut_tex.set_ram_image_as(np.ascontiguousarray(lut, dtype=np.float16).tobytes(), 'RG')
+    lut_tex.set_wrap_u(SamplerState.WM_clamp)
+    lut_tex.set_wrap_v(SamplerState.WM_clamp)
+    lut_tex.set_minfilter(SamplerState.FT_linear)
+    lut_tex.set_magfilter(SamplerState.FT_linear)
+
+    return lut_tex
+
+def get_brdf_lut_texture(size=128, samples=512, model='ggx', cache_dir=None, processes=0):
+    key = (size, samples, model, str(cache_dir))
+
+    if key not in _lut_textures:
+        lut = load_brdf_lut(size, samples, model, cache_dir=cache_dir, processes=processes)
+        _lut_textures[key] = make_brdf_lut_texture(lut)
+
+    return _lut_textures[key]
@@ -0,0 +1,35 @@
+#version 430
+// @slot defines
+
+// cheap shading of the cubemap capture, set_capture_culling(shading='unlit'), with ibl_v.vert as the vertex stage
+// albedo under the ambient light plus emission, reflections rarely show more than that
+
+uniform sampler2D p3d_Texture0;
+uniform sampler2D p3d_Texture3;
+uniform vec4 p3d_ColorScale;
+
+uniform struct p3d_MaterialParameters {
+    vec4 baseColor;
+    vec4 emission;
+    float roughness;
+    float metallic;
+} p3d_Material;
+
+uniform struct p3d_LightModelParameters {
+    vec4 ambient;
+} p3d_LightModel;
+
+in vec3 v_position;
+in vec4 v_color;
+in mat3 v_tbn;
+in vec2 v_texcoord;
+
+out vec4 o_color;
+
+void main()
+{
+    vec4 albedo = p3d_Material.baseColor * v_color * p3d_ColorScale * texture(p3d_Texture0, v_texcoord);
+    vec3 emission = p3d_Material.emission.rgb * texture(p3d_Texture3, v_texcoord).rgb;
+
+    o_color = vec4(albedo.rgb * p3d_LightModel.ambient.rgb + emission, albedo.a);
+}
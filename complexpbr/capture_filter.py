@@ -0,0 +1,147 @@
+from panda3d.core import BitMask32, NodePath, ShaderAttrib, RenderState, ClockObject
+
+
+# the camera rig's cube cameras and the reflection probes' draw through separate bits, so the size culling of the
+# rig leaves the probes' captures alone; nodes hidden from CAPTURE_MASK stay out of both, see exclude_from_capture()
+RIG_CAPTURE_MASK = BitMask32.bit(27)
+PROBE_CAPTURE_MASK = BitMask32.bit(26)
+CAPTURE_MASK = RIG_CAPTURE_MASK | PROBE_CAPTURE_MASK
+CAPTURE_SHADINGS = ('full', 'unlit')
+
+class CaptureFilter:
+    def __init__(self, cube_buffer, rig, shader_factory, far=None, min_pixels=0.0, shading='full', cull_hz=2.0,
+                 scene_root=None, task_name='complexpbr_capture_filter'):
+        # what the cube cameras draw: opted out nodes, anything past far, and nodes below min_pixels in a face
+        self.cube_buffer = cube_buffer
+        self.rig = rig
+        self.shader_factory = shader_factory
+        self.scene_root = base.render if scene_root is None else scene_root
+        self.clock = ClockObject.get_global_clock()
+        self.task_name = task_name
+        self.excluded = []
+        self.culled = set()
+        self.culled_count = 0
+        self.last_cull_time = None
+        self.states = {}
+
+        regions = [cube_buffer.get_display_region(i) for i in range(cube_buffer.get_num_display_regions())]
+        self.cameras = [dr.get_camera() for dr in regions if not dr.get_camera().is_empty()]
+        self.default_far = self.cameras[0].node().get_lens().get_far()
+        for camera_np in self.cameras:
+            camera_np.node().set_camera_mask(RIG_CAPTURE_MASK)
+
+        self.far = None
+        self.min_pixels = 0.0
+        self.shading = 'full'
+        self.cull_hz = 2.0
+        self.configure(far, min_pixels, shading, cull_hz)
+
+        base.task_mgr.add(self.update, task_name, sort=9)
+
+    def configure(self, far=None, min_pixels=None, shading=None, cull_hz=None):
+        if far is not None:
+            # 0 goes back to the lens' own far plane
+            self.far = float(far) if far > 0 else None
+            for camera_np in self.cameras:
+                camera_np.node().get_lens().set_far(self.far or self.default_far)
+        if min_pixels is not None:
+            self.min_pixels = max(0.0, float(min_pixels))
+            self.last_cull_time = None
+            if self.min_pixels == 0.0:
+                self.restore_culled()
+        if shading is not None:
+            if shading not in CAPTURE_SHADINGS:
+                raise ValueError('unknown capture shading ' + repr(shading) + ', expected one of ' + str(CAPTURE_SHADINGS))
+            self.shading = shading
+            self.apply_shading()
+        if cull_hz is not None:
+            self.cull_hz = max(0.001, float(cull_hz))
+
+    def apply_shading(self):
+        # 'unlit' overrides the shader of everything the cube cameras draw, skinned geometry is told apart by its
+        # complexpbr_skinned tag, see select_vertex_variants()
+        if self.shading == 'full':
+            initial_state = RenderState.make_empty()
+            skinned_state = None
+        else:
+            if self.shading not in self.states:
+                states = []
+                for skinned in (False, True):
+                    state_np = NodePath('complexpbr_capture_state')
+                    attrib = ShaderAttrib.make(self.shader_factory(self.shading, skinned), 1000)
+                    state_np.set_attrib(attrib.set_flag(ShaderAttrib.F_hardware_skinning, skinned), 1000)
+                    states.append(state_np.get_state())
+                self.states[self.shading] = states
+            initial_state, skinned_state = self.states[self.shading]
+
+        for camera_np in self.cameras:
+            camera = camera_np.node()
+            camera.set_initial_state(initial_state)
+            camera.set_tag_state_key('complexpbr_skinned')
+            if skinned_state is None:
+                camera.clear_tag_states()
+            else:
+                camera.set_tag_state('1', skinned_state)
+
+    def exclude(self, node):
+        if node not in self.excluded:
+            self.excluded.append(node)
+        node.hide(CAPTURE_MASK)
+
+    def include(self, node):
+        if node in self.excluded:
+            self.excluded.remove(node)
+        node.show(CAPTURE_MASK)
+
+    def add_proxy(self, node, proxy):
+        # the cube cameras draw proxy, IE a low detail stand-in, in place of node; the main camera gives up the
+        # capture bit so a node shown through it alone stays out of the main view
+        self.exclude(node)
+        proxy.hide(BitMask32.all_on())
+        proxy.show_through(CAPTURE_MASK)
+        camera = base.cam.node()
+        camera.set_camera_mask(camera.get_camera_mask() & ~CAPTURE_MASK)
+
+    def restore_culled(self):
+        for geom_np in self.culled:
+            if not geom_np.is_empty() and geom_np not in self.excluded:
+                geom_np.show(RIG_CAPTURE_MASK)
+        self.culled = set()
+        self.culled_count = 0
+
+    def update(self, task):
+        if self.min_pixels == 0.0:
+            return task.cont
+
+        frame_time = self.clock.get_frame_time()
+        if self.last_cull_time is not None and frame_time - self.last_cull_time < 1.0 / self.cull_hz:
+            return task.cont
+        self.last_cull_time = frame_time
+
+        # a 90 degree face spans its width in pixels at distance 1, so a bounding sphere covers about
+        # radius / distance * face size pixels
+        face_size = self.cube_buffer.get_texture().get_x_size()
+        rig_pos = self.rig.get_pos(self.scene_root)
+        culled = set()
+        for geom_np in self.scene_root.find_all_matches('**/+GeomNode'):
+            bounds = geom_np.get_bounds()
+            if bounds.is_empty() or bounds.is_infinite() or not hasattr(bounds, 'get_radius'):
+                continue
+            bounds.xform(geom_np.get_mat(self.scene_root))
+            distance = (bounds.get_center() - rig_pos).length()
+            if distance > bounds.get_radius() and bounds.get_radius() / distance * face_size < self.min_pixels:
+                culled.add(geom_np)
+
+        for geom_np in culled - self.culled:
+            geom_np.hide(RIG_CAPTURE_MASK)
+        for geom_np in self.culled - culled:
+            if not geom_np.is_empty() and geom_np not in self.excluded:
+                geom_np.show(RIG_CAPTURE_MASK)
+        self.culled = culled
+        self.culled_count = len(culled)
+
+        return task.cont
+
+    def destroy(self):
+        base.task_mgr.remove(self.task_name)
+        self.restore_culled()
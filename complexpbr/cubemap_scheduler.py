@@ -0,0 +1,122 @@
+import math
+from collections import deque
+from panda3d.core import ClockObject
+
+
+CUBEMAP_UPDATE_MODES = ('always', 'round_robin', 'motion', 'interval', 'manual')
+
+class CubemapScheduler:
+    def __init__(self, cube_buffer, rig, mode='always', faces_per_frame=6, update_hz=10.0,
+                 move_threshold=0.5, angle_threshold=5.0, task_name='complexpbr_cubemap_scheduler'):
+        self.cube_buffer = cube_buffer
+        self.rig = rig
+        self.clock = ClockObject.get_global_clock()
+        self.task_name = task_name
+
+        # one display region per cube face, in texture page order
+        face_regions = [cube_buffer.get_display_region(i) for i in range(cube_buffer.get_num_display_regions())]
+        face_regions = [dr for dr in face_regions if not dr.get_camera().is_empty()]
+        self.face_regions = sorted(face_regions, key=lambda dr: dr.get_target_tex_page())
+
+        self.pending_faces = deque()
+        self.active_faces = []
+        self.capture_callbacks = []
+        self.capture_count = 0
+        self.completing = False
+        self.last_trigger_time = None
+        self.last_rig_pos = None
+        self.last_rig_quat = None
+
+        self.configure(mode, faces_per_frame, update_hz, move_threshold, angle_threshold)
+        self.capture_now()
+
+        base.task_mgr.add(self.update, task_name, sort=10)
+
+    def configure(self, mode=None, faces_per_frame=None, update_hz=None, move_threshold=None, angle_threshold=None):
+        if mode is not None:
+            if mode not in CUBEMAP_UPDATE_MODES:
+                raise ValueError('unknown cubemap update mode ' + repr(mode) + ', expected one of ' + str(CUBEMAP_UPDATE_MODES))
+            self.mode = mode
+        if faces_per_frame is not None:
+            self.faces_per_frame = max(1, min(6, int(faces_per_frame)))
+        if update_hz is not None:
+            self.update_hz = max(0.001, float(update_hz))
+        if move_threshold is not None:
+            self.move_threshold = float(move_threshold)
+        if angle_threshold is not None:
+            self.angle_threshold = float(angle_threshold)
+
+    def capture_now(self):
+        # queue a full refresh, faces already waiting keep their place
+        for face in range(len(self.face_regions)):
+            if face not in self.pending_faces:
+                self.pending_faces.append(face)
+
+    def cancel(self):
+        # drops the faces still waiting and the capture being completed, its callbacks will not run
+        self.pending_faces.clear()
+        self.completing = False
+
+    def add_capture_callback(self, callback):
+        self.capture_callbacks.append(callback)
+
+    def remove_capture_callback(self, callback):
+        if callback in self.capture_callbacks:
+            self.capture_callbacks.remove(callback)
+
+    def rig_moved(self):
+        rig_pos = self.rig.get_pos(base.render)
+        rig_quat = self.rig.get_quat(base.render)
+
+        if self.last_rig_pos is None:
+            return True
+
+        moved = (rig_pos - self.last_rig_pos).length() > self.move_threshold
+        cos_half = min(1.0, abs(rig_quat.dot(self.last_rig_quat)))
+        rotated = math.degrees(2.0 * math.acos(cos_half)) > self.angle_threshold
+
+        return moved or rotated
+
+    def mark_rig(self):
+        self.last_rig_pos = self.rig.get_pos(base.render)
+        self.last_rig_quat = self.rig.get_quat(base.render)
+
+    def update(self, task):
+        # the faces activated last frame have been rendered by now
+        if self.completing:
+            self.completing = False
+            self.capture_count += 1
+            for callback in list(self.capture_callbacks):
+                callback(self)
+
+        frame_time = self.clock.get_frame_time()
+
+        if not self.pending_faces:
+            if self.mode in ('always', 'round_robin'):
+                self.capture_now()
+            elif self.mode == 'motion' and self.rig_moved():
+                self.capture_now()
+            elif self.mode == 'interval':
+                if self.last_trigger_time is None or frame_time - self.last_trigger_time >= 1.0 / self.update_hz:
+                    self.last_trigger_time = frame_time
+                    self.capture_now()
+
+            if self.pending_faces:
+                self.mark_rig()
+
+        faces = [self.pending_faces.popleft() for _ in range(min(self.faces_per_frame, len(self.pending_faces)))]
+
+        if faces != self.active_faces:
+            for face, dr in enumerate(self.face_regions):
+                dr.set_active(face in faces)
+            self.cube_buffer.set_active(len(faces) > 0)
+            self.active_faces = faces
+
+        if faces and not self.pending_faces:
+            self.completing = True
+
+        return task.cont
+
+    def destroy(self):
+        base.task_mgr.remove(self.task_name)
+        self.capture_callbacks = []
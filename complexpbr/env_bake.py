@@ -0,0 +1,268 @@
+import os, struct, zlib, hashlib
+from pathlib import Path
+import numpy as np
+from panda3d.core import Texture, SamplerState, PfmFile, Filename, CPTA_uchar
+from .brdf_lut import default_cache_dir
+from .sh_irradiance import cubemap_directions, project_sh9
+
+
+# baked environment files: a header, one block per mip level holding the 6 faces, then optional SH9
+ENV_FILE_MAGIC = b'CPBRENV\x00'
+ENV_FILE_VERSION = 1
+ENV_DTYPES = ('half', 'float')
+ENV_COMPRESSIONS = (None, 'zlib')
+# magic, version, face size, levels, dtype, compression, flags
+ENV_HEADER = struct.Struct('<8sIIIIII')
+# offset and stored size of each level block
+ENV_LEVEL_ENTRY = struct.Struct('<QQ')
+ENV_FLAG_SH = 1
+# level blocks start on this boundary so uncompressed files can be memory-mapped straight into numpy views
+ENV_ALIGNMENT = 64
+
+def numpy_dtype(dtype):
+    return np.float16 if dtype == 'half' else np.float32
+
+def write_env_file(path, levels, sh=None, dtype='half', compression=None):
+    # levels: (6, size, size, 4) arrays, largest first, in Panda's RAM layout (BGRA, rows bottom-up)
+    # sh: radiance SH9 coefficients, (9, 3), as from project_sh9()
+    if dtype not in ENV_DTYPES:
+        raise ValueError('unknown environment dtype ' + repr(dtype) + ', expected one of ' + str(ENV_DTYPES))
+    if compression not in ENV_COMPRESSIONS:
+        raise ValueError('unknown environment compression ' + repr(compression) + ', expected one of ' + str(ENV_COMPRESSIONS))
+
+    blocks = []
+    for level in levels:
+        data = np.ascontiguousarray(level, dtype=numpy_dtype(dtype)).tobytes()
+        blocks.append(zlib.compress(data, 6) if compression == 'zlib' else data)
+
+    flags = ENV_FLAG_SH if sh is not None else 0
+    header = ENV_HEADER.pack(ENV_FILE_MAGIC, ENV_FILE_VERSION, levels[0].shape[1], len(levels),
+                             ENV_DTYPES.index(dtype), ENV_COMPRESSIONS.index(compression), flags)
+    sh_bytes = np.asarray(sh, dtype=np.float32).reshape(9, 3).tobytes() if sh is not None else b''
+
+    offset = ENV_HEADER.size + ENV_LEVEL_ENTRY.size * len(blocks) + len(sh_bytes)
+    table = []
+    for block in blocks:
+        offset = (offset + ENV_ALIGNMENT - 1) // ENV_ALIGNMENT * ENV_ALIGNMENT
+        table.append((offset, len(block)))
+        offset += len(block)
+
+    path = Path(path)
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'wb') as env_file:
+        env_file.write(header)
+        for entry in table:
+            env_file.write(ENV_LEVEL_ENTRY.pack(*entry))
+        env_file.write(sh_bytes)
+        for (block_offset, block_size), block in zip(table, blocks):
+            env_file.write(b'\x00' * (block_offset - env_file.tell()))
+            env_file.write(block)
+    os.replace(tmp_path, path)
+
+def read_env_file(path):
+    # returns (levels, sh, dtype), uncompressed levels are read-only views of a memory map
+    path = Path(path)
+    with open(path, 'rb') as env_file:
+        header = env_file.read(ENV_HEADER.size)
+        if len(header) < ENV_HEADER.size:
+            raise ValueError(str(path) + ' is not a complexpbr environment file')
+        magic, version, size, level_count, dtype_index, compression_index, flags = ENV_HEADER.unpack(header)
+        if magic != ENV_FILE_MAGIC:
+            raise ValueError(str(path) + ' is not a complexpbr environment file')
+        if version > ENV_FILE_VERSION:
+            raise ValueError(str(path) + ' has environment file version ' + str(version) + ', this complexpbr reads up to '
+                             + str(ENV_FILE_VERSION))
+        table = [ENV_LEVEL_ENTRY.unpack(env_file.read(ENV_LEVEL_ENTRY.size)) for _ in range(level_count)]
+        sh = np.frombuffer(env_file.read(9 * 3 * 4), dtype=np.float32).reshape(9, 3).astype(np.float64) if flags & ENV_FLAG_SH else None
+
+        dtype = ENV_DTYPES[dtype_index]
+        compression = ENV_COMPRESSIONS[compression_index]
+        levels = []
+        mapped = np.memmap(path, dtype=np.uint8, mode='r') if compression is None else None
+        for level, (offset, stored_size) in enumerate(table):
+            level_size = max(1, size >> level)
+            if mapped is not None:
+                data = mapped[offset:offset + stored_size].view(numpy_dtype(dtype))
+            else:
+                env_file.seek(offset)
+                data = np.frombuffer(zlib.decompress(env_file.read(stored_size)), dtype=numpy_dtype(dtype))
+            levels.append(data.reshape(6, level_size, level_size, 4))
+
+    return levels, sh, dtype
+
+def texture_env_levels(tex, levels):
+    # reads the first levels mips of a cube map back from the GPU, as (6, size, size, 4) arrays in RAM layout
+    # returns None for component types other than 8 bit, half and float
+    base.graphicsEngine.extract_texture_data(tex, base.win.get_gsg())
+    component_type = tex.get_component_type()
+    if component_type == Texture.T_unsigned_byte:
+        dtype, scale = np.uint8, 1.0 / 255.0
+    elif component_type == Texture.T_half_float:
+        dtype, scale = np.float16, None
+    elif component_type == Texture.T_float:
+        dtype, scale = np.float32, None
+    else:
+        return None
+
+    size = tex.get_x_size()
+
+    result = []
+    for level in range(min(levels, tex.get_num_ram_mipmap_images() or 1)):
+        level_size = max(1, size >> level)
+        data = np.frombuffer(tex.get_ram_mipmap_image(level), dtype=dtype).reshape(6, level_size, level_size, -1)
+        if scale is not None:
+            data = data.astype(np.float32) * scale
+        # IE an rgb cube buffer, padded to the 4 channels of the file layout
+        if data.shape[-1] == 3:
+            data = np.concatenate((data, np.ones(data.shape[:-1] + (1,), dtype=data.dtype)), axis=-1)
+        result.append(data)
+
+    return result
+
+def save_env_texture(path, env_tex, levels, rotation=None, include_sh=True, dtype='half', compression=None):
+    # rotation turns the faces into world axes, IE for the camera rig, whose capture follows the view
+    data = texture_env_levels(env_tex, levels)
+    if data is None:
+        print('complexpbr message: save_environment() needs the prefiltered environment, apply_shader(prefilter_env=True).')
+        return
+    if rotation is not None:
+        data = [rotate_cubemap_faces(level, rotation) for level in data]
+    # level 0 of a prefiltered chain is the mirror lobe, close enough to the capture for diffuse SH
+    sh = project_sh9(data[0][..., [2, 1, 0]].astype(np.float64)) if include_sh else None
+    write_env_file(path, data, sh, dtype, compression)
+
+def fill_env_texture(tex, levels, dtype='half', name=None):
+    # sets tex up as a cube map holding levels; the mips below the last level are box filtered from it, so Panda
+    # keeps the stored levels instead of generating the chain from level 0
+    size = levels[0].shape[1]
+    if dtype == 'float':
+        tex.setup_cube_map(size, Texture.T_float, Texture.F_rgba32)
+    else:
+        tex.setup_cube_map(size, Texture.T_half_float, Texture.F_rgba16)
+    if name is not None:
+        tex.set_name(name)
+
+    chain = list(levels)
+    while chain[-1].shape[1] > 1:
+        last = chain[-1].astype(np.float32)
+        chain.append(((last[:, 0::2, 0::2] + last[:, 1::2, 0::2] + last[:, 0::2, 1::2] + last[:, 1::2, 1::2]) * 0.25))
+
+    for level, data in enumerate(chain):
+        data = np.ascontiguousarray(data, dtype=numpy_dtype(dtype))
+        tex.set_ram_mipmap_image(level, CPTA_uchar(data.view(np.uint8).reshape(-1)))
+
+    sampler = SamplerState()
+    sampler.set_minfilter(SamplerState.FT_linear_mipmap_linear)
+    sampler.set_magfilter(SamplerState.FT_linear)
+    sampler.set_max_lod(len(levels) - 1)
+    tex.set_default_sampler(sampler)
+
+    return tex
+
+def cube_face_coords(directions):
+    # inverse of cubemap_directions(): face index and [-1, 1] face coordinates of each direction
+    x, y, z = directions[..., 0], directions[..., 1], directions[..., 2]
+    ax, ay, az = np.abs(x), np.abs(y), np.abs(z)
+    major_x = (ax >= ay) & (ax >= az)
+    major_y = ~major_x & (ay >= az)
+
+    face = np.where(major_x, np.where(x > 0, 0, 1), np.where(major_y, np.where(y > 0, 2, 3), np.where(z > 0, 4, 5)))
+    major = np.where(major_x, ax, np.where(major_y, ay, az))
+    # u and v per face, matching the face layouts in cubemap_directions()
+    u = np.choose(face, (-z, z, x, x, x, -x)) / major
+    v = np.choose(face, (-y, -y, z, -z, -y, -y)) / major
+
+    return face, u, v
+
+def sample_cubemap(faces, directions):
+    # bilinear lookup of (6, size, size, channels) faces, filtered within each face
+    size = faces.shape[1]
+    face, u, v = cube_face_coords(directions)
+    col = np.clip((u + 1.0) * 0.5 * size - 0.5, 0.0, size - 1.0)
+    row = np.clip((v + 1.0) * 0.5 * size - 0.5, 0.0, size - 1.0)
+    col0 = np.minimum(col.astype(np.int32), size - 2) if size > 1 else np.zeros_like(col, dtype=np.int32)
+    row0 = np.minimum(row.astype(np.int32), size - 2) if size > 1 else np.zeros_like(row, dtype=np.int32)
+    col1 = np.minimum(col0 + 1, size - 1)
+    row1 = np.minimum(row0 + 1, size - 1)
+    fx = (col - col0)[..., None]
+    fy = (row - row0)[..., None]
+
+    faces = faces.astype(np.float32)
+    top = faces[face, row0, col0] * (1.0 - fx) + faces[face, row0, col1] * fx
+    bottom = faces[face, row1, col0] * (1.0 - fx) + faces[face, row1, col1] * fx
+
+    return top * (1.0 - fy) + bottom * fy
+
+def rotate_cubemap_faces(faces, rotation):
+    # resamples faces so that texel direction d reads the source at d @ rotation (Panda's row vector convention)
+    directions = cubemap_directions(faces.shape[1])[0]
+
+    return sample_cubemap(faces, directions @ np.asarray(rotation, dtype=np.float64))
+
+def equirect_to_cubemap(pixels, size):
+    # pixels: (height, width, channels) linear radiance, top row first, longitude 0 at the image center facing +Y
+    # with +X to the right, so the result is sampled with Panda world space directions; returns RAM layout faces
+    pixels = np.asarray(pixels, dtype=np.float32)
+    height, width = pixels.shape[:2]
+    directions = cubemap_directions(size)[0]
+    x, y, z = directions[..., 0], directions[..., 1], directions[..., 2]
+
+    col = ((np.arctan2(x, y) / (2.0 * np.pi) + 0.5) * width - 0.5) % width
+    row = np.clip(np.arccos(np.clip(z, -1.0, 1.0)) / np.pi * height - 0.5, 0.0, height - 1.0)
+    col0 = np.floor(col).astype(np.int32)
+    row0 = np.minimum(np.floor(row).astype(np.int32), max(0, height - 2))
+    col1 = (col0 + 1) % width
+    row1 = np.minimum(row0 + 1, height - 1)
+    fx = (col - col0)[..., None]
+    fy = (row - row0)[..., None]
+
+    top = pixels[row0, col0] * (1.0 - fx) + pixels[row0, col1] * fx
+    bottom = pixels[row1, col0] * (1.0 - fx) + pixels[row1, col1] * fx
+    rgb = top * (1.0 - fy) + bottom * fy
+
+    faces = np.ones(rgb.shape[:3] + (4,), dtype=np.float32)
+    faces[..., :3] = rgb[..., [2, 1, 0]]
+
+    return faces
+
+def read_equirect(path):
+    # any float or 8 bit image Panda reads, IE .hdr, .exr or .pfm, as (height, width, 3) top row first
+    pfm = PfmFile()
+    if not pfm.read(Filename.from_os_specific(str(path))):
+        raise IOError('could not read ' + str(path))
+    tex = Texture()
+    tex.load(pfm)
+    width, height = tex.get_x_size(), tex.get_y_size()
+    pixels = np.frombuffer(tex.get_ram_image_as('RGB'), dtype=np.float32).reshape(height, width, 3)
+
+    return pixels[::-1]
+
+def equirect_cache_path(path, size, cache_dir=None):
+    if cache_dir is None:
+        cache_dir = default_cache_dir()
+    stat = os.stat(path)
+    key = hashlib.sha1((str(Path(path).resolve()) + ':' + str(stat.st_mtime_ns) + ':' + str(stat.st_size)).encode()).hexdigest()
+
+    return Path(cache_dir) / ('skybox_' + key[:16] + '_' + str(size) + '.cpenv')
+
+def load_equirect_cubemap(path, size=256, cache_dir=None):
+    # the converted faces and their SH9, cached next to the BRDF LUT until the source file changes
+    cache_path = equirect_cache_path(path, size, cache_dir)
+
+    if cache_path.is_file():
+        try:
+            levels, sh, dtype = read_env_file(cache_path)
+            return levels[0], sh
+        except (OSError, ValueError):
+            pass
+
+    faces = equirect_to_cubemap(read_equirect(path), size)
+    sh = project_sh9(faces[..., [2, 1, 0]])
+
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        write_env_file(cache_path, [faces], sh)
+    except OSError:
+        print('complexpbr message: could not write the skybox cache to ' + str(cache_path))
+
+    return faces.astype(np.float16), sh
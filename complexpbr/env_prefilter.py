@@ -0,0 +1,96 @@
+from collections import deque
+from importlib.resources import files
+from panda3d.core import Shader, ShaderAttrib, Texture, SamplerState, NodePath, LVecBase3i
+
+
+class EnvPrefilter:
+    def __init__(self, source_tex, size=256, levels=5, sample_count=32, jobs_per_frame=6,
+                 shader_dir=None, task_name='complexpbr_env_prefilter'):
+        self.source_tex = source_tex
+        self.size = size
+        self.levels = max(1, min(levels, size.bit_length()))
+        self.sample_count = sample_count
+        self.jobs_per_frame = jobs_per_frame
+        self.task_name = task_name
+        self.jobs = deque()
+        self.pending_capture = True
+        self.pass_count = 0
+
+        # the capture needs a mip chain for filtered importance sampling
+        source_tex.set_minfilter(SamplerState.FT_linear_mipmap_linear)
+        source_tex.set_magfilter(SamplerState.FT_linear)
+
+        self.env_tex = Texture('complexpbr_prefiltered_env')
+        self.env_tex.setup_cube_map(size, Texture.T_half_float, Texture.F_rgba16)
+        self.env_sampler = SamplerState()
+        self.env_sampler.set_minfilter(SamplerState.FT_linear_mipmap_linear)
+        self.env_sampler.set_magfilter(SamplerState.FT_linear)
+        self.env_sampler.set_max_lod(self.levels - 1)
+        self.env_tex.set_default_sampler(self.env_sampler)
+        self.env_tex.set_clear_color((0, 0, 0, 1))
+
+        self.compute_np = NodePath('complexpbr_env_prefilter')
+        shader_dir = files('complexpbr') if shader_dir is None else shader_dir
+        self.compute_np.set_shader(Shader.load_compute(Shader.SL_GLSL, shader_dir / 'prefilter_c.comp'))
+        self.compute_np.set_shader_input('source_env', source_tex)
+        self.compute_np.set_shader_input('source_size', float(source_tex.get_x_size() or size))
+        self.compute_np.set_shader_input('sample_count', sample_count)
+
+        base.task_mgr.add(self.update, task_name, sort=20)
+
+    @property
+    def max_lod(self):
+        return float(self.levels - 1)
+
+    def on_capture(self, scheduler=None):
+        self.pending_capture = True
+
+    def set_source(self, source_tex):
+        # IE a converted skybox instead of the live capture, prefiltered on the next pass
+        self.source_tex = source_tex
+        source_tex.set_minfilter(SamplerState.FT_linear_mipmap_linear)
+        source_tex.set_magfilter(SamplerState.FT_linear)
+        self.compute_np.set_shader_input('source_env', source_tex)
+        self.compute_np.set_shader_input('source_size', float(source_tex.get_x_size() or self.size))
+        self.pending_capture = True
+
+    def cancel(self):
+        # drops queued and pending work, IE after env_tex was loaded from a baked file
+        self.jobs.clear()
+        self.pending_capture = False
+
+    def queue_pass(self):
+        if self.env_tex.get_x_size() != self.size or self.env_tex.get_component_type() != Texture.T_half_float:
+            # a baked environment of another size or precision was loaded into env_tex
+            self.env_tex.setup_cube_map(self.size, Texture.T_half_float, Texture.F_rgba16)
+            self.env_tex.set_default_sampler(self.env_sampler)
+        for level in range(self.levels):
+            for face in range(6):
+                self.jobs.append((level, face))
+
+        self.pending_capture = False
+        self.pass_count += 1
+
+    def run_job(self, level, face):
+        level_size = max(1, self.size >> level)
+        compute_np = self.compute_np
+        compute_np.set_shader_input('dest_level', self.env_tex, False, True, -1, level)
+        compute_np.set_shader_input('face', face)
+        compute_np.set_shader_input('level_size', level_size)
+        compute_np.set_shader_input('roughness', level / max(1.0, self.levels - 1.0))
+
+        groups = (level_size + 7) // 8
+        base.graphicsEngine.dispatch_compute(LVecBase3i(groups, groups, 1), compute_np.get_attrib(ShaderAttrib), base.win.get_gsg())
+
+    def update(self, task):
+        # a new pass starts only once the previous one has finished, so constant captures cannot starve it
+        if not self.jobs and self.pending_capture:
+            self.queue_pass()
+
+        for _ in range(min(self.jobs_per_frame, len(self.jobs))):
+            self.run_job(*self.jobs.popleft())
+
+        return task.cont
+
+    def destroy(self):
+        base.task_mgr.remove(self.task_name)
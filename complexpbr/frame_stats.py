@@ -0,0 +1,162 @@
+import time
+from collections import deque
+from panda3d.core import ClockObject, GlobPattern, PStatClient, PStatCollector, load_prc_file_data
+
+
+# screenspace render graph passes by the effect they belong to, see RenderGraph
+PASS_STAGES = {'ssao': 'ssao', 'linear': 'ssao', 'hiz': 'ssr', 'ssr': 'ssr', 'bloom': 'bloom', 'taa': 'taa'}
+# per-frame counts, also published as PStats levels under complexpbr:
+FRAME_COUNTS = ('cube_faces', 'probe_faces', 'screenspace_passes', 'shadow_cache_renders', 'clustered_lights')
+
+def connect_pstats(gpu_timing=False):
+    # GPU time per buffer shows up under Draw:<buffer name>, every complexpbr buffer is named complexpbr_*
+    if gpu_timing:
+        load_prc_file_data('', 'pstats-gpu-timing true')
+    if not PStatClient.is_connected():
+        PStatClient.connect()
+
+    return PStatClient.is_connected()
+
+class FrameStats:
+    def __init__(self, window=120, task_name='complexpbr_frame_stats'):
+        # rolling averages over window frames of the frame time, the complexpbr tasks, the draw time of each stage's
+        # display regions and a few per-frame counts
+        self.clock = ClockObject.get_global_clock()
+        self.task_name = task_name
+        self.window = window
+        self.enabled = False
+        self.samples = {}
+        self.draw_ms = {}
+        self.regions = []
+        self.stages = set()
+        self.region_key = None
+        self.last_cache_renders = None
+        self.levels = {name: PStatCollector('complexpbr:' + name) for name in FRAME_COUNTS}
+
+    def configure(self, window=None):
+        if window is not None:
+            self.window = max(1, int(window))
+            self.samples = {}
+
+    def start(self):
+        if self.enabled:
+            return
+        self.enabled = True
+        self.samples = {}
+        # after every complexpbr task, before igLoop renders the frame
+        base.task_mgr.add(self.update, self.task_name, sort=49)
+
+    def stop(self):
+        if not self.enabled:
+            return
+        self.enabled = False
+        base.task_mgr.remove(self.task_name)
+        self.unwrap_regions()
+
+    def stage_regions(self):
+        regions = []
+        def add_buffer(stage, buffer):
+            regions.extend((stage, buffer.get_display_region(i)) for i in range(buffer.get_num_display_regions()))
+
+        add_buffer('cube_capture', base.cube_buffer)
+        for probe in base.complexpbr_reflection_probes.probes:
+            add_buffer('probe_capture', probe.cube_buffer)
+        for buffer in base.complexpbr_shadow_atlas.buffers or ():
+            add_buffer('shadow_atlas', buffer)
+
+        if getattr(base, 'complexpbr_screenspace_init', False):
+            # the scene buffer is the ibl forward pass, the window only draws screen_quad
+            add_buffer('forward', base.complexpbr_filter_manager.buffers[0])
+            for graph_pass in base.complexpbr_render_graph.passes:
+                for buffer in graph_pass.buffers:
+                    add_buffer(PASS_STAGES.get(graph_pass.name.split('_')[0], 'screenspace'), buffer)
+            add_buffer('screen', base.win)
+        else:
+            regions.extend(('forward', dr) for dr in base.win.get_active_display_regions() if dr.get_camera() == base.cam)
+
+        return regions
+
+    def get_region_key(self):
+        return (len(base.complexpbr_reflection_probes.probes), base.complexpbr_shadow_atlas.buffers is not None,
+                getattr(base, 'complexpbr_screenspace_init', False))
+
+    def wrap_regions(self):
+        # a draw callback around each region times its draw, regions with a callback of their own are left alone
+        self.unwrap_regions()
+        for stage, dr in self.stage_regions():
+            self.stages.add(stage)
+            if dr.get_camera().is_empty() or dr.get_draw_callback() is not None:
+                continue
+            dr.set_draw_callback(lambda cbdata, stage=stage: self.timed_draw(cbdata, stage))
+            self.regions.append(dr)
+        self.region_key = self.get_region_key()
+
+    def unwrap_regions(self):
+        for dr in self.regions:
+            dr.clear_draw_callback()
+        self.regions = []
+        self.stages = set()
+        self.region_key = None
+
+    def timed_draw(self, cbdata, stage):
+        start = time.perf_counter()
+        cbdata.upcall()
+        self.draw_ms[stage] = self.draw_ms.get(stage, 0.0) + (time.perf_counter() - start) * 1000.0
+
+    def record(self, group, name, value):
+        samples = self.samples.setdefault(group, {})
+        if name not in samples:
+            samples[name] = deque(maxlen=self.window)
+        samples[name].append(value)
+
+    def frame_counts(self):
+        scheduler = base.complexpbr_cube_scheduler
+        atlas = base.complexpbr_shadow_atlas
+        last_renders = atlas.static_renders if self.last_cache_renders is None else self.last_cache_renders
+        cache_renders = atlas.static_renders - last_renders
+        self.last_cache_renders = atlas.static_renders
+        counts = {
+            'cube_faces': len(scheduler.active_faces) if base.cube_buffer.is_active() else 0,
+            'probe_faces': sum(len(probe.scheduler.active_faces) for probe in base.complexpbr_reflection_probes.probes),
+            'screenspace_passes': 0,
+            'shadow_cache_renders': cache_renders,
+            'clustered_lights': len(base.complexpbr_light_clusters.lights),
+        }
+        if getattr(base, 'complexpbr_screenspace_init', False):
+            counts['screenspace_passes'] = sum(1 for graph_pass in base.complexpbr_render_graph.passes if graph_pass.live)
+
+        return counts
+
+    def update(self, task):
+        if self.get_region_key() != self.region_key:
+            self.wrap_regions()
+
+        self.record('frame', 'frame_ms', self.clock.get_dt() * 1000.0)
+        for cpu_task in base.task_mgr.mgr.find_tasks_matching(GlobPattern('complexpbr_*')):
+            if cpu_task.get_name() != self.task_name:
+                self.record('cpu_ms', cpu_task.get_name(), cpu_task.get_dt() * 1000.0)
+
+        # the draw times are those of the last frame, rendered after this task ran then
+        for stage in self.stages | set(self.draw_ms):
+            self.record('draw_ms', stage, self.draw_ms.get(stage, 0.0))
+        self.draw_ms = {}
+
+        for name, value in self.frame_counts().items():
+            self.record('counts', name, value)
+            self.levels[name].set_level(value)
+
+        return task.cont
+
+    def get(self):
+        average = lambda values: sum(values) / len(values) if values else 0.0
+        frame = self.samples.get('frame', {}).get('frame_ms', ())
+        stats = {'frames': len(frame), 'frame_ms': average(frame), 'quality_tier': base.complexpbr_quality_governor.tier}
+        for group in ('cpu_ms', 'draw_ms', 'counts'):
+            stats[group] = {name: average(values) for name, values in self.samples.get(group, {}).items()}
+        stats['cpu_ms_total'] = sum(stats['cpu_ms'].values())
+        stats['draw_ms_total'] = sum(stats['draw_ms'].values())
+
+        return stats
+
+    def destroy(self):
+        self.stop()
@@ -1,28 +1,90 @@
 #version 430
+// @slot defines
 
 #ifndef MAX_LIGHTS
     #define MAX_LIGHTS 20
 #endif
 
+// feature flags, apply_shader(features=...) compiles permutations with these overridden
+#ifndef DIRECT_LIGHTS
+    #define DIRECT_LIGHTS 1
+#endif
+
+#ifndef SHADOWS
+    #define SHADOWS 1
+#endif
+
+#ifndef SHADOW_ATLAS
+    #define SHADOW_ATLAS 1
+#endif
+
+#ifndef EMISSION
+    #define EMISSION 1
+#endif
+
+#ifndef CLUSTERED_LIGHTS
+    #define CLUSTERED_LIGHTS 1
+#endif
+
+#ifndef MOTION_VECTORS
+    #define MOTION_VECTORS 1
+#endif
+
+#ifndef REFLECTION_PROBES
+    #define REFLECTION_PROBES 1
+#endif
+
+// the vertex variant, see ibl_v.vert
+#ifndef SKINNING
+    #define SKINNING 1
+#endif
+
 uniform sampler2D p3d_Texture0;
 uniform sampler2D p3d_Texture1;
 uniform sampler2D p3d_Texture2;
 uniform sampler2D p3d_Texture3;
 uniform samplerCube cubemaptex;
+uniform samplerCube prefiltered_envmap;
+uniform float prefilter_max_lod;
+// L2 spherical harmonic irradiance, cosine lobe and basis constants premultiplied on the CPU
+uniform vec3 sh_irradiance[9];
+// 1 once a baked environment or skybox is loaded, those are stored in world axes rather than the camera rig's
+uniform int env_world_space;
 uniform sampler2D brdfLUT;
+uniform mat4 p3d_ViewMatrixInverse;
+
+#if REFLECTION_PROBES
+// placed reflection probes, set per GeomNode by complexpbr/reflection_probes.py, probe_count 0 keeps the camera rig's environment
+// the probes are captured in world axes and blended by probe_position.w
+uniform int probe_count;
+uniform samplerCube probe_env_0;
+uniform samplerCube probe_env_1;
+uniform float probe_max_lod;
+uniform vec4 probe_position[2];
+uniform vec3 probe_box_min[2];  // world space parallax box, empty when min is not below max
+uniform vec3 probe_box_max[2];
+uniform vec3 probe_sh[9];  // the blended irradiance of the probes, same layout as sh_irradiance
+#endif
 // layout(rgba32f) uniform image2D outputNormalNorm;
-layout(location=1) out vec3 outputNormal;
+// the octahedral view space normal for the screenspace passes, see packViewNormal()
+layout(location=1) out vec4 outputNormal;
+
+#if MOTION_VECTORS
+// screen motion since the last frame for the temporal screenspace passes, see complexpbr/motion_vectors.py
+layout(location=2) out vec4 outputVelocity;
+in vec4 v_clip_position;
+in vec4 v_prev_clip_position;
+#endif
 
 in vec3 v_position;
 in vec4 v_color;
 in mat3 v_tbn;
 in vec2 v_texcoord;
 
-in vec4 v_shadow_pos[MAX_LIGHTS];
-
 uniform float ao;
 uniform float specular_factor;
 uniform float shadow_boost;
+// @slot uniforms
 
 const float LIGHT_CUTOFF = 0.001;
 const float SPOTSMOOTH = 0.1;
@@ -78,24 +140,59 @@ float GeometrySmith(vec3 N, vec3 V, vec3 L, float roughness)
     return ggx1 * ggx2;
 }
 
+vec3 evalSHIrradiance(vec3 sh[9], vec3 n)
+{
+    vec3 irradiance = sh[0]
+                    + sh[1] * n.y
+                    + sh[2] * n.z
+                    + sh[3] * n.x
+                    + sh[4] * (n.x * n.y)
+                    + sh[5] * (n.y * n.z)
+                    + sh[6] * (3.0 * n.z * n.z - 1.0)
+                    + sh[7] * (n.x * n.z)
+                    + sh[8] * (n.x * n.x - n.y * n.y);
+
+    return max(irradiance, vec3(0.0));
+}
+
+#if REFLECTION_PROBES
+vec3 probeDirection(vec4 position, vec3 box_min, vec3 box_max, vec3 world_pos, vec3 R)
+{
+    if (all(lessThan(box_min, box_max))) {
+        // box projection, the reflected ray is traced to the probe's box and looked up from the probe's center
+        vec3 exits = max((box_max - world_pos) / R, (box_min - world_pos) / R);
+        float dist = min(min(exits.x, exits.y), exits.z);
+        return world_pos + R * max(dist, 0.0) - position.xyz;
+    }
+    return R;
+}
+#endif
+
 vec3 getIBL(vec3 N, vec3 V, vec3 F0, vec3 diffuse_color, float roughness)
 {
     vec3 R = reflect(-V, N);
     vec3 kS = fresnelSchlick(max(dot(N, V), 0.0), F0);
     vec3 kD = vec3(1.0) - kS;
 
-    vec3 irradiance = texture(cubemaptex, N).rgb;
+    mat3 env_rotation = env_world_space == 1 ? mat3(p3d_ViewMatrixInverse) : mat3(1.0);
+    vec3 irradiance = evalSHIrradiance(sh_irradiance, env_rotation * N);
+    // each mip of the prefiltered environment holds the GGX lobe for one roughness step
+    vec3 prefilteredColor = textureLod(prefiltered_envmap, env_rotation * R, roughness * prefilter_max_lod).rgb;
+
+#if REFLECTION_PROBES
+    if (probe_count > 0) {
+        mat3 view_to_world = mat3(p3d_ViewMatrixInverse);
+        vec3 world_pos = (p3d_ViewMatrixInverse * vec4(v_position, 1.0)).xyz;
+        vec3 world_R = view_to_world * R;
+        float lod = roughness * probe_max_lod;
+        irradiance = evalSHIrradiance(probe_sh, view_to_world * N);
+        prefilteredColor = textureLod(probe_env_0, probeDirection(probe_position[0], probe_box_min[0], probe_box_max[0], world_pos, world_R), lod).rgb * probe_position[0].w;
+        if (probe_count > 1) {
+            prefilteredColor += textureLod(probe_env_1, probeDirection(probe_position[1], probe_box_min[1], probe_box_max[1], world_pos, world_R), lod).rgb * probe_position[1].w;
+        }
+    }
+#endif
     vec3 diffuse = irradiance * diffuse_color;
-
-    const float MAX_REFLECTION_LOD = 4.0;
-    vec3 prefilteredColor = vec3(0.0);
-    if (roughness < 0.7) 
-        prefilteredColor = textureLod(cubemaptex, R, roughness * MAX_REFLECTION_LOD).rgb;
-    else if (roughness >= 0.7)
-        if (roughness < 0.99)
-            prefilteredColor = textureLod(cubemaptex, R, roughness * MAX_REFLECTION_LOD).rgb * vec3(0.04);
-    else if (roughness >= 0.99) 
-        prefilteredColor = prefilteredColor;
     vec2 brdf = texture(brdfLUT, vec2(max(dot(N, V), 0.0), roughness)).rg;
     vec3 specular = prefilteredColor * (kS * brdf.x + brdf.y);
     vec3 ao_final = (kD * diffuse + specular) * ao;
@@ -118,6 +215,27 @@ uniform struct p3d_LightModelParameters {
     vec4 ambient;
 } p3d_LightModel;
 
+#if SHADOW_ATLAS
+// lights added with add_shadow_light() share one depth atlas, see complexpbr/shadow_atlas.py
+// both arrays follow the p3d_LightSource slots, a zero size rect means the light uses its own shadowMap
+uniform sampler2DShadow shadow_atlas;
+uniform mat4 shadow_atlas_matrices[MAX_LIGHTS];  // world to the light's tile uv and depth
+uniform vec4 shadow_atlas_rects[MAX_LIGHTS];  // tile origin and size in atlas uv
+
+float atlasShadow(vec4 rect, vec4 shadow_coord)
+{
+    vec3 coord = shadow_coord.xyz / shadow_coord.w;
+    if (any(lessThan(coord, vec3(0.0))) || any(greaterThan(coord, vec3(1.0)))) {
+        return 1.0;
+    }
+
+    // keep the filter footprint inside the tile
+    vec2 half_texel = 0.5 / vec2(textureSize(shadow_atlas, 0));
+    vec2 uv = rect.xy + clamp(coord.xy * rect.zw, half_texel, rect.zw - half_texel);
+    return texture(shadow_atlas, vec3(uv, coord.z));
+}
+#endif
+
 uniform vec4 p3d_ColorScale;
 
 struct FunctionParameters {
@@ -156,11 +274,122 @@ float diffuse_function(FunctionParameters func_params) {
     return 1.0 / PI;
 }
 
+vec4 packUnorm16x2(vec2 q)
+{
+    // the aux targets may be 8 bits per channel, so each 16 bit value is split over two channels
+    vec2 high = floor(q / 256.0);
+    return vec4(high.x, q.x - high.x * 256.0, high.y, q.y - high.y * 256.0) / 255.0;
+}
+
+#if MOTION_VECTORS
+vec4 packVelocity(vec2 velocity)
+{
+    // +-1 uv range
+    return packUnorm16x2(floor(clamp(velocity * 0.5 + 0.5, 0.0, 1.0) * 65535.0 + 0.5));
+}
+#endif
+
+vec4 packViewNormal(vec3 n)
+{
+    // octahedral encoding, the lower hemisphere folded over the diagonals
+    n /= abs(n.x) + abs(n.y) + abs(n.z);
+    vec2 oct = n.z >= 0.0 ? n.xy : (1.0 - abs(n.yx)) * vec2(n.x >= 0.0 ? 1.0 : -1.0, n.y >= 0.0 ? 1.0 : -1.0);
+    // 0 is left to the clear value, IE where geometry without this shader drew
+    return packUnorm16x2(clamp(floor((oct * 0.5 + 0.5) * 65535.0 + 0.5), 1.0, 65535.0));
+}
+
+#if CLUSTERED_LIGHTS
+// forward+ lights binned into view space clusters by complexpbr/light_clusters.py, 4 texels per light:
+// world position + radius (0 is unbounded), color, spot direction + cos cutoff, attenuation
+uniform samplerBuffer cluster_lights;
+uniform isamplerBuffer cluster_grid;
+uniform isamplerBuffer cluster_indices;
+uniform int cluster_mode;  // 0 off, 1 every light, 2 this fragment's cluster
+uniform int cluster_light_count;
+uniform ivec3 cluster_dims;
+uniform vec2 cluster_tile_size;
+uniform vec2 cluster_z_params;
+uniform mat4 p3d_ViewMatrix;
+
+vec3 clusteredLight(int light_index, vec3 N, vec3 V, float roughness, float metallic, vec3 F0, vec3 diffuse_color)
+{
+    vec4 pos_radius = texelFetch(cluster_lights, light_index * 4);
+    vec3 light_pos = (p3d_ViewMatrix * vec4(pos_radius.xyz, 1.0)).xyz - v_position;
+    float dist = length(light_pos);
+
+    if (pos_radius.w > 0.0 && dist > pos_radius.w) {
+        return vec3(0.0);
+    }
+
+    vec3 lightcol = texelFetch(cluster_lights, light_index * 4 + 1).rgb;
+    vec4 spot = texelFetch(cluster_lights, light_index * 4 + 2);
+    vec3 att_const = texelFetch(cluster_lights, light_index * 4 + 3).xyz;
+    vec3 l = light_pos / max(dist, 0.0001);
+    vec3 h = normalize(l + V);
+
+    float attenuation_factor = 1.0 / (att_const.x + att_const.y + att_const.z * dist * dist);
+    if (pos_radius.w > 0.0) {
+        // fade to zero at the cutoff radius instead of clipping
+        float falloff = clamp(1.0 - pow(dist / pos_radius.w, 4.0), 0.0, 1.0);
+        attenuation_factor *= falloff * falloff;
+    }
+
+    if (spot.w > -1.5) {
+        float spotcos = dot(normalize(mat3(p3d_ViewMatrix) * spot.xyz), -l);
+        attenuation_factor *= smoothstep(spot.w - SPOTSMOOTH, spot.w + SPOTSMOOTH, spotcos);
+    }
+
+    FunctionParameters func_params;
+    func_params.n_dot_l = clamp(dot(N, l), 0.0, 1.0);
+    func_params.n_dot_v = clamp(abs(dot(N, V)), 0.0, 1.0);
+    func_params.n_dot_h = clamp(dot(N, h), 0.0, 1.0);
+    func_params.l_dot_h = clamp(dot(l, h), 0.0, 1.0);
+    func_params.v_dot_h = clamp(dot(V, h), 0.0, 1.0);
+    func_params.roughness = roughness;
+    func_params.metallic = metallic;
+    func_params.reflection0 = F0;
+    func_params.diffuse_color = diffuse_color;
+    func_params.specular_color = F0;
+
+    float vis = visibility_occlusion(func_params);
+    float D = microfacet_distribution(func_params);
+
+    vec3 diffuse_contrib = (diffuse_color * p3d_LightModel.ambient.rgb) * diffuse_function(func_params);
+    vec3 spec_contrib = vec3(F0 * vis * D);
+
+    return func_params.n_dot_l * lightcol * (diffuse_contrib + spec_contrib) * attenuation_factor;
+}
+
+vec3 clusteredLighting(vec3 N, vec3 V, float roughness, float metallic, vec3 F0, vec3 diffuse_color)
+{
+    vec3 result = vec3(0.0);
+
+    if (cluster_mode == 1) {
+        for (int i = 0; i < cluster_light_count; ++i) {
+            result += clusteredLight(i, N, V, roughness, metallic, F0, diffuse_color);
+        }
+    }
+    else if (cluster_mode == 2) {
+        ivec2 tile = min(ivec2(gl_FragCoord.xy / cluster_tile_size), cluster_dims.xy - 1);
+        int slice = clamp(int(log(max(-v_position.z, 0.0001)) * cluster_z_params.x + cluster_z_params.y), 0, cluster_dims.z - 1);
+        ivec2 offset_count = texelFetch(cluster_grid, tile.x + cluster_dims.x * (tile.y + cluster_dims.y * slice)).xy;
+
+        for (int i = 0; i < offset_count.y; ++i) {
+            result += clusteredLight(texelFetch(cluster_indices, offset_count.x + i).x, N, V, roughness, metallic, F0, diffuse_color);
+        }
+    }
+
+    return result;
+}
+#endif
+
 float normal_blur(in float x, in float sig)
 {
     return 0.3989*exp(-0.5*x*x/(sig*sig))/sig;
 }
 
+// @slot functions
+
 void main()
 {
     vec3 N = normalize(v_tbn * (2.0 * texture(p3d_Texture2, v_texcoord).rgb - 1.0));
@@ -176,7 +405,11 @@ void main()
     float roughness = clamp(p3d_Material.roughness * metalRough.g,  0.0, 1.0);
     
     // sample the emission texture
+#if EMISSION
     vec3 emission = p3d_Material.emission.rgb * texture(p3d_Texture3, v_texcoord).rgb;
+#else
+    vec3 emission = vec3(0.0);
+#endif
 
     vec3 F0 = vec3(0.04);
     F0 = mix(F0, albedo.rgb, metallic);
@@ -187,6 +420,26 @@ void main()
     // vec3 color = vec3(0.0);
     vec4 color = vec4(vec3(0.0), albedo.a);
 
+    // @slot pre_lighting
+
+#if DIRECT_LIGHTS
+#if SHADOWS
+    // shadow coordinates from the interpolated view position instead of a varying per light slot, and only for bound lights
+    vec4 shadow_coords[MAX_LIGHTS];
+#if SHADOW_ATLAS
+    // atlas lights are not Panda shadow casters, their shadowMap lookup below passes and the atlas lookup applies instead
+    vec4 world_position = p3d_ViewMatrixInverse * vec4(v_position, 1.0);
+    float atlas_shadows[MAX_LIGHTS];
+#endif
+    for (int i = 0; i < MAX_LIGHTS; ++i) {
+        vec3 lightcol = p3d_LightSource[i].diffuse.rgb;
+        shadow_coords[i] = dot(lightcol, lightcol) < LIGHT_CUTOFF ? vec4(0.0) : p3d_LightSource[i].shadowViewMatrix * vec4(v_position, 1.0);
+#if SHADOW_ATLAS
+        atlas_shadows[i] = shadow_atlas_rects[i].z > 0.0 ? atlasShadow(shadow_atlas_rects[i], shadow_atlas_matrices[i] * world_position) : 1.0;
+#endif
+    }
+#endif
+
     // compute the direct lighting from light sources
     for (int i = 0; i < MAX_LIGHTS; ++i) {
         vec3 lightcol = p3d_LightSource[i].diffuse.rgb;
@@ -205,7 +458,14 @@ void main()
         float spotcutoff = p3d_LightSource[i].spotCosCutoff;
         float shadowSpot = smoothstep(spotcutoff-SPOTSMOOTH, spotcutoff+SPOTSMOOTH, spotcos);
 
-        float shadowCaster = textureProj(p3d_LightSource[i].shadowMap, v_shadow_pos[i]);
+#if SHADOWS
+        float shadowCaster = textureProj(p3d_LightSource[i].shadowMap, shadow_coords[i]);
+#if SHADOW_ATLAS
+        shadowCaster *= atlas_shadows[i];
+#endif
+#else
+        float shadowCaster = 1.0;
+#endif
         float shadow = shadowSpot * shadowCaster * attenuation_factor;
 
         FunctionParameters func_params;
@@ -228,15 +488,34 @@ void main()
         color.rgb += func_params.n_dot_l * lightcol * (diffuse_contrib + spec_contrib) * shadow;
         color.rgb += albedo.rgb * shadow_boost; // node-level shadow boost heuristic
     }
+
+#if CLUSTERED_LIGHTS
+    // clustered lights are unshadowed, so shadow_boost does not apply to them
+    color.rgb += clusteredLighting(N, V, roughness, metallic, F0, diffuse_color);
+#endif
+#endif
+
+    // @slot post_lighting
     
     vec3 ibl = getIBL(N, V, F0, diffuse_color, roughness);
     o_color = vec4(ibl + emission + color.rgb, color.a);
+
+#if MOTION_VECTORS
+#if SKINNING
+    // the last frame's skinning is not kept, a full screen of motion moves the history lookup off screen, which
+    // the temporal passes reject
+    outputVelocity = packVelocity(vec2(-1.0));
+#else
+    outputVelocity = packVelocity((v_clip_position.xy / v_clip_position.w - v_prev_clip_position.xy / v_prev_clip_position.w) * 0.5);
+#endif
+#endif
+
+    // @slot main_end
+
     // o_color = vec4(v_tbn * texture(p3d_Texture2, v_texcoord).rgb, 1)
     // o_color = vec4(v_tbn, 1);
     // o_color = vec4(N, color.a);
-    // send the normal texture to post
+    // send the shading normal to post
     // imageStore(outputNormalNorm, coord, vec4(texture(p3d_Texture2, v_texcoord).rgb * 0.5 + vec3(0.5),1));
-    outputNormal = texture(p3d_Texture2, v_texcoord).rgb * 0.5 + vec3(0.5);
-    // outputNormal = N * 0.5 + vec3(0.5);
-    // outputNormal = N;
+    outputNormal = packViewNormal(N);
 }
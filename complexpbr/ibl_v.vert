@@ -1,7 +1,18 @@
 #version 430
+// @slot defines
 
-#ifndef MAX_LIGHTS
-    #define MAX_LIGHTS 20
+// feature flags, apply_shader(features=...) compiles permutations with these overridden
+#ifndef DISPLACEMENT
+    #define DISPLACEMENT 1
+#endif
+
+// the vertex variants, apply_shader() picks static, skinned or displaced per GeomNode
+#ifndef SKINNING
+    #define SKINNING 1
+#endif
+
+#ifndef MOTION_VECTORS
+    #define MOTION_VECTORS 1
 #endif
 
 uniform mat4 p3d_ProjectionMatrix;
@@ -10,10 +21,11 @@ uniform mat3 p3d_NormalMatrix;
 uniform mat4 p3d_TextureMatrix;
 uniform mat4 p3d_ModelMatrix;
 
-// skinning
+#if SKINNING
 uniform mat4 p3d_TransformTable[100];
 in vec4 transform_weight;
 in vec4 transform_index;
+#endif
 
 in vec3 p3d_Normal;
 in vec4 p3d_Vertex;
@@ -26,44 +38,61 @@ out vec4 v_color;
 out mat3 v_tbn;
 out vec2 v_texcoord;
 
+#if DISPLACEMENT
 uniform sampler2D displacement_map;
 uniform float displacement_scale;
+#endif
+// @slot uniforms
 
-uniform struct p3d_LightSourceParameters {
-    vec4 position;
-    vec4 diffuse;
-    vec4 specular;
-    vec3 attenuation;
-    vec3 spotDirection;
-    float spotCosCutoff;
-    sampler2DShadow shadowMap;
-    mat4 shadowViewMatrix;
-} p3d_LightSource[MAX_LIGHTS];
+#if MOTION_VECTORS
+// unjittered world to clip transforms of this frame and the last, see complexpbr/motion_vectors.py
+uniform mat4 view_projection;
+uniform mat4 prev_view_projection;
+// this frame's world space to the last frame's for GeomNodes tracked with complexpbr.add_motion_node(), identity for the rest
+uniform mat4 object_motion;
+out vec4 v_clip_position;
+out vec4 v_prev_clip_position;
+#endif
 
-out vec4 v_shadow_pos[MAX_LIGHTS];
+// @slot functions
 
 void main() {
+#if SKINNING
     mat4 skin_matrix = (
         p3d_TransformTable[int(transform_index.x)] * transform_weight.x +
         p3d_TransformTable[int(transform_index.y)] * transform_weight.y +
         p3d_TransformTable[int(transform_index.z)] * transform_weight.z +
         p3d_TransformTable[int(transform_index.w)] * transform_weight.w);
 
+    vec4 vertex = skin_matrix * p3d_Vertex;
     vec3 normal = normalize(p3d_NormalMatrix * (skin_matrix * vec4(p3d_Normal.xyz, 0.0)).xyz);
     vec3 tangent = normalize(p3d_NormalMatrix * (skin_matrix * vec4(p3d_Tangent.xyz, 0.0)).xyz);
+#else
+    vec4 vertex = p3d_Vertex;
+    vec3 normal = normalize(p3d_NormalMatrix * p3d_Normal.xyz);
+    vec3 tangent = normalize(p3d_NormalMatrix * p3d_Tangent.xyz);
+#endif
     vec3 bitangent = cross(normal, tangent) * p3d_Tangent.w;
     v_tbn = mat3(tangent, bitangent, normal);
 
     v_color = p3d_Color;
     v_texcoord = (p3d_TextureMatrix * vec4(p3d_MultiTexCoord0, 0.0, 1.0)).xy;
+#if DISPLACEMENT
     float displacement = texture(displacement_map, v_texcoord).r * displacement_scale;
-    vec4 displaced_vertex = skin_matrix * p3d_Vertex + vec4(normal, 0.0) * displacement;
+    vec4 displaced_vertex = vertex + vec4(normal, 0.0) * displacement;
+#else
+    vec4 displaced_vertex = vertex;
+#endif
     vec4 model_view_displaced_vertex = p3d_ModelViewMatrix * displaced_vertex;
     v_position = vec3(model_view_displaced_vertex);
 
-    for (int i = 0; i < p3d_LightSource.length(); ++i) {
-        v_shadow_pos[i] = p3d_LightSource[i].shadowViewMatrix * model_view_displaced_vertex;
-    }
+#if MOTION_VECTORS
+    vec4 world_vertex = p3d_ModelMatrix * displaced_vertex;
+    v_clip_position = view_projection * world_vertex;
+    v_prev_clip_position = prev_view_projection * (object_motion * world_vertex);
+#endif
+
+    // @slot main_end
 
     gl_Position = p3d_ProjectionMatrix * model_view_displaced_vertex;
 }
@@ -0,0 +1,225 @@
+import math
+import numpy as np
+from panda3d.core import Texture, GeomEnums, NodePath, PointLight, Spotlight, LVecBase2f, LVecBase3i
+from panda3d.core import PTA_int, PTA_LVecBase2f, PTA_LVecBase3i
+from .screenspace import scene_buffer_size
+
+
+# modes of the cluster_mode shader input, see the clustered light loop in ibl_f.frag
+CLUSTER_MODE_OFF = 0
+CLUSTER_MODE_ALL = 1
+CLUSTER_MODE_CLUSTERED = 2
+
+# rgba32f texels per light in the cluster_lights buffer
+LIGHT_TEXELS = 4
+
+def make_buffer_texture(name, size, component_type, buffer_format):
+    tex = Texture(name)
+    tex.setup_buffer_texture(max(1, size), component_type, buffer_format, GeomEnums.UH_dynamic)
+
+    return tex
+
+class LightClusters:
+    def __init__(self, camera, dims=(16, 9, 24), far=None, cutoff=1.0 / 256.0, task_name='complexpbr_light_clusters'):
+        self.camera = camera
+        self.task_name = task_name
+        self.lights = []
+        self.light_count = 0
+        self.index_count = 0
+        self.far = far
+        self.z_params = (0.0, 0.0)
+
+        # shared by every node, so per-frame changes need no state changes
+        self.light_count_input = PTA_int.empty_array(1)
+        self.dims_input = PTA_LVecBase3i.empty_array(1)
+        self.tile_size_input = PTA_LVecBase2f.empty_array(1)
+        self.z_params_input = PTA_LVecBase2f.empty_array(1)
+
+        self.lights_tex = make_buffer_texture('complexpbr_cluster_lights', LIGHT_TEXELS * 64, Texture.T_float, Texture.F_rgba32)
+        self.grid_tex = make_buffer_texture('complexpbr_cluster_grid', 1, Texture.T_int, Texture.F_rg32i)
+        self.indices_tex = make_buffer_texture('complexpbr_cluster_indices', 1024, Texture.T_int, Texture.F_r32i)
+
+        self.configure(dims, None, cutoff)
+        self.enable_on_camera(camera)
+
+        base.task_mgr.add(self.update, task_name, sort=45)
+
+    def configure(self, dims=None, far=None, cutoff=None):
+        if dims is not None:
+            self.dims = tuple(max(1, int(d)) for d in dims)
+            cluster_count = self.dims[0] * self.dims[1] * self.dims[2]
+            self.grid_tex.setup_buffer_texture(cluster_count, Texture.T_int, Texture.F_rg32i, GeomEnums.UH_dynamic)
+            self.dims_input[0] = LVecBase3i(*self.dims)
+        if far is not None:
+            self.far = far
+        if cutoff is not None:
+            self.cutoff = max(1e-6, float(cutoff))
+
+    def enable_on_camera(self, camera):
+        # cameras default to looping over every clustered light, this one bins them per cluster instead
+        override = NodePath('complexpbr_cluster_override')
+        override.set_shader_input('cluster_mode', CLUSTER_MODE_CLUSTERED, priority=1000)
+        cam_node = camera.node()
+        cam_node.set_initial_state(cam_node.get_initial_state().compose(override.get_state()))
+
+    def set_shader_inputs(self, node):
+        node.set_shader_input('cluster_mode', CLUSTER_MODE_ALL)
+        node.set_shader_input('cluster_lights', self.lights_tex)
+        node.set_shader_input('cluster_grid', self.grid_tex)
+        node.set_shader_input('cluster_indices', self.indices_tex)
+        node.set_shader_input('cluster_light_count', self.light_count_input)
+        node.set_shader_input('cluster_dims', self.dims_input)
+        node.set_shader_input('cluster_tile_size', self.tile_size_input)
+        node.set_shader_input('cluster_z_params', self.z_params_input)
+
+    def add_light(self, light_np):
+        if not isinstance(light_np.node(), (PointLight, Spotlight)):
+            print('complexpbr message: only PointLight and Spotlight nodes can be clustered, ' + str(light_np) + ' was ignored.')
+            return
+        if light_np not in self.lights:
+            self.lights.append(light_np)
+
+    def remove_light(self, light_np):
+        if light_np in self.lights:
+            self.lights.remove(light_np)
+
+    def light_radius(self, light, intensity):
+        # distance past which the light adds less than cutoff, mirroring the attenuation in ibl_f.frag
+        att = light.get_attenuation()
+        radius = math.inf
+        if att[2] > 0.0:
+            radius = math.sqrt(max(0.0, intensity / self.cutoff - att[0] - att[1]) / att[2])
+
+        return min(radius, light.get_max_distance())
+
+    def gather_lights(self):
+        # world space, LIGHT_TEXELS texels per light: position + radius, color, spot direction + cos cutoff, attenuation
+        self.lights = [light_np for light_np in self.lights if not light_np.is_empty()]
+        rows = []
+        radii = []
+
+        for light_np in self.lights:
+            light = light_np.node()
+            color = light.get_color()
+            att = light.get_attenuation()
+            radius = self.light_radius(light, max(color[0], color[1], color[2]))
+            pos = light_np.get_pos(base.render)
+
+            if isinstance(light, Spotlight):
+                direction = base.render.get_relative_vector(light_np, (0, 1, 0))
+                cos_cutoff = math.cos(math.radians(light.get_lens().get_fov()[0] * 0.5))
+            else:
+                direction = (0, 0, 0)
+                cos_cutoff = -2.0
+
+            radii.append(radius)
+            rows.append((pos[0], pos[1], pos[2], 0.0 if math.isinf(radius) else radius,
+                         color[0], color[1], color[2], 0.0,
+                         direction[0], direction[1], direction[2], cos_cutoff,
+                         att[0], att[1], att[2], 0.0))
+
+        data = np.array(rows, dtype=np.float32).reshape(len(rows), LIGHT_TEXELS, 4)
+
+        return data, np.array(radii, dtype=np.float64)
+
+    def bin_lights(self, data, radii):
+        # returns per cluster (offset, count) and the flattened light index list
+        tiles_x, tiles_y, slices = self.dims
+        cluster_count = tiles_x * tiles_y * slices
+        lens = self.camera.node().get_lens()
+        near = lens.get_near()
+        far = self.far if self.far is not None else min(lens.get_far(), 1000.0)
+        log_scale = slices / math.log(max(far, near * 1.001) / near)
+        self.z_params = (log_scale, -math.log(near) * log_scale)
+
+        world_to_cam = np.array(base.render.get_mat(self.camera), dtype=np.float64).reshape(4, 4)
+        proj = np.array(lens.get_projection_mat(), dtype=np.float64).reshape(4, 4)
+        centers = (np.hstack((data[:, 0, :3], np.ones((len(data), 1)))) @ world_to_cam)[:, :3]
+        depth = centers[:, 1]
+        unbounded = np.isinf(radii)
+        r = np.where(unbounded, 0.0, radii)
+
+        # depth slices, fragments past the far slice are clamped into it and so are the lights
+        z0 = np.log(np.maximum(depth - r, near)) * log_scale + self.z_params[1]
+        z1 = np.log(np.maximum(depth + r, near)) * log_scale + self.z_params[1]
+        z0 = np.clip(z0.astype(np.int64), 0, slices - 1)
+        z1 = np.clip(z1.astype(np.int64), 0, slices - 1)
+
+        # the projection of each sphere's bounding box bounds its screen footprint
+        offsets = np.array([[x, y, z] for x in (-1, 1) for y in (-1, 1) for z in (-1, 1)], dtype=np.float64)
+        corners = centers[:, None, :] + offsets[None, :, :] * r[:, None, None]
+        clip = np.concatenate((corners, np.ones(corners.shape[:2] + (1,))), axis=2) @ proj
+        ndc = clip[..., :2] / np.maximum(clip[..., 3:4], 1e-6)
+        lo = ndc.min(axis=1) * 0.5 + 0.5
+        hi = ndc.max(axis=1) * 0.5 + 0.5
+        # spheres crossing the near plane cover the whole screen
+        full = unbounded | (depth - r <= near)
+        lo[full] = 0.0
+        hi[full] = 1.0
+        z0[unbounded] = 0
+        z1[unbounded] = slices - 1
+
+        visible = unbounded | ((depth + r >= near) & (lo <= 1.0).all(axis=1) & (hi >= 0.0).all(axis=1))
+        x0 = np.clip((lo[:, 0] * tiles_x).astype(np.int64), 0, tiles_x - 1)
+        x1 = np.clip((hi[:, 0] * tiles_x).astype(np.int64), 0, tiles_x - 1)
+        y0 = np.clip((lo[:, 1] * tiles_y).astype(np.int64), 0, tiles_y - 1)
+        y1 = np.clip((hi[:, 1] * tiles_y).astype(np.int64), 0, tiles_y - 1)
+
+        # expand every light's cluster box into (cluster, light) pairs
+        nx, ny, nz = x1 - x0 + 1, y1 - y0 + 1, z1 - z0 + 1
+        counts = np.where(visible, nx * ny * nz, 0)
+        total = int(counts.sum())
+        if total == 0:
+            return np.zeros((cluster_count, 2), dtype=np.int32), np.zeros(1, dtype=np.int32)
+
+        light_ids = np.repeat(np.arange(len(radii)), counts)
+        local = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+        lnx, lny = nx[light_ids], ny[light_ids]
+        xs = x0[light_ids] + local % lnx
+        ys = y0[light_ids] + (local // lnx) % lny
+        zs = z0[light_ids] + local // (lnx * lny)
+        cluster_ids = xs + tiles_x * (ys + tiles_y * zs)
+
+        order = np.argsort(cluster_ids, kind='stable')
+        cluster_counts = np.bincount(cluster_ids, minlength=cluster_count)
+        grid = np.zeros((cluster_count, 2), dtype=np.int32)
+        grid[1:, 0] = np.cumsum(cluster_counts)[:-1]
+        grid[:, 1] = cluster_counts
+
+        return grid, light_ids[order].astype(np.int32)
+
+    def upload(self, tex, array, texels):
+        # buffers grow in powers of two and never shrink
+        if tex.get_x_size() < texels:
+            tex.setup_buffer_texture(1 << (texels - 1).bit_length(), tex.get_component_type(), tex.get_format(), GeomEnums.UH_dynamic)
+        ram = bytearray(tex.get_x_size() * (array.nbytes // texels))
+        ram[:array.nbytes] = array.tobytes()
+        tex.set_ram_image(bytes(ram))
+
+    def update(self, task):
+        data, radii = self.gather_lights()
+        grid, indices = self.bin_lights(data, radii)
+
+        if len(data):
+            self.upload(self.lights_tex, data, len(data) * LIGHT_TEXELS)
+        self.upload(self.grid_tex, grid, len(grid))
+        self.upload(self.indices_tex, indices, len(indices))
+        self.light_count = len(data)
+        self.index_count = len(indices)
+
+        self.light_count_input[0] = self.light_count
+        self.update_tile_size()
+        self.z_params_input[0] = LVecBase2f(*self.z_params)
+
+        return task.cont
+
+    def update_tile_size(self):
+        # gl_FragCoord is in pixels of the screenspace scene buffer when there is one, of the window otherwise
+        if getattr(base, 'complexpbr_screenspace_init', False):
+            x_size, y_size = scene_buffer_size(base.complexpbr_filter_manager)
+        else:
+            x_size, y_size = base.win.get_x_size(), base.win.get_y_size()
+        self.tile_size_input[0] = LVecBase2f(x_size / self.dims[0], y_size / self.dims[1])
+
+    def destroy(self):
+        base.task_mgr.remove(self.task_name)
@@ -0,0 +1,17 @@
+#version 430
+
+// the scene depth as a linear view distance, written once per frame for the SSAO pass to read with screenspace_init(linear_depth=True)
+
+uniform sampler2D depth_tex;
+uniform float cameraNear;
+uniform float cameraFar;
+
+in vec2 texcoord;
+
+out vec4 o_color;
+
+void main()
+{
+    float z_ndc = textureLod(depth_tex, texcoord, 0.0).r * 2.0 - 1.0;
+    o_color = vec4(2.0 * cameraNear * cameraFar / (cameraFar + cameraNear - z_ndc * (cameraFar - cameraNear)));
+}
@@ -1,32 +1,46 @@
 #version 430
+// @slot defines
+
+// effects with a live pass in the render graph, screenspace_init() recompiles this shader when they change
+#ifndef SSAO
+    #define SSAO 0
+#endif
+
+#ifndef SSR
+    #define SSR 0
+#endif
+
+#ifndef BLOOM
+    #define BLOOM 0
+#endif
+
+#ifndef TAA
+    #define TAA 0
+#endif
 
 uniform sampler2D scene_tex;  // albedo
 uniform sampler2D depth_tex;  // depth
-uniform sampler2D normal_tex;  // normal
+uniform sampler2D normal_tex;  // packed view space normal, see packViewNormal() in ibl_f.frag
 uniform vec2 window_size;
-uniform mat4 p3d_ViewMatrix;
-uniform mat4 p3d_ProjectionMatrixInverse;
 
 // SSAO
 uniform float ssao_radius = 0.5;
 uniform float ssao_bias = 0.25;
 uniform int ssao_samples;
 uniform float ssao_intensity;
+uniform sampler2D ssao_tex;  // blurred reduced-resolution SSAO, see complexpbr/screenspace.py
 
 // Bloom
 uniform float bloom_intensity;
 uniform float bloom_threshold;
 uniform int bloom_blur_width;
 uniform int bloom_samples;
+uniform sampler2D bloom_tex;  // downsampled bloom pyramid, see complexpbr/screenspace.py
 
 // SSR
 uniform float ssr_intensity;
-uniform float ssr_step;
-uniform float ssr_fresnel_pow;
 uniform int ssr_samples;
-uniform float screen_ray_factor;
-uniform float ssr_depth_cutoff;
-uniform float ssr_depth_min;
+uniform sampler2D ssr_tex;  // premultiplied reduced-resolution reflections, see complexpbr/screenspace.py
 
 // HSV
 uniform float hsv_r = 1.0;
@@ -42,12 +56,9 @@ uniform float reflection_threshold;
 
 // final brightness factor
 uniform float final_brightness;
+// @slot uniforms
 
 in vec2 texcoord;
-in vec3 tbn_tangent;
-in vec3 tbn_bitangent;
-in vec3 tbn_normal;
-in vec3 vertex_pos_view;
 
 out vec4 o_color;
 
@@ -68,18 +79,6 @@ float hash(float n)
     return fract(sin(n) * 43758.5453);
 }
 
-vec3 randomSample(int i, vec2 uv)
-{
-    float r1 = hash(float(i) + 1.0 + uv.x * uv.y * 1000.0);
-    float r2 = hash(float(i) + 21.0 + uv.y * uv.x * 1000.0);
-
-    float phi = 2.0 * 3.14159265 * r1;
-    float cosTheta = 1.0 - r2;
-    float sinTheta = sqrt(1.0 - cosTheta * cosTheta);
-
-    return vec3(cos(phi) * sinTheta, sin(phi) * sinTheta, cosTheta);
-}
-
 float normalBlur(in float x, in float sig)
 {
     return 0.3989*exp(-0.5*x*x/(sig*sig))/sig;
@@ -90,99 +89,35 @@ float luminance(vec3 color)
     return dot(color, vec3(0.299, 0.587, 0.114));
 }
 
-struct SSRout {
-    vec3 color;
-    float intensity;
-};
-
-SSRout screenSpaceReflection(vec2 uv, float linearDepth, vec3 normal)
-{
-    vec3 viewPos = vec3(uv, linearDepth);
-    viewPos = (p3d_ProjectionMatrixInverse * vec4(viewPos, 1.0)).xyz;
-    vec3 reflect_color = vec3(0.0);
-
-    vec3 reflectedRay = reflect(viewPos, normal);
-    vec3 screenSpaceRay = (p3d_ProjectionMatrixInverse * vec4(reflectedRay, 0.0)).xyz;
-    screenSpaceRay.xy /= screenSpaceRay.z;
-
-    vec2 rayStep = screenSpaceRay.xy * screen_ray_factor;
-    vec2 rayPosition = uv;
-
-    for (int i = 0; i < ssr_samples; i++)
-    {
-        rayPosition -= rayStep;
-
-        float depth = 1.0 - texture(depth_tex, rayPosition).r + 0.5;
-        vec3 position = vec3(rayPosition * 2.0 - 1.0, depth);
-        position = (p3d_ProjectionMatrixInverse * vec4(position, 1.0)).xyz;
-
-        if (abs(viewPos.z - position.z) < ssr_step)
-        {   
-            if (depth <= ssr_depth_cutoff)
-            {
-                if (depth >= ssr_depth_min)
-                {
-                    float fresnel = pow(1.0 - dot(normal, normalize(viewPos)), ssr_fresnel_pow);
-                    vec3 color = texture(scene_tex, rayPosition).rgb;
-                    reflect_color = mix(reflect_color, color, fresnel);
-                }
-            }
-        }
-    }
-
-    SSRout result;
-    result.color = reflect_color;
-    result.intensity = ssr_intensity;
-    return result;
-}
-
-float ssao(in vec2 uv, in vec3 viewPos, in vec3 viewNormal) {
-    float occlusion = 0.0;
-    for (int i = 0; i < ssao_samples; ++i) {
-        vec3 randVec = randomSample(i, uv);
-        vec3 offset = viewNormal * randVec.z + vec3(randVec.xy * vec2(ssao_radius), 0.0);
-        vec3 samplePos = viewPos + offset;
-
-        vec4 proj = p3d_ProjectionMatrixInverse * vec4(samplePos, 1.0);
-        proj.xyz /= proj.w;
-        vec2 sampleUV = proj.xy * 0.5 + 0.5;
-
-        float depth = 1.0 - texture(depth_tex, sampleUV).r + 0.5;
-
-        vec4 clip = vec4(sampleUV, depth, 1.0);
-        vec4 viewPosSample = p3d_ProjectionMatrixInverse * clip;
-        viewPosSample.xyz /= viewPosSample.w;
-
-        float hidden = (samplePos.z > viewPosSample.z - ssao_bias) ? ssao_intensity : 0.0;
-        occlusion += hidden;
-    }
-    return 1.0 - occlusion / float(ssao_samples);
-}
-
-vec3 getViewPos(vec2 uv, float depth)
-{
-    vec3 viewPos = vec3(uv * 2.0 - 1.0, depth);
-    vec4 worldPos = p3d_ProjectionMatrixInverse * vec4(viewPos, 1.0);
-
-    return worldPos.xyz / worldPos.w;
-}
-
-mat3 getNormalMatrix(mat4 viewMatrix) 
-{
-    return transpose(inverse(mat3(viewMatrix)));
-}
-
-vec3 transformNormalToViewSpace(vec3 tangentSpaceNormal) 
+float linearizeDepth(float depth)
 {
-    return normalize(getNormalMatrix(p3d_ViewMatrix) * tangentSpaceNormal);
+    float z_ndc = depth * 2.0 - 1.0;
+    return 2.0 * cameraNear * cameraFar / (cameraFar + cameraNear - z_ndc * (cameraFar - cameraNear));
 }
 
-vec3 getViewNormal(vec3 tbn_tangent, vec3 tbn_bitangent, vec3 tbn_normal) 
+float upsampleSSAO(vec2 uv)
 {
-    vec3 normalTex = texture(normal_tex, texcoord).rgb * 2.0 - 1.0;
-    vec3 tangentSpaceNormal = normalize(tbn_tangent * normalTex.x + tbn_bitangent * normalTex.y + tbn_normal * normalTex.z);
+    // joint bilateral upsample, the 4 nearest low-res texels weighted by how well their depth matches
+    ivec2 size = textureSize(ssao_tex, 0);
+    vec2 coord = uv * vec2(size) - 0.5;
+    ivec2 base_texel = ivec2(floor(coord));
+    vec2 f = fract(coord);
+    float depth = linearizeDepth(texture(depth_tex, uv).r);
+
+    float ao_sum = 0.0;
+    float weight_sum = 0.0;
+
+    for (int i = 0; i < 4; ++i) {
+        ivec2 offset = ivec2(i & 1, i >> 1);
+        vec4 tap = texelFetch(ssao_tex, clamp(base_texel + offset, ivec2(0), size - 1), 0);
+        vec2 bilinear = mix(1.0 - f, f, vec2(offset));
+        float weight = bilinear.x * bilinear.y / (0.0001 + abs(tap.y - depth) / max(depth, 0.0001));
+
+        ao_sum += tap.x * weight;
+        weight_sum += weight;
+    }
 
-    return normalize(transformNormalToViewSpace(tangentSpaceNormal));
+    return ao_sum / max(weight_sum, 0.0001);
 }
 
 vec3 rgb2hsv(vec3 c) {
@@ -213,29 +148,15 @@ vec3 bloomAA(vec3 color, vec2 uv)
     vec3 aa_contrib = vec3(0.0);
     vec2 texelSize = 1.0 / window_size;
     int aaBlurWidth = 10;
-    float totalBlurWeight = 0.0;
 
-    if (bloom_intensity > 0)
-    {
-        for (int i = -bloom_samples; i <= bloom_samples; ++i)
-        {
-            for (int j = -bloom_samples; j <= bloom_samples; ++j)
-            {
-                vec2 offset = vec2(i, j) * texelSize;
-                vec3 bloom_sample = texture(scene_tex, uv + offset).rgb;
-
-                float brightness_value = brightness(bloom_sample);
-                float intensity = brightness_value > bloom_threshold ? brightness_value : 0.0;
-                float blur = normalBlur(length(offset), bloom_blur_width);
-                bloom += bloom_sample * intensity * bloom_intensity * blur;
-                totalBlurWeight += blur;
-            }
-        }
+#if BLOOM
+    bloom = texture(bloom_tex, uv).rgb * bloom_intensity;
+#endif
 
-        // normalize bloom effect
-        bloom /= totalBlurWeight;
-    }
-    
+    // temporal AA replaces the edge blur, scene_tex is the resolved history while it is on
+#if TAA
+    return color + bloom;
+#else
     // AA loop
     mat3 Inter;
     
@@ -270,32 +191,34 @@ vec3 bloomAA(vec3 color, vec2 uv)
     vec3 combined = color + bloom + aa_contrib;
 
     return combined;
+#endif
 }
 
+// @slot functions
+
 void main() {
     vec3 color = texture(scene_tex, texcoord).rgb;
-    vec4 depth = texture(depth_tex, texcoord);
-    float depth_fl = 1.0 - depth.r + 0.5;
-    vec3 viewPos = getViewPos(texcoord, depth_fl);
-    vec3 worldNormal = getViewNormal(tbn_tangent, tbn_bitangent, tbn_normal);
-    vec3 viewNormal = transformNormalToViewSpace(worldNormal);
 
-    SSRout ssrOut = screenSpaceReflection(texcoord, depth_fl, viewNormal);
+#if SSR
     // blend the object color with the reflection color based on the intensity
-    color = mix(color, ssrOut.color, max(ssrOut.intensity - reflection_threshold, 0.0));
+    vec4 ssr = texture(ssr_tex, texcoord);
+    float ssr_blend = max(ssr_intensity - reflection_threshold, 0.0);
+    color = color * (1.0 - ssr.a * ssr_blend) + ssr.rgb * ssr_blend;
+#endif
 
+#if SSAO
     // apply SSAO to the final color
-    if (ssao_samples > 0)
-    {
-    	float app_occlusion = ssao(texcoord, viewPos, viewNormal);
-    	color *= app_occlusion;
-    }
+    float app_occlusion = upsampleSSAO(texcoord);
+    color *= app_occlusion;
+#endif
     // combined bloom/AA loop
     color = bloomAA(color, texcoord);
 
     vec3 hsvColor = rgb2hsv(color);
     hsvColor *= vec3(hsv_r, hsv_g, hsv_b);
     color = hsv2rgb(hsvColor);
+
+    // @slot main_end
     
     o_color = vec4(color * vec3(final_brightness), 1.0);
 }
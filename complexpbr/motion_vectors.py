@@ -0,0 +1,118 @@
+from panda3d.core import LVecBase2f, LMatrix4f, PTA_int, PTA_LMatrix4f
+from .screenspace import scene_buffer_size
+
+
+# sub-pixel camera jitter sequence length, see MotionVectors.set_jitter()
+JITTER_PHASES = 8
+
+def halton(index, radix):
+    result = 0.0
+    fraction = 1.0 / radix
+    while index > 0:
+        result += fraction * (index % radix)
+        index //= radix
+        fraction /= radix
+
+    return result
+
+class MotionVectors:
+    def __init__(self, camera, task_name='complexpbr_motion_vectors'):
+        # unjittered world to clip transforms of this frame and the last, which ibl_v.vert turns into
+        # per-pixel screen motion; GeomNodes below add_node() nodes also move their last frame's position by
+        # their own motion, the rest only move with the camera
+        self.camera = camera
+        self.task_name = task_name
+        self.jitter = False
+        self.film_offset = None
+        self.frame_index = 0
+        self.nodes = []
+        self.inputs = {}
+
+        self.view_projection_input = PTA_LMatrix4f.empty_array(1)
+        self.prev_view_projection_input = PTA_LMatrix4f.empty_array(1)
+        self.frame_index_input = PTA_int.empty_array(1)
+        self.view_projection_input[0] = self.view_projection()
+        self.prev_view_projection_input[0] = self.view_projection_input[0]
+        self.static_motion_input = PTA_LMatrix4f.empty_array(1)
+        self.static_motion_input[0] = LMatrix4f.ident_mat()
+
+        # after user tasks move the camera, before the screenspace passes read the lens
+        base.task_mgr.add(self.update, task_name, sort=44)
+
+    def set_shader_inputs(self, node):
+        node.set_shader_input('view_projection', self.view_projection_input)
+        node.set_shader_input('prev_view_projection', self.prev_view_projection_input)
+        node.set_shader_input('object_motion', self.static_motion_input)
+
+    def add_node(self, node):
+        # every GeomNode below node gets its world transform of the last frame, IE for moving props and characters
+        if node not in self.nodes:
+            self.nodes.append(node)
+        for geom_np in node.find_all_matches('**/+GeomNode'):
+            if geom_np not in self.inputs:
+                motion_input = PTA_LMatrix4f.empty_array(1)
+                motion_input[0] = LMatrix4f.ident_mat()
+                geom_np.set_shader_input('object_motion', motion_input)
+                self.inputs[geom_np] = [motion_input, geom_np.get_mat(base.render)]
+
+    def remove_node(self, node):
+        if node in self.nodes:
+            self.nodes.remove(node)
+        for geom_np in node.find_all_matches('**/+GeomNode'):
+            if geom_np in self.inputs:
+                del self.inputs[geom_np]
+                geom_np.clear_shader_input('object_motion')
+
+    def view_projection(self):
+        return base.render.get_mat(self.camera) * self.camera.node().get_lens().get_projection_mat()
+
+    def set_jitter(self, jitter):
+        # sub-pixel film offsets for temporal AA, the lens gets its own offset back when disabled
+        if jitter == self.jitter:
+            return
+        self.jitter = jitter
+
+        lens = self.camera.node().get_lens()
+        if jitter:
+            self.film_offset = LVecBase2f(lens.get_film_offset())
+        else:
+            lens.set_film_offset(self.film_offset)
+
+    def update(self, task):
+        lens = self.camera.node().get_lens()
+        if self.jitter:
+            lens.set_film_offset(self.film_offset)
+
+        self.prev_view_projection_input[0] = self.view_projection_input[0]
+        self.view_projection_input[0] = self.view_projection()
+        self.frame_index += 1
+        self.frame_index_input[0] = self.frame_index
+
+        # this frame's world space to the last frame's, for each tracked GeomNode
+        for geom_np in [geom_np for geom_np in self.inputs if geom_np.is_empty()]:
+            del self.inputs[geom_np]
+        for geom_np, entry in self.inputs.items():
+            motion_input, prev_mat = entry
+            mat = geom_np.get_mat(base.render)
+            motion_input[0] = base.render.get_mat(geom_np) * prev_mat
+            entry[1] = mat
+
+        if self.jitter:
+            phase = self.frame_index % JITTER_PHASES + 1
+            film_size = lens.get_film_size()
+            # a pixel of the scene buffer, which renders below the window size at lower quality tiers
+            if getattr(base, 'complexpbr_screenspace_init', False):
+                x_size, y_size = scene_buffer_size(base.complexpbr_filter_manager)
+            else:
+                x_size, y_size = base.win.get_x_size(), base.win.get_y_size()
+            jitter = LVecBase2f((halton(phase, 2) - 0.5) * film_size[0] / x_size,
+                                (halton(phase, 3) - 0.5) * film_size[1] / y_size)
+            lens.set_film_offset(self.film_offset + jitter)
+
+        return task.cont
+
+    def destroy(self):
+        self.set_jitter(False)
+        base.task_mgr.remove(self.task_name)
+        for node in list(self.nodes):
+            self.remove_node(node)
@@ -0,0 +1,104 @@
+import hashlib
+import os
+from pathlib import Path
+from panda3d.core import Shader
+from .brdf_lut import default_cache_dir
+
+
+def driver_signature(gsg):
+    # a program binary is only good for the driver that linked it
+    return '|'.join((gsg.get_driver_vendor(), gsg.get_driver_renderer(), gsg.get_driver_version(),
+                     str(gsg.get_driver_shader_version_major()) + '.' + str(gsg.get_driver_shader_version_minor())))
+
+class ProgramCache:
+    def __init__(self, cache_dir=None, task_name='complexpbr_program_cache'):
+        # linked GL programs on disk, keyed by the shader cache key and the driver; Panda hands out the binary through
+        # the bam form of a Shader with set_cache_compiled_shader(True), and links from it instead of the source
+        self.cache_dir = Path(cache_dir) if cache_dir is not None else default_cache_dir() / 'programs'
+        self.task_name = task_name
+        self.driver_key = None
+        # shaders made this session, written out once the GSG has linked them
+        self.pending = []
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.skipped = 0
+
+        # after igLoop, when this frame's shaders have been linked
+        base.task_mgr.add(self.update, task_name, sort=55)
+
+    def program_path(self, key):
+        if self.driver_key is None:
+            self.driver_key = driver_signature(base.win.get_gsg())
+        digest = hashlib.sha1((key + '\0' + self.driver_key).encode('utf-8')).hexdigest()
+
+        return self.cache_dir / ('program_' + digest + '.bam')
+
+    def load(self, key):
+        path = self.program_path(key)
+        shader = None
+        if path.is_file():
+            try:
+                shader = Shader.decode_from_bam_stream(path.read_bytes())
+            except (OSError, AssertionError):
+                shader = None
+
+        if shader is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        shader.set_cache_compiled_shader(True)
+
+        return shader
+
+    def add(self, key, shader):
+        if self.program_path(key).with_suffix('.skip').is_file():
+            return
+        # the size of the source-only bam form tells whether a binary was added to it once linked
+        shader.set_cache_compiled_shader(True)
+        self.pending.append((key, shader, len(shader.encode_to_bam_stream())))
+
+    def write(self, key, shader, source_size):
+        try:
+            data = shader.encode_to_bam_stream()
+        except AssertionError:
+            # bam strings are limited to 64 KiB, which some drivers' program binaries exceed
+            data = None
+        path = self.program_path(key)
+        if data is None or len(data) <= source_size:
+            # no binary to keep, or none the driver gave; the marker stops later runs from trying again
+            self.skipped += 1
+            data = b''
+            path = path.with_suffix('.skip')
+
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_suffix('.tmp')
+            tmp_path.write_bytes(data)
+            os.replace(tmp_path, path)
+            self.writes += int(len(data) > 0)
+        except OSError:
+            print('complexpbr message: could not write the program cache to ' + str(self.cache_dir))
+
+    def update(self, task):
+        if not self.pending:
+            return task.cont
+
+        prepared_objects = base.win.get_gsg().get_prepared_objects()
+        waiting = []
+        for key, shader, source_size in self.pending:
+            if prepared_objects.is_shader_prepared(shader):
+                self.write(key, shader, source_size)
+            else:
+                waiting.append((key, shader, source_size))
+        self.pending = waiting
+
+        return task.cont
+
+    def clear(self):
+        for path in self.cache_dir.glob('program_*') if self.cache_dir.is_dir() else ():
+            path.unlink()
+
+    def destroy(self):
+        base.task_mgr.remove(self.task_name)
@@ -0,0 +1,15 @@
+#version 430
+
+// shared vertex stage of the screenspace passes, a FilterManager fullscreen quad
+
+uniform mat4 p3d_ModelViewProjectionMatrix;
+
+in vec4 p3d_Vertex;
+in vec2 p3d_MultiTexCoord0;
+
+out vec2 texcoord;
+
+void main() {
+    texcoord = p3d_MultiTexCoord0;
+    gl_Position = p3d_ModelViewProjectionMatrix * p3d_Vertex;
+}
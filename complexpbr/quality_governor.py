@@ -0,0 +1,169 @@
+from collections import deque
+from panda3d.core import ClockObject
+from .screenspace import shader_input_value, scene_buffer_size
+
+
+# lowest first; samples scale the ssao/ssr/bloom sample counts set on screen_quad, render_scale the scene buffer
+# and cube_faces_per_frame the cubemap capture, see CubemapScheduler
+QUALITY_TIERS = (
+    {'render_scale': 0.5, 'samples': 0.25, 'cube_faces_per_frame': 1},
+    {'render_scale': 0.75, 'samples': 0.5, 'cube_faces_per_frame': 2},
+    {'render_scale': 1.0, 'samples': 0.75, 'cube_faces_per_frame': 3},
+    {'render_scale': 1.0, 'samples': 1.0, 'cube_faces_per_frame': 6},
+)
+GOVERNED_SAMPLES = ('ssao_samples', 'ssr_samples', 'bloom_samples')
+
+class QualityGovernor:
+    def __init__(self, target_ms=16.6, tiers=QUALITY_TIERS, window=30, down_delay=0.5, up_delay=3.0,
+                 down_margin=1.05, up_margin=0.8, task_name='complexpbr_quality_governor'):
+        # steps down a tier once the average frame time has stayed above target_ms * down_margin for down_delay
+        # seconds, and back up after up_delay seconds below target_ms * up_margin
+        self.clock = ClockObject.get_global_clock()
+        self.task_name = task_name
+        self.tiers = list(tiers)
+        self.tier = len(self.tiers) - 1
+        self.frame_times = deque(maxlen=window)
+        self.callbacks = []
+        self.enabled = False
+        self.over_since = None
+        self.under_since = None
+        self.tier_changes = 0
+        # the user's own settings, which the tiers scale, and what was last written over them
+        self.baseline = {}
+        self.written = {}
+        self.baseline_faces = None
+        self.baseline_scale = None
+
+        self.target_ms = target_ms
+        self.down_delay = down_delay
+        self.up_delay = up_delay
+        self.down_margin = down_margin
+        self.up_margin = up_margin
+
+    def configure(self, target_ms=None, tiers=None, down_delay=None, up_delay=None):
+        if target_ms is not None:
+            self.target_ms = max(0.1, float(target_ms))
+        if tiers is not None:
+            self.tiers = list(tiers)
+            if self.enabled:
+                self.set_tier(min(self.tier, len(self.tiers) - 1), force=True)
+            else:
+                self.tier = len(self.tiers) - 1
+        if down_delay is not None:
+            self.down_delay = max(0.0, float(down_delay))
+        if up_delay is not None:
+            self.up_delay = max(0.0, float(up_delay))
+        self.reset_window()
+
+    def start(self):
+        if self.enabled:
+            return
+        self.enabled = True
+        self.read_baseline()
+        self.reset_window()
+        base.task_mgr.add(self.update, self.task_name, sort=5)
+
+    def stop(self):
+        # the user's settings come back
+        if not self.enabled:
+            return
+        self.enabled = False
+        base.task_mgr.remove(self.task_name)
+        self.apply({'render_scale': 1.0, 'samples': 1.0, 'cube_faces_per_frame': None})
+        self.tier = len(self.tiers) - 1
+
+    def add_callback(self, callback):
+        # callback(governor, tier) after every tier change, IE to scale LODs or particle counts along
+        self.callbacks.append(callback)
+
+    def remove_callback(self, callback):
+        if callback in self.callbacks:
+            self.callbacks.remove(callback)
+
+    def read_baseline(self):
+        if getattr(base, 'complexpbr_screenspace_init', False):
+            for name in GOVERNED_SAMPLES:
+                self.baseline[name] = int(shader_input_value(base.screen_quad, name))
+            self.baseline_scale = base.complexpbr_filter_manager.sizes[0]
+        self.baseline_faces = base.complexpbr_cube_scheduler.faces_per_frame
+
+    def reset_window(self):
+        self.frame_times.clear()
+        self.over_since = None
+        self.under_since = None
+
+    def set_tier(self, tier, force=False):
+        tier = max(0, min(len(self.tiers) - 1, int(tier)))
+        if tier == self.tier and not force:
+            return
+        self.tier = tier
+        self.tier_changes += 1
+        self.apply(self.tiers[tier])
+        self.reset_window()
+        for callback in list(self.callbacks):
+            callback(self, tier)
+
+    def apply(self, settings):
+        if self.baseline_faces is None:
+            self.read_baseline()
+        if getattr(base, 'complexpbr_screenspace_init', False):
+            samples = settings.get('samples', 1.0)
+            for name in GOVERNED_SAMPLES:
+                current = int(shader_input_value(base.screen_quad, name))
+                if current != self.written.get(name, current):
+                    # changed by hand since the last tier, that is the new full quality value
+                    self.baseline[name] = current
+                full = self.baseline.get(name, current)
+                # an effect that is off stays off
+                value = max(1, int(round(full * samples))) if full > 0 else 0
+                base.screen_quad.set_shader_input(name, value)
+                self.written[name] = value
+            self.set_render_scale(settings.get('render_scale', 1.0))
+
+        faces = settings.get('cube_faces_per_frame')
+        base.complexpbr_cube_scheduler.configure(faces_per_frame=self.baseline_faces if faces is None else min(faces, self.baseline_faces))
+
+    def set_render_scale(self, scale):
+        # the scene buffer (the first FilterManager buffer) renders at scale times the window, screen_quad upsamples
+        filter_manager = base.complexpbr_filter_manager
+        mul, div, align = self.baseline_scale or (1, 1, 1)
+        if filter_manager.sizes[0] == (mul * scale, div, align):
+            return
+        filter_manager.sizes[0] = (mul * scale, div, align)
+        filter_manager.resize_buffers()
+        x_size, y_size = scene_buffer_size(filter_manager)
+        base.screen_quad.set_shader_input('window_size', [x_size, y_size])
+        # the depth pyramid and the light cluster tiles follow the scene buffer
+        base.complexpbr_hiz.resize()
+        base.complexpbr_light_clusters.update_tile_size()
+
+    @property
+    def average_ms(self):
+        return sum(self.frame_times) / len(self.frame_times) * 1000.0 if self.frame_times else 0.0
+
+    def update(self, task):
+        self.frame_times.append(self.clock.get_dt())
+        if len(self.frame_times) < self.frame_times.maxlen:
+            return task.cont
+
+        frame_time = self.clock.get_frame_time()
+        average_ms = self.average_ms
+        if average_ms > self.target_ms * self.down_margin:
+            self.under_since = None
+            self.over_since = frame_time if self.over_since is None else self.over_since
+            if frame_time - self.over_since >= self.down_delay and self.tier > 0:
+                self.set_tier(self.tier - 1)
+        elif average_ms < self.target_ms * self.up_margin:
+            self.over_since = None
+            self.under_since = frame_time if self.under_since is None else self.under_since
+            if frame_time - self.under_since >= self.up_delay and self.tier < len(self.tiers) - 1:
+                self.set_tier(self.tier + 1)
+        else:
+            # inside the band, hold the tier
+            self.over_since = None
+            self.under_since = None
+
+        return task.cont
+
+    def destroy(self):
+        self.stop()
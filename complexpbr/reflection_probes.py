@@ -0,0 +1,213 @@
+import numpy as np
+from panda3d.core import ClockObject, LVecBase3f, LVecBase4f, PTA_LVecBase3f, PTA_LVecBase4f
+from .cubemap_scheduler import CubemapScheduler
+from .env_prefilter import EnvPrefilter
+from .sh_irradiance import ShIrradiance
+from .capture_filter import PROBE_CAPTURE_MASK
+
+
+PROBE_BLEND_MODES = ('nearest', 'blend')
+
+class ReflectionProbe:
+    def __init__(self, name, pos, size, static=True, resolution=128, parallax=True, update_mode='always',
+                 levels=5, sample_count=32, shader_dir=None):
+        # a cube capture at a fixed world position, shading the GeomNodes inside its box
+        self.name = name
+        self.static = static
+        self.parallax = parallax
+        self.rig = base.render.attach_new_node(name)
+        self.rig.set_pos(pos)
+        self.set_size(size)
+
+        # the rig keeps world axes, so the probe is sampled with world space directions
+        self.cube_buffer = base.win.make_cube_map(name, resolution, self.rig)
+        for i in range(self.cube_buffer.get_num_display_regions()):
+            camera_np = self.cube_buffer.get_display_region(i).get_camera()
+            if not camera_np.is_empty():
+                camera_np.node().set_camera_mask(PROBE_CAPTURE_MASK)
+
+        cube_tex = self.cube_buffer.get_texture()
+        # static probes capture once and then only on capture()
+        self.scheduler = CubemapScheduler(self.cube_buffer, self.rig, mode='manual' if static else update_mode,
+                                          task_name=name + '_scheduler')
+        self.prefilter = EnvPrefilter(cube_tex, size=resolution, levels=levels, sample_count=sample_count,
+                                      shader_dir=shader_dir, task_name=name + '_prefilter')
+        self.sh_irradiance = ShIrradiance(cube_tex, update_hz=1000.0, smoothing=0.0, shader_dir=shader_dir,
+                                          task_name=name + '_sh_irradiance')
+        self.scheduler.add_capture_callback(self.prefilter.on_capture)
+        self.scheduler.add_capture_callback(self.sh_irradiance.on_capture)
+
+    @property
+    def env_tex(self):
+        return self.prefilter.env_tex
+
+    def set_size(self, size):
+        self.size = LVecBase3f(*size)
+        pos = self.rig.get_pos(base.render)
+        self.box_min = pos - self.size * 0.5
+        self.box_max = pos + self.size * 0.5
+
+    def set_static(self, static, update_mode='always'):
+        self.static = static
+        self.scheduler.configure(mode='manual' if static else update_mode)
+
+    def capture(self):
+        self.scheduler.capture_now()
+
+    def influence(self, point, blend_distance):
+        # 1 well inside the box, falling to 0 at its faces over blend_distance, negative outside
+        inside = min(min(point[i] - self.box_min[i], self.box_max[i] - point[i]) for i in range(3))
+
+        return min(1.0, inside / blend_distance) if blend_distance > 0.0 else (1.0 if inside >= 0.0 else inside)
+
+    def destroy(self):
+        for part in (self.scheduler, self.prefilter, self.sh_irradiance):
+            part.destroy()
+        base.graphicsEngine.remove_window(self.cube_buffer)
+        self.rig.remove_node()
+
+class ProbeInputs:
+    def __init__(self):
+        # one set of inputs per GeomNode, updated in place so reassignment does not touch the node's state
+        self.probes = None
+        self.position = PTA_LVecBase4f.empty_array(2)
+        self.box_min = PTA_LVecBase3f.empty_array(2)
+        self.box_max = PTA_LVecBase3f.empty_array(2)
+        self.sh = PTA_LVecBase3f.empty_array(9)
+
+class ReflectionProbes:
+    def __init__(self, levels=5, sample_count=32, update_hz=4.0, blend_distance=1.0, shader_dir=None,
+                 task_name='complexpbr_reflection_probes'):
+        self.levels = levels
+        self.sample_count = sample_count
+        self.update_hz = update_hz
+        self.blend_distance = blend_distance
+        self.shader_dir = shader_dir
+        self.clock = ClockObject.get_global_clock()
+        self.task_name = task_name
+        self.probes = []
+        self.nodes = []
+        self.inputs = {}
+        self.last_update_time = None
+
+        self.empty_position = PTA_LVecBase4f.empty_array(2)
+        self.empty_box = PTA_LVecBase3f.empty_array(2)
+        self.empty_sh = PTA_LVecBase3f.empty_array(9)
+
+        base.task_mgr.add(self.update, task_name, sort=48)
+
+    def set_shader_inputs(self, node, env_tex):
+        # the defaults under every shaded node, no probes
+        node.set_shader_input('probe_count', 0)
+        node.set_shader_input('probe_env_0', env_tex)
+        node.set_shader_input('probe_env_1', env_tex)
+        node.set_shader_input('probe_max_lod', float(self.levels - 1))
+        node.set_shader_input('probe_position', self.empty_position)
+        node.set_shader_input('probe_box_min', self.empty_box)
+        node.set_shader_input('probe_box_max', self.empty_box)
+        node.set_shader_input('probe_sh', self.empty_sh)
+
+    def configure(self, update_hz=None, blend_distance=None):
+        if update_hz is not None:
+            self.update_hz = max(0.001, float(update_hz))
+        if blend_distance is not None:
+            self.blend_distance = max(0.0, float(blend_distance))
+        self.last_update_time = None
+
+    def add_probe(self, pos, size, static=True, resolution=128, parallax=True, update_mode='always'):
+        probe = ReflectionProbe('complexpbr_probe_' + str(len(self.probes)) + '_' + str(id(self)), pos, size, static,
+                                resolution, parallax, update_mode, self.levels, self.sample_count, self.shader_dir)
+        self.probes.append(probe)
+        self.last_update_time = None
+
+        return probe
+
+    def remove_probe(self, probe):
+        if probe in self.probes:
+            self.probes.remove(probe)
+            # nodes shaded by probe go back to the defaults until the next update picks from the remaining probes
+            for geom_np in [geom_np for geom_np, inputs in self.inputs.items() if inputs.probes and probe in inputs.probes]:
+                self.clear_inputs(geom_np)
+            probe.destroy()
+            self.last_update_time = None
+
+    def add_node(self, node, mode='blend'):
+        # every GeomNode below node picks its probes from the center of its bounds
+        if mode not in PROBE_BLEND_MODES:
+            raise ValueError('unknown probe mode ' + repr(mode) + ', expected one of ' + str(PROBE_BLEND_MODES))
+        self.nodes = [entry for entry in self.nodes if entry[0] != node] + [(node, mode)]
+        self.last_update_time = None
+
+    def remove_node(self, node):
+        self.nodes = [entry for entry in self.nodes if entry[0] != node]
+        for geom_np in node.find_all_matches('**/+GeomNode'):
+            if geom_np in self.inputs:
+                self.clear_inputs(geom_np)
+
+    def clear_inputs(self, geom_np):
+        del self.inputs[geom_np]
+        for name in ('probe_count', 'probe_env_0', 'probe_env_1', 'probe_position', 'probe_box_min', 'probe_box_max', 'probe_sh'):
+            geom_np.clear_shader_input(name)
+
+    def pick_probes(self, point, mode):
+        weighted = sorted(((probe.influence(point, self.blend_distance), probe) for probe in self.probes),
+                          key=lambda entry: -entry[0])
+        if mode == 'nearest' or weighted[0][0] <= 0.0:
+            # outside every box the nearest probe still beats the camera rig's environment
+            return [(1.0, weighted[0][1])]
+
+        picked = [entry for entry in weighted[:2] if entry[0] > 0.0]
+        total = sum(weight for weight, probe in picked)
+
+        return [(weight / total, probe) for weight, probe in picked]
+
+    def assign(self, geom_np, picked):
+        inputs = self.inputs.get(geom_np)
+        if inputs is None:
+            inputs = self.inputs[geom_np] = ProbeInputs()
+            geom_np.set_shader_input('probe_position', inputs.position)
+            geom_np.set_shader_input('probe_box_min', inputs.box_min)
+            geom_np.set_shader_input('probe_box_max', inputs.box_max)
+            geom_np.set_shader_input('probe_sh', inputs.sh)
+
+        probes = tuple(probe for weight, probe in picked)
+        if probes != inputs.probes:
+            inputs.probes = probes
+            geom_np.set_shader_input('probe_count', len(probes))
+            geom_np.set_shader_input('probe_env_0', probes[0].env_tex)
+            geom_np.set_shader_input('probe_env_1', probes[-1].env_tex)
+
+        sh = np.zeros((9, 3))
+        for slot, (weight, probe) in enumerate(picked):
+            inputs.position[slot] = LVecBase4f(probe.rig.get_pos(base.render), weight)
+            # an empty box turns the parallax correction off
+            inputs.box_min[slot] = probe.box_min if probe.parallax else LVecBase3f(0, 0, 0)
+            inputs.box_max[slot] = probe.box_max if probe.parallax else LVecBase3f(0, 0, 0)
+            sh += probe.sh_irradiance.current * weight
+        for i in range(9):
+            inputs.sh[i] = LVecBase3f(*sh[i])
+
+    def update(self, task):
+        if not self.probes or not self.nodes:
+            return task.cont
+
+        frame_time = self.clock.get_frame_time()
+        if self.last_update_time is not None and frame_time - self.last_update_time < 1.0 / self.update_hz:
+            return task.cont
+        self.last_update_time = frame_time
+
+        for node, mode in self.nodes:
+            for geom_np in node.find_all_matches('**/+GeomNode'):
+                bounds = geom_np.get_bounds()
+                if bounds.is_empty() or bounds.is_infinite():
+                    point = geom_np.get_pos(base.render)
+                else:
+                    point = base.render.get_relative_point(geom_np, bounds.get_approx_center())
+                self.assign(geom_np, self.pick_probes(point, mode))
+
+        return task.cont
+
+    def destroy(self):
+        base.task_mgr.remove(self.task_name)
+        for probe in list(self.probes):
+            self.remove_probe(probe)
@@ -0,0 +1,227 @@
+from panda3d.core import Texture, SamplerState, GraphicsOutput
+
+
+class GraphPass:
+    def __init__(self, name, inputs=None, target=None, ping_pong=False):
+        self.name = name
+        # shader input name -> resource name, resolved to textures whenever the graph compiles
+        self.inputs = dict(inputs or {})
+        # (div, framebuffer format, filter) of a pooled color target, None when the pass keeps its own
+        self.target = target
+        # ping-pong passes pick their active buffer every frame themselves in on_frame, see TemporalPass
+        self.ping_pong = ping_pong
+        self.on_frame = None
+        self.enabled = True
+        self.live = False
+        # set when a ping-pong pass comes back, its history is stale until it has rendered once
+        self.restarted = False
+        self.quads = []
+        self.buffers = []
+
+    def set_live(self, live):
+        if self.ping_pong and live:
+            self.restarted = self.restarted or not self.live
+            self.live = live
+            return
+
+        self.live = live
+        for buffer in self.buffers:
+            buffer.set_active(live)
+
+class RenderGraph:
+    def __init__(self, filter_manager):
+        # passes run in the order they are added, which is also FilterManager's buffer order
+        self.filter_manager = filter_manager
+        self.passes = []
+        self.producers = {}
+        self.textures = {}
+        self.aliases = {}
+        self.sinks = []
+        self.pool = {}
+        self.live_resources = set()
+        self.compile_callbacks = []
+        self.compile_count = 0
+        self.dirty = True
+
+    def add_resource(self, name, tex):
+        # textures from outside the graph, such as the scene's render targets
+        self.textures[name] = tex
+        self.dirty = True
+
+    def add_pass(self, name, shader, inputs=None, div=1, fbprops=None, filter_type=SamplerState.FT_linear, pooled=True):
+        # a fullscreen quad writing the resource of the same name, pooled passes share color targets; buffers are
+        # named complexpbr_<pass> for PStats, see frame_stats.py
+        tex = make_target_texture(name, filter_type)
+        quad = self.filter_manager.render_quad_into('complexpbr_' + name, div=div, colortex=tex, fbprops=fbprops)
+        quad.set_shader(shader)
+
+        graph_pass = GraphPass(name, inputs, (div, str(fbprops or ''), filter_type) if pooled else None)
+        graph_pass.quads.append(quad)
+        graph_pass.buffers.append(self.filter_manager.buffers[-1])
+        self.register(graph_pass, None if pooled else tex)
+
+        return graph_pass
+
+    def add_host_pass(self, name, tex, inputs=None):
+        # a buffer that draws nothing itself, for compute nodes attached to its quad; tex is what they write
+        quad = self.filter_manager.render_quad_into('complexpbr_' + name, div=64)
+        quad.node().remove_all_geoms()
+
+        graph_pass = GraphPass(name, inputs)
+        graph_pass.quads.append(quad)
+        graph_pass.buffers.append(self.filter_manager.buffers[-1])
+        self.register(graph_pass, tex)
+
+        return graph_pass
+
+    def add_ping_pong_pass(self, name, shader, inputs=None, div=1, fbprops=None, filter_type=SamplerState.FT_linear):
+        # two persistent targets, each buffer reads the other's result as its history
+        graph_pass = GraphPass(name, inputs, ping_pong=True)
+        for i in range(2):
+            tex = make_target_texture(name + '_' + str(i), filter_type)
+            quad = self.filter_manager.render_quad_into('complexpbr_' + name + '_' + str(i), div=div, colortex=tex, fbprops=fbprops)
+            quad.set_shader(shader)
+            graph_pass.quads.append(quad)
+            graph_pass.buffers.append(self.filter_manager.buffers[-1])
+        self.register(graph_pass, graph_pass.buffers[0].get_texture())
+
+        return graph_pass
+
+    def register(self, graph_pass, tex=None):
+        self.passes.append(graph_pass)
+        self.producers[graph_pass.name] = graph_pass
+        if tex is not None:
+            self.textures[graph_pass.name] = tex
+        graph_pass.set_live(False)
+        self.dirty = True
+
+    def add_sink(self, node, inputs):
+        # a consumer outside the graph, IE the final screen quad, which keeps the passes it reads alive
+        self.sinks.append((node, dict(inputs)))
+        self.dirty = True
+
+    def set_enabled(self, name, enabled):
+        graph_pass = self.producers[name]
+        if graph_pass.enabled != enabled:
+            graph_pass.enabled = enabled
+            self.dirty = True
+
+    def set_alias(self, name, resource):
+        # name reads whatever resource currently stands in for it, IE a history pass or its raw input
+        if self.aliases.get(name) != resource:
+            self.aliases[name] = resource
+            self.dirty = True
+
+    def resolve(self, resource):
+        while resource in self.aliases:
+            resource = self.aliases[resource]
+
+        return resource
+
+    def is_live(self, resource):
+        return self.resolve(resource) in self.live_resources
+
+    def set_texture(self, resource, tex):
+        # per-frame texture swaps, IE ping-pong history, rebind the consumers without a compile
+        self.textures[resource] = tex
+        if self.dirty:
+            return
+
+        for consumer, inputs in self.consumers():
+            for input_name, input_resource in inputs.items():
+                if self.resolve(input_resource) == resource:
+                    consumer.set_shader_input(input_name, tex)
+
+    def consumers(self):
+        for graph_pass in self.passes:
+            if graph_pass.live:
+                for quad in graph_pass.quads:
+                    yield quad, graph_pass.inputs
+        for node, inputs in self.sinks:
+            yield node, {name: resource for name, resource in inputs.items() if self.is_live(resource)}
+
+    def compile(self):
+        # a pass can run when it is enabled and everything it reads can be produced
+        available = set(name for name in self.textures if name not in self.producers)
+        runnable = []
+        for graph_pass in self.passes:
+            if graph_pass.enabled and all(self.resolve(r) in available for r in graph_pass.inputs.values()):
+                runnable.append(graph_pass)
+                available.add(graph_pass.name)
+
+        # and is culled unless a sink, or a live pass, reads its result
+        demanded = set(self.resolve(r) for node, inputs in self.sinks for r in inputs.values())
+        live = []
+        for graph_pass in reversed(runnable):
+            if graph_pass.name in demanded:
+                live.insert(0, graph_pass)
+                demanded.update(self.resolve(r) for r in graph_pass.inputs.values())
+
+        self.live_resources = (available - set(p.name for p in runnable)) | set(p.name for p in live)
+        self.assign_targets(live)
+
+        for graph_pass in self.passes:
+            graph_pass.set_live(graph_pass in live)
+        for consumer, inputs in self.consumers():
+            for input_name, resource in inputs.items():
+                consumer.set_shader_input(input_name, self.textures[self.resolve(resource)])
+
+        self.dirty = False
+        self.compile_count += 1
+        for callback in self.compile_callbacks:
+            callback(self)
+
+    def assign_targets(self, live):
+        # pooled targets are aliased between passes whose lifetimes do not overlap
+        last_read = {}
+        for index, graph_pass in enumerate(live):
+            for resource in graph_pass.inputs.values():
+                last_read[self.resolve(resource)] = index
+        for node, inputs in self.sinks:
+            for resource in inputs.values():
+                last_read[self.resolve(resource)] = len(live)
+
+        free = {key: list(textures) for key, textures in self.pool.items()}
+        in_use = []
+        for index, graph_pass in enumerate(live):
+            for entry in [entry for entry in in_use if entry[0] < index]:
+                in_use.remove(entry)
+                free[entry[1]].append(entry[2])
+            if graph_pass.target is None:
+                continue
+
+            key = graph_pass.target
+            if free.get(key):
+                tex = free[key].pop()
+            else:
+                tex = make_target_texture('complexpbr_pooled_' + str(sum(len(t) for t in self.pool.values())), key[2])
+                self.pool.setdefault(key, []).append(tex)
+                free.setdefault(key, [])
+
+            in_use.append((last_read.get(graph_pass.name, index), key, tex))
+            self.textures[graph_pass.name] = tex
+            buffer = graph_pass.buffers[0]
+            if buffer.get_texture() != tex:
+                buffer.clear_render_textures()
+                buffer.add_render_texture(tex, GraphicsOutput.RTM_bind_or_copy, GraphicsOutput.RTP_color)
+
+    def pooled_texture_count(self):
+        return sum(len(textures) for textures in self.pool.values())
+
+    def update(self):
+        # once per frame, after the passes have set their enabled flags
+        if self.dirty:
+            self.compile()
+
+        for graph_pass in self.passes:
+            if graph_pass.live and graph_pass.on_frame is not None:
+                graph_pass.on_frame()
+
+def make_target_texture(name, filter_type=SamplerState.FT_linear):
+    tex = Texture(name)
+    tex.set_wrap_u(Texture.WM_clamp)
+    tex.set_wrap_v(Texture.WM_clamp)
+    tex.set_minfilter(filter_type)
+    tex.set_magfilter(filter_type)
+
+    return tex
@@ -0,0 +1,330 @@
+from panda3d.core import Shader, Texture, SamplerState, FrameBufferProperties, ComputeNode, LVecBase2f, LVecBase4f
+from .shader_template import format_defines
+
+
+# shader files of the screenspace passes besides min_v.vert/min_f.frag
+SCREENSPACE_SHADER_FILES = ['quad_v.vert', 'bloom_down_f.frag', 'bloom_up_f.frag', 'ssao_f.frag', 'ssao_blur_f.frag',
+                            'hiz_c.comp', 'ssr_f.frag', 'temporal_f.frag', 'taa_f.frag', 'linear_depth_f.frag']
+# screenspace_init(scene_format=...) color bits of the scene buffer, None is Panda's default 8 bits per channel
+SCENE_FORMATS = {'rgba8': None, 'r11g11b10': (11, 11, 10, 0), 'rgba16': (16, 16, 16, 16)}
+
+def shader_input_value(node, name, default=0.0):
+    # the scalar value of a shader input set with set_shader_input(), default when it is not set
+    shader_input = node.get_shader_input(name)
+    if shader_input.get_value_type() == 0:
+        return default
+
+    return shader_input.get_vector()[0]
+
+def scene_buffer_size(filter_manager):
+    # the scene buffer is the first FilterManager buffer, which may render below the window size, see QualityGovernor
+    return filter_manager.get_scaled_size(*filter_manager.sizes[0])
+
+def camera_projection_params(lens):
+    # (x scale, y scale, x offset, y offset) of the lens projection, which the screen quad's own
+    # p3d_ProjectionMatrix cannot provide, as ndc.xy = view.xy * scale / depth + offset
+    proj = lens.get_projection_mat()
+
+    return LVecBase4f(proj[0][0], proj[2][1], proj[1][0], proj[1][1])
+
+def make_hdr_fbprops():
+    fbprops = FrameBufferProperties()
+    fbprops.set_float_color(True)
+    fbprops.set_rgba_bits(16, 16, 16, 16)
+
+    return fbprops
+
+def make_scene_fbprops(scene_format):
+    if scene_format not in SCENE_FORMATS:
+        raise ValueError('unknown scene format ' + repr(scene_format) + ', expected one of ' + str(sorted(SCENE_FORMATS)))
+    if SCENE_FORMATS[scene_format] is None:
+        return None
+
+    fbprops = FrameBufferProperties()
+    fbprops.set_float_color(True)
+    fbprops.set_rgba_bits(*SCENE_FORMATS[scene_format])
+
+    return fbprops
+
+def load_pass_shader(shader_dir, frag_name, defines=None):
+    if not defines:
+        return Shader.load(Shader.SL_GLSL, shader_dir / 'quad_v.vert', shader_dir / frag_name)
+
+    # the #defines go right below the #version line
+    version, body = (shader_dir / frag_name).read_text().split('\n', 1)
+
+    return Shader.make(Shader.SL_GLSL, (shader_dir / 'quad_v.vert').read_text(), version + '\n' + format_defines(defines) + body)
+
+class TemporalPass:
+    def __init__(self, graph, name, shader, inputs, div=1, fbprops=None, filter_type=SamplerState.FT_linear):
+        # two buffers take turns writing the result and reading the other's as history, so nothing is copied
+        self.graph = graph
+        self.name = name
+        self.graph_pass = graph.add_ping_pong_pass(name, shader, inputs, div, fbprops, filter_type)
+        self.graph_pass.on_frame = self.advance
+        buffers = self.graph_pass.buffers
+        for i, quad in enumerate(self.graph_pass.quads):
+            quad.set_shader_input('history_tex', buffers[1 - i].get_texture())
+            quad.set_shader_input('history_blend', 0.0)
+
+        self.index = 0
+        self.blend = 0.0
+
+    def set_shader_input(self, *args):
+        for quad in self.graph_pass.quads:
+            quad.set_shader_input(*args)
+
+    def set_blend(self, blend):
+        # a blend of 0 takes the pass out of the graph
+        self.blend = blend
+        self.graph.set_enabled(self.name, blend > 0.0)
+
+    def advance(self):
+        # once per frame while live, the history is stale right after the pass comes back so that frame takes none of it
+        self.index ^= 1
+        buffers = self.graph_pass.buffers
+        buffers[self.index].set_active(True)
+        buffers[self.index ^ 1].set_active(False)
+        self.graph_pass.quads[self.index].set_shader_input('history_blend', 0.0 if self.graph_pass.restarted else self.blend)
+        self.graph_pass.restarted = False
+        self.graph.set_texture(self.name, buffers[self.index].get_texture())
+
+class BloomPyramid:
+    def __init__(self, graph, shader_dir, levels=5):
+        self.graph = graph
+        self.levels = max(1, levels)
+        self.active_levels = None
+        self.knobs = None
+        down_shader = load_pass_shader(shader_dir, 'bloom_down_f.frag')
+        up_shader = load_pass_shader(shader_dir, 'bloom_up_f.frag')
+        fbprops = make_hdr_fbprops()
+
+        # every level is added after the level it reads
+        self.down_passes = []
+        source = 'scene'
+        for level in range(self.levels):
+            down_pass = graph.add_pass('bloom_down_' + str(level), down_shader, {'source_tex': source}, 2 ** (level + 1), fbprops)
+            down_pass.quads[0].set_shader_input('prefilter', int(level == 0))
+            down_pass.quads[0].set_shader_input('bloom_threshold', 0.7)
+            self.down_passes.append(down_pass)
+            source = down_pass.name
+
+        self.up_passes = [None] * self.levels
+        for level in reversed(range(self.levels - 1)):
+            up_pass = graph.add_pass('bloom_up_' + str(level), up_shader, {'current_tex': 'bloom_down_' + str(level),
+                                     'lower_tex': 'bloom_lower_' + str(level)}, 2 ** (level + 1), fbprops)
+            up_pass.quads[0].set_shader_input('filter_radius', 1.0)
+            up_pass.quads[0].set_shader_input('output_scale', 1.0)
+            self.up_passes[level] = up_pass
+
+        self.set_active_levels(0)
+
+    def set_active_levels(self, active_levels):
+        # the pyramid is only as deep as bloom_samples asks, and not rendered at all without bloom
+        if active_levels == self.active_levels:
+            return
+        self.active_levels = active_levels
+
+        for level in range(self.levels):
+            self.graph.set_enabled(self.down_passes[level].name, level < active_levels)
+            if self.up_passes[level] is not None:
+                self.graph.set_enabled(self.up_passes[level].name, level < active_levels - 1)
+
+        for level in range(active_levels - 1):
+            lower = self.up_passes[level + 1] if level + 1 < active_levels - 1 else self.down_passes[level + 1]
+            self.graph.set_alias('bloom_lower_' + str(level), lower.name)
+            # the level sum is averaged so the bloom strength does not depend on the depth
+            self.up_passes[level].quads[0].set_shader_input('output_scale', 1.0 / active_levels if level == 0 else 1.0)
+
+        self.graph.set_alias('bloom', 'bloom_up_0' if active_levels > 1 else 'bloom_down_0')
+
+    def sync(self, screen_quad):
+        # bloom_intensity, bloom_threshold, bloom_blur_width and bloom_samples stay screen_quad inputs
+        intensity = shader_input_value(screen_quad, 'bloom_intensity')
+        threshold = shader_input_value(screen_quad, 'bloom_threshold', 0.7)
+        blur_width = shader_input_value(screen_quad, 'bloom_blur_width', 10.0)
+        samples = int(shader_input_value(screen_quad, 'bloom_samples', self.levels))
+        knobs = (intensity > 0.0, threshold, blur_width, samples)
+        if knobs == self.knobs:
+            return
+        self.knobs = knobs
+
+        self.set_active_levels(0 if intensity <= 0.0 else min(max(1, samples), self.levels))
+
+        self.down_passes[0].quads[0].set_shader_input('bloom_threshold', threshold)
+        for up_pass in self.up_passes[:-1]:
+            # the old default width of 10 is the unit tent
+            up_pass.quads[0].set_shader_input('filter_radius', max(0.0, blur_width) / 10.0)
+
+class SSAOPass:
+    def __init__(self, graph, frame_index, shader_dir, scale=2, linear_depth=False):
+        self.graph = graph
+        self.knobs = None
+        fbprops = make_hdr_fbprops()
+        nearest = SamplerState.FT_nearest
+
+        # with linear_depth the scene depth is linearized once into its own target, instead of for every SSAO tap
+        self.depth_pass = None
+        if linear_depth:
+            depth_fbprops = FrameBufferProperties()
+            depth_fbprops.set_float_color(True)
+            depth_fbprops.set_rgba_bits(32, 0, 0, 0)
+            self.depth_pass = graph.add_pass('linear_depth', load_pass_shader(shader_dir, 'linear_depth_f.frag'), {'depth_tex': 'depth'},
+                                             1, depth_fbprops, nearest)
+
+        ao_shader = load_pass_shader(shader_dir, 'ssao_f.frag', {'LINEAR_DEPTH': int(linear_depth)})
+        ao_inputs = {'depth_tex': 'linear_depth' if linear_depth else 'depth', 'normal_tex': 'normal'}
+        self.ao_pass = graph.add_pass('ssao', ao_shader, ao_inputs, scale, fbprops, nearest)
+        self.ao_pass.quads[0].set_shader_input('frame_index', frame_index)
+
+        # the raw, per-frame rotated samples accumulate over frames before the blur
+        self.temporal = TemporalPass(graph, 'ssao_history', load_pass_shader(shader_dir, 'temporal_f.frag'),
+                                     {'current_tex': 'ssao', 'velocity_tex': 'velocity'}, scale, fbprops, nearest)
+        self.temporal.set_shader_input('accumulate_mask', LVecBase4f(1, 0, 0, 0))
+        self.temporal.set_shader_input('reject_depth', 1)
+
+        # separable bilateral blur, horizontal then vertical
+        blur_shader = load_pass_shader(shader_dir, 'ssao_blur_f.frag')
+        h_pass = graph.add_pass('ssao_blur_h', blur_shader, {'ssao_tex': 'ssao_accumulated'}, scale, fbprops, nearest)
+        h_pass.quads[0].set_shader_input('blur_direction', LVecBase2f(1, 0))
+        v_pass = graph.add_pass('ssao_blur_v', blur_shader, {'ssao_tex': 'ssao_blur_h'}, scale, fbprops, nearest)
+        v_pass.quads[0].set_shader_input('blur_direction', LVecBase2f(0, 1))
+
+    def sync(self, screen_quad, lens):
+        samples = int(shader_input_value(screen_quad, 'ssao_samples'))
+        enabled = samples > 0
+        self.graph.set_enabled('ssao', enabled)
+        temporal_blend = shader_input_value(screen_quad, 'ssao_temporal_blend', 0.9)
+        self.temporal.set_blend(temporal_blend)
+        self.graph.set_alias('ssao_accumulated', 'ssao_history' if temporal_blend > 0.0 else 'ssao')
+        if not enabled:
+            return
+
+        knobs = (samples, shader_input_value(screen_quad, 'ssao_radius', 0.99), shader_input_value(screen_quad, 'ssao_bias', 0.005),
+                 shader_input_value(screen_quad, 'ssao_intensity', 0.5), lens.get_near(), lens.get_far(), tuple(camera_projection_params(lens)))
+        if knobs == self.knobs:
+            return
+        self.knobs = knobs
+
+        quad = self.ao_pass.quads[0]
+        quad.set_shader_input('ssao_samples', samples)
+        quad.set_shader_input('ssao_radius', knobs[1])
+        quad.set_shader_input('ssao_bias', knobs[2])
+        quad.set_shader_input('ssao_intensity', knobs[3])
+        quad.set_shader_input('cameraNear', knobs[4])
+        quad.set_shader_input('cameraFar', knobs[5])
+        quad.set_shader_input('proj_params', LVecBase4f(*knobs[6]))
+        if self.depth_pass is not None:
+            self.depth_pass.quads[0].set_shader_input('cameraNear', knobs[4])
+            self.depth_pass.quads[0].set_shader_input('cameraFar', knobs[5])
+
+class HiZPyramid:
+    def __init__(self, graph, depth_tex, shader_dir):
+        # a (min, max) depth mip chain of the scene, rebuilt every frame while a live pass reads 'hiz'
+        self.filter_manager = graph.filter_manager
+        self.depth_tex = depth_tex
+        self.size = None
+        self.level_nps = []
+        self.shader = Shader.load_compute(Shader.SL_GLSL, shader_dir / 'hiz_c.comp')
+
+        self.hiz_tex = Texture('complexpbr_hiz')
+        self.hiz_tex.set_wrap_u(Texture.WM_clamp)
+        self.hiz_tex.set_wrap_v(Texture.WM_clamp)
+        self.hiz_tex.set_minfilter(SamplerState.FT_nearest_mipmap_nearest)
+        self.hiz_tex.set_magfilter(SamplerState.FT_nearest)
+        self.hiz_tex.set_clear_color((1, 1, 0, 0))
+
+        # the host buffer sits between the scene and the passes reading the pyramid
+        self.host = graph.add_host_pass('hiz', self.hiz_tex, {'depth_tex': 'depth'}).quads[0]
+        self.resize()
+
+    @property
+    def levels(self):
+        return len(self.level_nps)
+
+    def resize(self):
+        # the pyramid matches the scene depth texture
+        size = scene_buffer_size(self.filter_manager)
+        if size == self.size:
+            return
+        self.size = size
+
+        width, height = size
+        self.hiz_tex.setup_2d_texture(width, height, Texture.T_float, Texture.F_rg32)
+        for level_np in self.level_nps:
+            level_np.remove_node()
+        self.level_nps = []
+
+        for level in range(max(width, height).bit_length()):
+            level_width = max(1, width >> level)
+            level_height = max(1, height >> level)
+            compute_node = ComputeNode('complexpbr_hiz_' + str(level))
+            compute_node.add_dispatch((level_width + 7) // 8, (level_height + 7) // 8, 1)
+            level_np = self.host.attach_new_node(compute_node)
+            # the fixed bin keeps the levels in order
+            level_np.set_bin('fixed', level)
+            level_np.set_shader(self.shader)
+            level_np.set_shader_input('depth_tex', self.depth_tex)
+            level_np.set_shader_input('source_level', self.hiz_tex, True, False, -1, max(0, level - 1))
+            level_np.set_shader_input('dest_level', self.hiz_tex, False, True, -1, level)
+            level_np.set_shader_input('hiz_level', level)
+            self.level_nps.append(level_np)
+
+    def sync(self):
+        self.resize()
+
+class SSRPass:
+    def __init__(self, graph, hiz, frame_index, shader_dir, scale=2):
+        self.graph = graph
+        self.hiz = hiz
+        self.knobs = None
+        fbprops = make_hdr_fbprops()
+
+        self.trace_pass = graph.add_pass('ssr', load_pass_shader(shader_dir, 'ssr_f.frag'), {'scene_tex': 'scene', 'hiz_tex': 'hiz', 'normal_tex': 'normal'},
+                                         scale, fbprops)
+        self.trace_pass.quads[0].set_shader_input('frame_index', frame_index)
+
+        self.temporal = TemporalPass(graph, 'ssr_history', load_pass_shader(shader_dir, 'temporal_f.frag'),
+                                     {'current_tex': 'ssr', 'velocity_tex': 'velocity'}, scale, fbprops)
+        self.temporal.set_shader_input('accumulate_mask', LVecBase4f(1, 1, 1, 1))
+        self.temporal.set_shader_input('reject_depth', 0)
+
+    def sync(self, screen_quad, lens):
+        samples = int(shader_input_value(screen_quad, 'ssr_samples'))
+        enabled = samples > 0
+        self.graph.set_enabled('ssr', enabled)
+        temporal_blend = shader_input_value(screen_quad, 'ssr_temporal_blend', 0.9)
+        self.temporal.set_blend(temporal_blend)
+        self.graph.set_alias('ssr_out', 'ssr_history' if temporal_blend > 0.0 else 'ssr')
+        if not enabled:
+            return
+
+        knobs = (samples, shader_input_value(screen_quad, 'ssr_thickness', 0.5), shader_input_value(screen_quad, 'ssr_max_distance', 50.0),
+                 shader_input_value(screen_quad, 'ssr_fresnel_pow', 3.0), lens.get_near(), lens.get_far(), tuple(camera_projection_params(lens)), self.hiz.levels)
+        if knobs == self.knobs:
+            return
+        self.knobs = knobs
+
+        quad = self.trace_pass.quads[0]
+        quad.set_shader_input('ssr_samples', samples)
+        quad.set_shader_input('ssr_thickness', knobs[1])
+        quad.set_shader_input('ssr_max_distance', knobs[2])
+        quad.set_shader_input('ssr_fresnel_pow', knobs[3])
+        quad.set_shader_input('cameraNear', knobs[4])
+        quad.set_shader_input('cameraFar', knobs[5])
+        quad.set_shader_input('proj_params', LVecBase4f(*knobs[6]))
+        quad.set_shader_input('hiz_levels', knobs[7])
+
+class TemporalAA:
+    def __init__(self, graph, motion_vectors, shader_dir):
+        self.graph = graph
+        self.motion_vectors = motion_vectors
+        self.temporal = TemporalPass(graph, 'taa', load_pass_shader(shader_dir, 'taa_f.frag'),
+                                     {'scene_tex': 'scene', 'depth_tex': 'depth', 'velocity_tex': 'velocity'}, 1, make_hdr_fbprops())
+
+    def sync(self, screen_quad):
+        # taa_blend is the history weight, 0 leaves the camera unjittered and min_f.frag on its edge AA
+        blend = shader_input_value(screen_quad, 'taa_blend')
+        self.temporal.set_blend(blend)
+        self.motion_vectors.set_jitter(blend > 0.0)
+        self.graph.set_alias('scene_out', 'taa' if blend > 0.0 else 'scene')
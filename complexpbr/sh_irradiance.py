@@ -0,0 +1,155 @@
+import math
+from importlib.resources import files
+import numpy as np
+from panda3d.core import ClockObject, Shader, ShaderAttrib, Texture, SamplerState, NodePath, LVecBase3i, LVecBase3f, PTA_LVecBase3f
+
+
+# real L2 spherical harmonic basis constants, in the order used by sh_project_c.comp and ibl_f.frag
+SH_BASIS = np.array([0.282095, 0.488603, 0.488603, 0.488603, 1.092548, 1.092548, 0.315392, 1.092548, 0.546274])
+# clamped-cosine convolution per band, divided by pi so the result is diffuse radiance
+SH_COSINE_LOBE = np.array([1.0, 2.0 / 3.0, 2.0 / 3.0, 2.0 / 3.0, 0.25, 0.25, 0.25, 0.25, 0.25])
+
+def cubemap_directions(size):
+    # unit directions and solid angles of every texel, shape (6, size, size, 3) and (6, size, size)
+    coords = (np.arange(size) + 0.5) / size * 2.0 - 1.0
+    u, v = np.meshgrid(coords, coords)
+    one = np.ones_like(u)
+    faces = np.stack([
+        np.stack((one, -v, -u), axis=-1),
+        np.stack((-one, -v, u), axis=-1),
+        np.stack((u, one, v), axis=-1),
+        np.stack((u, -one, -v), axis=-1),
+        np.stack((u, -v, one), axis=-1),
+        np.stack((-u, -v, -one), axis=-1),
+    ])
+    len2 = (faces * faces).sum(axis=-1)
+    solid_angles = (4.0 / (size * size)) / (len2 * np.sqrt(len2))
+
+    return faces / np.sqrt(len2)[..., None], solid_angles
+
+def sh9_basis(directions):
+    x, y, z = directions[..., 0], directions[..., 1], directions[..., 2]
+    basis = np.stack((np.ones_like(x), y, z, x, x * y, y * z, 3.0 * z * z - 1.0, x * z, x * x - y * y), axis=-1)
+
+    return basis * SH_BASIS
+
+def project_sh9(faces):
+    # faces: (6, size, size, 3) linear radiance in OpenGL cube face order, rows as stored in texture memory
+    faces = np.asarray(faces, dtype=np.float64)
+    directions, solid_angles = cubemap_directions(faces.shape[1])
+    basis = sh9_basis(directions) * solid_angles[..., None]
+
+    return np.einsum('fyxk,fyxc->kc', basis, faces[..., :3])
+
+def sh9_to_shader_coefficients(coefficients):
+    # fold the cosine lobe and the basis constants in so the shader only evaluates polynomials
+    return np.asarray(coefficients, dtype=np.float64) * (SH_COSINE_LOBE * SH_BASIS)[:, None]
+
+def eval_sh9_irradiance(shader_coefficients, directions):
+    # NumPy mirror of evalSHIrradiance() in ibl_f.frag
+    basis = sh9_basis(directions) / SH_BASIS
+
+    return np.maximum(basis @ shader_coefficients, 0.0)
+
+def cubemap_texture_faces(cube_tex, level=0):
+    # reads the RAM image of a cube map texture into a (6, size, size, 3) float array
+    size = max(1, cube_tex.get_x_size() >> level)
+    data = cube_tex.get_ram_mipmap_image(level) if level > 0 else cube_tex.get_ram_image_as('RGB')
+    component_type = cube_tex.get_component_type()
+
+    if component_type == Texture.T_float:
+        faces = np.frombuffer(data, dtype=np.float32)
+    elif component_type == Texture.T_half_float:
+        faces = np.frombuffer(data, dtype=np.float16).astype(np.float32)
+    elif component_type == Texture.T_unsigned_short:
+        faces = np.frombuffer(data, dtype=np.uint16) / 65535.0
+    else:
+        faces = np.frombuffer(data, dtype=np.uint8) / 255.0
+
+    channels = faces.size // (6 * size * size)
+    faces = faces.reshape(6, size, size, channels)
+    if level > 0 and channels >= 3:
+        # mipmap images keep Panda's native BGR(A) order
+        faces = faces[..., [2, 1, 0]]
+
+    return faces[..., :3]
+
+class ShIrradiance:
+    def __init__(self, source_tex=None, update_hz=2.0, smoothing=0.5, grid_size=32,
+                 shader_dir=None, task_name='complexpbr_sh_irradiance'):
+        self.source_tex = source_tex
+        self.update_hz = update_hz
+        self.smoothing = smoothing
+        self.grid_size = grid_size
+        self.clock = ClockObject.get_global_clock()
+        self.task_name = task_name
+        self.pending_capture = source_tex is not None
+        self.last_update_time = None
+        self.update_count = 0
+
+        # target is the latest projection, current is what the shader sees and eases toward target
+        self.target = np.zeros((9, 3))
+        self.current = np.zeros((9, 3))
+        self.sh_input = PTA_LVecBase3f.empty_array(9)
+
+        if source_tex is not None:
+            self.partials_tex = Texture('complexpbr_sh_partials')
+            self.partials_tex.setup_2d_texture(9, 6, Texture.T_float, Texture.F_rgba32)
+            self.partials_tex.set_minfilter(SamplerState.FT_nearest)
+            self.partials_tex.set_magfilter(SamplerState.FT_nearest)
+            self.partials_tex.set_clear_color((0, 0, 0, 0))
+
+            shader_dir = files('complexpbr') if shader_dir is None else shader_dir
+            self.compute_np = NodePath('complexpbr_sh_projection')
+            self.compute_np.set_shader(Shader.load_compute(Shader.SL_GLSL, shader_dir / 'sh_project_c.comp'))
+            self.compute_np.set_shader_input('source_env', source_tex)
+            self.compute_np.set_shader_input('sh_partials', self.partials_tex, False, True, -1, 0)
+            self.compute_np.set_shader_input('grid_size', grid_size)
+            source_size = source_tex.get_x_size() or grid_size
+            self.compute_np.set_shader_input('sample_lod', max(0.0, math.log2(source_size / grid_size)))
+
+        base.task_mgr.add(self.update, task_name, sort=21)
+
+    def on_capture(self, scheduler=None):
+        self.pending_capture = True
+
+    def cancel(self):
+        self.pending_capture = False
+
+    def set_coefficients(self, coefficients, immediate=False):
+        # radiance SH coefficients, IE from project_sh9(), shape (9, 3)
+        self.target = sh9_to_shader_coefficients(coefficients)
+        if immediate:
+            self.current = self.target.copy()
+            self.upload()
+
+    def project_gpu(self):
+        base.graphicsEngine.dispatch_compute(LVecBase3i(6, 1, 1), self.compute_np.get_attrib(ShaderAttrib), base.win.get_gsg())
+        base.graphicsEngine.extract_texture_data(self.partials_tex, base.win.get_gsg())
+        partials = np.frombuffer(self.partials_tex.get_ram_image_as('RGBA'), dtype=np.float32).reshape(6, 9, 4)
+
+        return partials[..., :3].sum(axis=0)
+
+    def upload(self):
+        for i in range(9):
+            self.sh_input[i] = LVecBase3f(*self.current[i])
+
+    def update(self, task):
+        frame_time = self.clock.get_frame_time()
+
+        if self.pending_capture and self.source_tex is not None:
+            if self.last_update_time is None or frame_time - self.last_update_time >= 1.0 / self.update_hz:
+                self.pending_capture = False
+                self.last_update_time = frame_time
+                self.update_count += 1
+                self.set_coefficients(self.project_gpu(), immediate=self.update_count == 1)
+
+        if not np.array_equal(self.current, self.target):
+            blend = 1.0 if self.smoothing <= 0.0 else 1.0 - math.exp(-self.clock.get_dt() / self.smoothing)
+            self.current += (self.target - self.current) * blend
+            self.upload()
+
+        return task.cont
+
+    def destroy(self):
+        base.task_mgr.remove(self.task_name)
@@ -0,0 +1,91 @@
+import hashlib
+from collections import OrderedDict
+from pathlib import Path
+from panda3d.core import Shader
+
+
+def make_shader_key(*parts):
+    digest = hashlib.sha1()
+
+    for part in parts:
+        if isinstance(part, dict):
+            part = sorted((str(k), str(v)) for k, v in part.items())
+        digest.update(repr(part).encode('utf-8'))
+        digest.update(b'\0')
+
+    return digest.hexdigest()
+
+class ShaderCache:
+    def __init__(self, max_variants=128):
+        self.max_variants = max_variants
+        self.variants = OrderedDict()
+        self.sources = {}
+        self.hits = 0
+        self.misses = 0
+        # optional ProgramCache, which keeps linked programs on disk between runs
+        self.program_cache = None
+
+    def __len__(self):
+        return len(self.variants)
+
+    def __contains__(self, key):
+        return key in self.variants
+
+    def get(self, key, build, write_dir=None, write_names=('ibl_v', 'ibl_f')):
+        # build() is only called on a miss and returns (vert_source, frag_source)
+        if key in self.variants:
+            self.variants.move_to_end(key)
+            self.hits += 1
+            return self.variants[key]
+
+        self.misses += 1
+        shader = None
+        if self.program_cache is not None and write_dir is None:
+            shader = self.program_cache.load(key)
+
+        if shader is None:
+            vert_src, frag_src = build()
+            shader = Shader.make(Shader.SL_GLSL, vert_src, frag_src)
+            if self.program_cache is not None:
+                self.program_cache.add(key, shader)
+
+        if write_dir is not None:
+            write_dir = Path(write_dir)
+            (write_dir / (write_names[0] + '_' + key[:12] + '.vert')).write_text(vert_src)
+            (write_dir / (write_names[1] + '_' + key[:12] + '.frag')).write_text(frag_src)
+
+        self.variants[key] = shader
+        self.set_max_variants(self.max_variants)
+
+        return shader
+
+    def set_max_variants(self, max_variants):
+        self.max_variants = max(1, max_variants)
+
+        while len(self.variants) > self.max_variants:
+            self.variants.popitem(last=False)
+
+    def load_source(self, path):
+        # shader sources are re-read and re-hashed only when the file changes on disk
+        path = Path(path)
+        mtime = path.stat().st_mtime_ns
+        cached = self.sources.get(path)
+
+        if cached is None or cached[0] != mtime:
+            text = path.read_text()
+            cached = (mtime, text, hashlib.sha1(text.encode('utf-8')).hexdigest())
+            self.sources[path] = cached
+
+        return cached
+
+    def read_source(self, path):
+        return self.load_source(path)[1]
+
+    def source_digest(self, path):
+        return self.load_source(path)[2]
+
+    def clear(self):
+        self.variants.clear()
+        self.sources.clear()
+        self.hits = 0
+        self.misses = 0
@@ -0,0 +1,89 @@
+import re
+
+
+# a slot marker is a line of its own, IE "    // @slot functions"
+SLOT_PATTERN = re.compile(r'^[ \t]*// @slot (\w+)[ \t]*$', re.MULTILINE)
+
+def format_defines(defines):
+    if not defines:
+        return ''
+
+    return ''.join('#define ' + str(k) + ' ' + str(v) + '\n' for k, v in sorted(defines.items()))
+
+class ShaderTemplate:
+    def __init__(self, source):
+        # the source is split once into text chunks around the named injection slots
+        self.chunks = []
+        self.slots = {}
+        cursor = 0
+
+        for match in SLOT_PATTERN.finditer(source):
+            name = match.group(1)
+
+            if name in self.slots:
+                raise ValueError('duplicate shader slot ' + repr(name))
+
+            marker_end = match.end() + 1 if source.startswith('\n', match.end()) else match.end()
+            self.chunks.append(source[cursor:marker_end])
+            self.slots[name] = len(self.slots)
+            cursor = marker_end
+
+        self.chunks.append(source[cursor:])
+
+    def compose(self, mods=()):
+        # mods is a dict of slot name -> code, or a sequence of such dicts applied in order
+        if isinstance(mods, dict):
+            mods = (mods,)
+
+        injected = [[] for _ in self.slots]
+
+        for mod in mods:
+            for name, code in mod.items():
+                if not code:
+                    continue
+                if name not in self.slots:
+                    raise KeyError('unknown shader slot ' + repr(name) + ', expected one of ' + str(sorted(self.slots)))
+
+                injected[self.slots[name]].append(code if code.endswith('\n') else code + '\n')
+
+        pieces = [self.chunks[0]]
+
+        for index, chunk in enumerate(self.chunks[1:]):
+            pieces.extend(injected[index])
+            pieces.append(chunk)
+
+        return ''.join(pieces)
+
+_templates = {}
+
+def load_template(shader_cache, path):
+    digest = shader_cache.source_digest(path)
+
+    if digest not in _templates:
+        _templates[digest] = ShaderTemplate(shader_cache.read_source(path))
+
+    return _templates[digest]
+
+def split_stage_mods(mods, stages=('vert', 'frag')):
+    # {'frag_functions': ..., 'vert_main_end': ...} -> {'vert': {...}, 'frag': {...}}
+    if isinstance(mods, dict):
+        mods = (mods,)
+
+    split = {stage: [] for stage in stages}
+
+    for mod in mods:
+        staged = {stage: {} for stage in stages}
+
+        for name, code in mod.items():
+            stage, _, slot = name.partition('_')
+
+            if stage not in staged or slot == '':
+                raise KeyError('shader mod ' + repr(name) + ' must be prefixed with one of ' + str(stages))
+
+            staged[stage][slot] = code
+
+        for stage in stages:
+            if staged[stage]:
+                split[stage].append(staged[stage])
+
+    return split
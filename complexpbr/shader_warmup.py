@@ -0,0 +1,48 @@
+class ShaderWarmup:
+    def __init__(self, shaders, per_frame=2, callback=None, done_callback=None, task_name='complexpbr_shader_warmup'):
+        # hands shaders to the GSG a few per frame, IE behind a loading screen, so that they are compiled and linked
+        # before their first draw instead of stalling it
+        self.shaders = list(dict((id(shader), shader) for shader in shaders).values())
+        self.per_frame = max(1, int(per_frame))
+        self.callback = callback
+        self.done_callback = done_callback
+        self.task_name = task_name
+        self.queued = 0
+        self.done = 0
+        self.finished = False
+
+        base.task_mgr.remove(task_name)
+        base.task_mgr.add(self.update, task_name, sort=55)
+
+    @property
+    def total(self):
+        return len(self.shaders)
+
+    @property
+    def progress(self):
+        return self.done / self.total if self.shaders else 1.0
+
+    def update(self, task):
+        prepared_objects = base.win.get_gsg().get_prepared_objects()
+        done = sum(1 for shader in self.shaders[:self.queued] if prepared_objects.is_shader_prepared(shader))
+        if done != self.done:
+            self.done = done
+            if self.callback is not None:
+                self.callback(done, self.total)
+
+        if done == self.total:
+            self.finished = True
+            if self.done_callback is not None:
+                self.done_callback()
+            return task.done
+
+        # per_frame shaders are linked at the start of each frame, the rest wait their turn
+        if self.queued - done < self.per_frame:
+            for shader in self.shaders[self.queued:self.queued + self.per_frame]:
+                prepared_objects.enqueue_shader(shader)
+            self.queued = min(self.total, self.queued + self.per_frame)
+
+        return task.cont
+
+    def cancel(self):
+        base.task_mgr.remove(self.task_name)
@@ -0,0 +1,398 @@
+import math
+from panda3d.core import Shader, Texture, SamplerState, NodePath, Camera, CardMaker, BitMask32, LMatrix4f, LVecBase4f
+from panda3d.core import FrameBufferProperties, WindowProperties, GraphicsPipe, GraphicsOutput, OmniBoundingVolume, BoundingSphere
+from panda3d.core import ColorWriteAttrib, DepthTestAttrib, DepthOffsetAttrib, RenderAttrib, LightAttrib, Spotlight, DirectionalLight
+from panda3d.core import PTA_LMatrix4f, PTA_LVecBase4f, OrthographicLens
+
+
+SHADOW_ATLAS_SHADER_FILES = ['shadow_v.vert', 'shadow_f.frag', 'shadow_copy_v.vert', 'shadow_copy_f.frag']
+# draw mask bits of the static cache and dynamic composite cameras
+STATIC_CASTER_MASK = BitMask32.bit(28)
+DYNAMIC_CASTER_MASK = BitMask32.bit(29)
+# the shader arrays are indexed by p3d_LightSource slot, see the shadow lookup in ibl_f.frag
+MAX_SLOTS = 20
+
+# a tile keeps its size until its coverage asks for this much more than it, or this much less than half of it
+TILE_HYSTERESIS = 0.25
+
+# clip space [-1, 1] to texture space [0, 1]
+CLIP_TO_TEXTURE = LMatrix4f.scale_mat(0.5) * LMatrix4f.translate_mat(0.5, 0.5, 0.5)
+
+def make_depth_texture(name, filter_type):
+    tex = Texture(name)
+    tex.set_wrap_u(Texture.WM_clamp)
+    tex.set_wrap_v(Texture.WM_clamp)
+    tex.set_minfilter(filter_type)
+    tex.set_magfilter(filter_type)
+
+    return tex
+
+def make_depth_buffer(name, size, sort, tex):
+    fbprops = FrameBufferProperties()
+    fbprops.set_depth_bits(32)
+    buffer = base.graphicsEngine.make_output(base.pipe, name, sort, fbprops, WindowProperties.size(size, size),
+                                             GraphicsPipe.BF_refuse_window, base.win.get_gsg(), base.win)
+    buffer.add_render_texture(tex, GraphicsOutput.RTM_bind_or_copy, GraphicsOutput.RTP_depth)
+    # tiles clear their own region, the rest of the atlas keeps its contents
+    buffer.set_clear_color_active(False)
+    buffer.set_clear_depth_active(False)
+
+    return buffer
+
+def free_squares(x, y, size, used):
+    # the buddy squares of the (x, y, size) square that no used tile overlaps
+    overlapping = [tile for tile in used if tile[0] < x + size and x < tile[0] + tile[2] and tile[1] < y + size and y < tile[1] + tile[2]]
+    if not overlapping:
+        return [(x, y, size)]
+    if any(tile[2] >= size for tile in overlapping):
+        return []
+    half = size >> 1
+
+    return [square for qx, qy in ((x, y), (x + half, y), (x, y + half), (x + half, y + half))
+            for square in free_squares(qx, qy, half, overlapping)]
+
+def pack_tiles(sizes, atlas_size, kept=None):
+    # buddy allocation of square power of 2 tiles, largest first, a tile that does not fit is halved until it does;
+    # kept holds tiles that stay where they are, IE from the last packing, and None for the ones to place
+    tiles = list(kept) if kept is not None else [None] * len(sizes)
+    free = free_squares(0, 0, atlas_size, [tile for tile in tiles if tile is not None])
+
+    for index in sorted((i for i in range(len(sizes)) if tiles[i] is None), key=lambda i: -sizes[i]):
+        size = sizes[index]
+        while size >= 1:
+            fits = [square for square in free if square[2] >= size]
+            if fits:
+                break
+            size >>= 1
+        if size < 1:
+            continue
+
+        square = min(fits, key=lambda s: (s[2], s[1], s[0]))
+        free.remove(square)
+        x, y, square_size = square
+        while square_size > size:
+            square_size >>= 1
+            free += [(x + square_size, y, square_size), (x, y + square_size, square_size), (x + square_size, y + square_size, square_size)]
+        tiles[index] = (x, y, size)
+
+    return tiles
+
+def packed_area(tiles):
+    return sum(tile[2] * tile[2] for tile in tiles if tile is not None)
+
+class ShadowTile:
+    def __init__(self, light_np):
+        self.light_np = light_np
+        self.tile = None
+        # the size asked for, tile may be smaller when the atlas is full
+        self.size = None
+        self.signature = None
+        self.static_region = None
+        self.copy_region = None
+        self.dynamic_region = None
+        self.cameras = []
+
+class ShadowAtlas:
+    def __init__(self, size=4096, min_tile=256, max_tile=None, caster_root=None, shader_dir=None,
+                 task_name='complexpbr_shadow_atlas'):
+        # lights share one depth atlas, each tile keeps a cache of its static casters and dynamic casters are
+        # composited on top of it every frame
+        self.size = size
+        self.min_tile = min_tile
+        self.max_tile = max_tile or size
+        self.caster_root = base.render if caster_root is None else caster_root
+        self.shader_dir = shader_dir
+        self.task_name = task_name
+        self.tiles = []
+        self.dynamic_casters = []
+        self.static_bounds = {}
+        self.static_root_bounds = None
+        self.buffers = None
+        self.static_renders = 0
+
+        self.matrices_input = PTA_LMatrix4f.empty_array(MAX_SLOTS)
+        self.rects_input = PTA_LVecBase4f.empty_array(MAX_SLOTS)
+
+        # a 1x1 stand-in until the first light needs the atlas
+        self.atlas_tex = make_depth_texture('complexpbr_shadow_atlas', SamplerState.FT_shadow)
+        self.atlas_tex.setup_2d_texture(1, 1, Texture.T_float, Texture.F_depth_component32)
+        self.atlas_tex.set_clear_color((1, 1, 1, 1))
+
+        base.task_mgr.add(self.update, task_name, sort=47)
+
+    def set_shader_inputs(self, node):
+        node.set_shader_input('shadow_atlas', self.atlas_tex)
+        node.set_shader_input('shadow_atlas_matrices', self.matrices_input)
+        node.set_shader_input('shadow_atlas_rects', self.rects_input)
+
+    def configure(self, min_tile=None, max_tile=None):
+        if min_tile is not None:
+            self.min_tile = max(1, int(min_tile))
+        if max_tile is not None:
+            self.max_tile = max(1, min(self.size, int(max_tile)))
+        self.invalidate()
+
+    def has_light(self, light_np):
+        return any(tile.light_np == light_np for tile in self.tiles)
+
+    def setup_buffers(self):
+        # static casters draw with a depth-only shader, dynamic ones with their own so skinning and displacement apply
+        static_np = NodePath('complexpbr_shadow_static_state')
+        static_np.set_shader(Shader.load(Shader.SL_GLSL, self.shader_dir / 'shadow_v.vert', self.shader_dir / 'shadow_f.frag'), 1000)
+        static_np.set_attrib(ColorWriteAttrib.make(ColorWriteAttrib.C_off), 1000)
+        # a negative offset pushes casters away from the light, against acne on the lit surfaces
+        static_np.set_attrib(DepthOffsetAttrib.make(-1), 1000)
+        dynamic_np = NodePath('complexpbr_shadow_dynamic_state')
+        dynamic_np.set_attrib(ColorWriteAttrib.make(ColorWriteAttrib.C_off), 1000)
+        dynamic_np.set_attrib(DepthOffsetAttrib.make(-1), 1000)
+        dynamic_np.set_light_off(1000)
+        self.caster_states = (static_np.get_state(), dynamic_np.get_state())
+
+        self.static_tex = make_depth_texture('complexpbr_shadow_static', SamplerState.FT_nearest)
+        self.atlas_tex.clear_image()
+        self.buffers = (make_depth_buffer('complexpbr_shadow_static', self.size, -40, self.static_tex),
+                        make_depth_buffer('complexpbr_shadow_composite', self.size, -39, self.atlas_tex))
+
+        # the composite starts each tile from its static cache with a depth-only quad in a scene of its own
+        card = CardMaker('complexpbr_shadow_copy')
+        card.set_frame(-1, 1, -1, 1)
+        self.copy_root = NodePath('complexpbr_shadow_copy_root')
+        copy_np = self.copy_root.attach_new_node(card.generate())
+        copy_np.node().set_bounds(OmniBoundingVolume())
+        copy_np.node().set_final(True)
+        copy_np.set_shader(Shader.load(Shader.SL_GLSL, self.shader_dir / 'shadow_copy_v.vert', self.shader_dir / 'shadow_copy_f.frag'))
+        copy_np.set_shader_input('static_atlas', self.static_tex)
+        copy_np.set_attrib(ColorWriteAttrib.make(ColorWriteAttrib.C_off))
+        copy_np.set_attrib(DepthTestAttrib.make(RenderAttrib.M_always))
+        self.copy_camera = self.copy_root.attach_new_node(Camera('complexpbr_shadow_copy_camera', OrthographicLens()))
+
+        # static geometry stays out of the composite, dynamic casters out of the cache
+        self.caster_root.hide(DYNAMIC_CASTER_MASK)
+        for node in self.dynamic_casters:
+            self.hide_from_cache(node)
+
+    def make_region(self, buffer, tile, mask, state, sort):
+        camera = Camera('complexpbr_shadow_camera', tile.light_np.node().get_lens())
+        camera.set_camera_mask(mask)
+        camera.set_scene(self.caster_root)
+        camera.set_initial_state(state)
+        camera_np = tile.light_np.attach_new_node(camera)
+        tile.cameras.append(camera_np)
+
+        region = self.make_tile_region(buffer, camera_np, sort)
+        region.set_clear_depth_active(mask == STATIC_CASTER_MASK)
+
+        return region
+
+    def make_tile_region(self, buffer, camera_np, sort):
+        region = buffer.make_display_region()
+        region.set_camera(camera_np)
+        region.set_sort(sort)
+        region.set_clear_depth(1.0)
+        region.set_active(False)
+
+        return region
+
+    def add_light(self, light_np):
+        light = light_np.node()
+        if not isinstance(light, (Spotlight, DirectionalLight)):
+            print('complexpbr message: only Spotlight and DirectionalLight nodes can use the shadow atlas, ' + str(light_np) + ' was ignored.')
+            return
+        if self.has_light(light_np):
+            return
+        if self.buffers is None:
+            self.setup_buffers()
+
+        # the atlas replaces the light's own shadow buffer
+        light.set_shadow_caster(False)
+        tile = ShadowTile(light_np)
+        static_buffer, dynamic_buffer = self.buffers
+        tile.static_region = self.make_region(static_buffer, tile, STATIC_CASTER_MASK, self.caster_states[0], 0)
+        tile.copy_region = self.make_tile_region(dynamic_buffer, self.copy_camera, 0)
+        tile.dynamic_region = self.make_region(dynamic_buffer, tile, DYNAMIC_CASTER_MASK, self.caster_states[1], 1)
+        self.tiles.append(tile)
+
+    def remove_light(self, light_np):
+        for tile in [tile for tile in self.tiles if tile.light_np == light_np]:
+            self.remove_tile(tile)
+
+    def remove_tile(self, tile):
+        static_buffer, dynamic_buffer = self.buffers
+        static_buffer.remove_display_region(tile.static_region)
+        dynamic_buffer.remove_display_region(tile.copy_region)
+        dynamic_buffer.remove_display_region(tile.dynamic_region)
+        for camera_np in tile.cameras:
+            if not camera_np.is_empty():
+                camera_np.remove_node()
+        self.tiles.remove(tile)
+
+    def hide_from_cache(self, node):
+        node.hide(STATIC_CASTER_MASK)
+        node.show_through(DYNAMIC_CASTER_MASK)
+
+    def add_dynamic_caster(self, node):
+        # geometry that moves or animates, drawn into the composite every frame instead of being cached
+        if node not in self.dynamic_casters:
+            self.dynamic_casters.append(node)
+            if self.buffers is not None:
+                self.hide_from_cache(node)
+
+    def remove_dynamic_caster(self, node):
+        if node in self.dynamic_casters:
+            self.dynamic_casters.remove(node)
+            node.show(STATIC_CASTER_MASK)
+            node.show(DYNAMIC_CASTER_MASK)
+            self.invalidate()
+
+    def invalidate(self):
+        # re-render every static cache, IE after static geometry was changed in place
+        for tile in self.tiles:
+            tile.signature = None
+
+    def static_changed(self):
+        # static geometry counts as moved when the transform or the bounds of a caster root child change, children
+        # holding a dynamic caster are left out so they do not invalidate the cache every frame; Panda keeps a node's
+        # bounds until something below it changes, so an unchanged bounds object means nothing below moved
+        root_bounds = self.caster_root.node().get_bounds()
+        if self.static_root_bounds is not None and root_bounds.this == self.static_root_bounds.this:
+            return False
+        self.static_root_bounds = root_bounds
+
+        dynamic_children = set()
+        for node in self.dynamic_casters:
+            while not node.is_empty() and node.get_parent() != self.caster_root:
+                node = node.get_parent()
+            if not node.is_empty():
+                dynamic_children.add(node)
+
+        changed = False
+        static_bounds = {}
+        for child in self.caster_root.get_children():
+            if child in dynamic_children:
+                continue
+            transform = child.get_transform()
+            bounds = child.node().get_bounds()
+            entry = self.static_bounds.get(child)
+            if entry is None or entry[0] != transform or entry[1].this != bounds.this:
+                # shader inputs and draw masks are part of the bounds too, so new bounds are compared by value; nodes
+                # without bounds, IE lights and cameras, move freely
+                placed = None
+                if not bounds.is_empty() and not bounds.is_infinite() and hasattr(bounds, 'get_min'):
+                    placed = (transform, bounds.get_min(), bounds.get_max())
+                changed = changed or entry is None or entry[2] != placed
+                entry = (transform, bounds, placed)
+            static_bounds[child] = entry
+
+        changed = changed or len(static_bounds) != len(self.static_bounds)
+        self.static_bounds = static_bounds
+
+        return changed
+
+    def coverage(self, light_np, lens):
+        # the share of the screen a light's shadow frustum covers, which sets its tile resolution
+        light = light_np.node()
+        if isinstance(light, DirectionalLight):
+            return 1.0
+
+        far = lens.get_far()
+        att = light.get_attenuation()
+        if att[2] > 0.0:
+            color = light.get_color()
+            far = min(far, math.sqrt(max(0.0, 256.0 * max(color[0], color[1], color[2]) - att[0]) / att[2]))
+        half_angle = math.radians(max(lens.get_fov()) * 0.5)
+        radius = far * 0.5 / max(math.cos(min(half_angle, 1.5)), 0.1)
+        center = base.cam.get_relative_point(light_np, (0, far * 0.5, 0))
+
+        cam_lens = base.camLens
+        if not cam_lens.make_bounds().contains(BoundingSphere(center, radius)):
+            return 0.0
+        distance = center.length()
+        if distance <= radius:
+            return 1.0
+
+        tan_half_fov = math.tan(math.radians(min(cam_lens.get_fov()) * 0.5))
+
+        return min(1.0, radius / (math.sqrt(distance * distance - radius * radius) * tan_half_fov))
+
+    def tile_size(self, coverage, current=None):
+        size = max(self.min_tile, min(self.max_tile, int(self.max_tile * coverage)))
+        size = 1 << (size - 1).bit_length()
+        # a light near a step between two sizes keeps its current one, so its cache is not redrawn every frame
+        if current is not None and current != size and self.tile_size(0.0) <= current <= self.tile_size(1.0):
+            if current * 0.5 * (1.0 - TILE_HYSTERESIS) < self.max_tile * coverage <= current * (1.0 + TILE_HYSTERESIS):
+                return current
+
+        return size
+
+    def update(self, task):
+        for tile in [tile for tile in self.tiles if tile.light_np.is_empty()]:
+            self.remove_tile(tile)
+        if self.buffers is None:
+            return task.cont
+
+        lenses = [tile.light_np.node().get_lens() for tile in self.tiles]
+        sizes = [self.tile_size(self.coverage(tile.light_np, lens), tile.size) for tile, lens in zip(self.tiles, lenses)]
+        # tiles that hold the size asked for stay in place, so only the lights that were resized or added redraw their
+        # cache, unless packing everything again fits more of the sizes asked for
+        kept = [tile.tile if tile.size == size and tile.tile is not None and tile.tile[2] == size else None
+                for tile, size in zip(self.tiles, sizes)]
+        packed = pack_tiles(sizes, self.size, kept)
+        if None in kept:
+            repacked = pack_tiles(sizes, self.size)
+            if packed_area(repacked) > packed_area(packed):
+                packed = repacked
+        for tile, size in zip(self.tiles, sizes):
+            tile.size = size
+        if self.static_changed():
+            self.invalidate()
+
+        any_static = False
+        for tile, lens, tile_rect in zip(self.tiles, lenses, packed):
+            # the cache is kept until the light, its lens or its place in the atlas changes
+            signature = (tile_rect, tile.light_np.get_mat(self.caster_root), LMatrix4f(lens.get_projection_mat()))
+            redraw = signature != tile.signature and tile_rect is not None
+            tile.signature = signature
+            tile.tile = tile_rect
+            if redraw:
+                x, y, size = (value / self.size for value in tile_rect)
+                for region in (tile.static_region, tile.copy_region, tile.dynamic_region):
+                    region.set_dimensions(x, x + size, y, y + size)
+            composite = tile_rect is not None and (redraw or bool(self.dynamic_casters))
+            tile.static_region.set_active(redraw)
+            tile.copy_region.set_active(composite)
+            tile.dynamic_region.set_active(composite)
+            any_static = any_static or redraw
+
+        static_buffer, dynamic_buffer = self.buffers
+        static_buffer.set_active(any_static)
+        dynamic_buffer.set_active(any(tile.dynamic_region.is_active() for tile in self.tiles))
+        self.static_renders += int(any_static)
+        self.update_inputs()
+
+        return task.cont
+
+    def update_inputs(self):
+        # shader slots follow the p3d_LightSource order of the lights set on the caster root
+        light_attrib = self.caster_root.get_net_state().get_attrib(LightAttrib)
+        slots = [light_attrib.get_on_light(i) for i in range(light_attrib.get_num_non_ambient_lights())] if light_attrib else []
+        tiles = {tile.light_np: tile for tile in self.tiles if tile.tile is not None}
+
+        for slot in range(MAX_SLOTS):
+            tile = tiles.get(slots[slot]) if slot < len(slots) else None
+            if tile is None:
+                self.rects_input[slot] = LVecBase4f(0, 0, 0, 0)
+                continue
+
+            x, y, size = (value / self.size for value in tile.tile)
+            lens = tile.light_np.node().get_lens()
+            self.matrices_input[slot] = self.caster_root.get_mat(tile.light_np) * lens.get_projection_mat() * CLIP_TO_TEXTURE
+            self.rects_input[slot] = LVecBase4f(x, y, size, size)
+
+    def destroy(self):
+        base.task_mgr.remove(self.task_name)
+        if self.buffers is not None:
+            for tile in list(self.tiles):
+                self.remove_tile(tile)
+            for buffer in self.buffers:
+                base.graphicsEngine.remove_window(buffer)
+            self.caster_root.show(DYNAMIC_CASTER_MASK)
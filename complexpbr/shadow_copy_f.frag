@@ -0,0 +1,9 @@
+#version 430
+
+// starts a composite tile from its cached static caster depth, both atlases share one layout
+
+uniform sampler2D static_atlas;
+
+void main() {
+    gl_FragDepth = texelFetch(static_atlas, ivec2(gl_FragCoord.xy), 0).r;
+}
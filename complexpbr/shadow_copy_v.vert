@@ -0,0 +1,9 @@
+#version 430
+
+// covers whichever atlas tile the display region is set to
+
+in vec4 p3d_Vertex;
+
+void main() {
+    gl_Position = vec4(p3d_Vertex.xz, 0.0, 1.0);
+}
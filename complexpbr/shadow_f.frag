@@ -0,0 +1,6 @@
+#version 430
+
+// color writes are off, the rasterizer's depth is all the atlas keeps
+
+void main() {
+}
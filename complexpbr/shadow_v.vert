@@ -0,0 +1,11 @@
+#version 430
+
+// depth-only caster pass of the shadow atlas static cache, see complexpbr/shadow_atlas.py
+
+uniform mat4 p3d_ModelViewProjectionMatrix;
+
+in vec4 p3d_Vertex;
+
+void main() {
+    gl_Position = p3d_ModelViewProjectionMatrix * p3d_Vertex;
+}
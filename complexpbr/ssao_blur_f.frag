@@ -0,0 +1,41 @@
+#version 430
+
+// one axis of the separable, depth and normal aware SSAO blur
+
+uniform sampler2D ssao_tex;  // (ao, linear depth, view normal xy)
+uniform vec2 blur_direction;
+
+in vec2 texcoord;
+
+out vec4 o_color;
+
+const int BLUR_RADIUS = 4;
+const float DEPTH_SHARPNESS = 16.0;
+
+vec3 unpackNormal(vec2 xy)
+{
+    return vec3(xy, sqrt(max(1.0 - dot(xy, xy), 0.0)));
+}
+
+void main()
+{
+    vec2 texel = blur_direction / vec2(textureSize(ssao_tex, 0));
+    vec4 center = textureLod(ssao_tex, texcoord, 0.0);
+    vec3 center_normal = unpackNormal(center.zw);
+
+    float ao_sum = 0.0;
+    float weight_sum = 0.0;
+
+    for (int i = -BLUR_RADIUS; i <= BLUR_RADIUS; ++i) {
+        vec4 tap = textureLod(ssao_tex, texcoord + texel * float(i), 0.0);
+        float spatial = exp(-float(i * i) / (2.0 * float(BLUR_RADIUS * BLUR_RADIUS) * 0.25));
+        float depth_weight = exp(-abs(tap.y - center.y) / max(center.y, 0.0001) * DEPTH_SHARPNESS);
+        float normal_weight = pow(max(dot(unpackNormal(tap.zw), center_normal), 0.0), 8.0);
+        float weight = spatial * depth_weight * normal_weight;
+
+        ao_sum += tap.x * weight;
+        weight_sum += weight;
+    }
+
+    o_color = vec4(ao_sum / max(weight_sum, 0.0001), center.yzw);
+}
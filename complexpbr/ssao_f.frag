@@ -0,0 +1,117 @@
+#version 430
+
+// screenspace ambient occlusion at a fraction of the window resolution
+// writes (ao, linear depth, view normal xy) for the bilateral blur and upsample
+
+#ifndef LINEAR_DEPTH
+    #define LINEAR_DEPTH 0
+#endif
+
+uniform sampler2D depth_tex;  // the linear depth target with LINEAR_DEPTH, the scene depth buffer otherwise
+uniform sampler2D normal_tex;  // packed by ibl_f.frag
+uniform vec4 proj_params;  // see camera_projection_params() in complexpbr/screenspace.py
+uniform float cameraNear;
+uniform float cameraFar;
+
+uniform int ssao_samples;
+uniform float ssao_radius;
+uniform float ssao_bias;
+uniform float ssao_intensity;
+uniform int frame_index;  // rotates the kernel every frame for the temporal accumulation
+
+in vec2 texcoord;
+
+out vec4 o_color;
+
+const float PI = 3.14159265359;
+
+float linearDepth(vec2 uv)
+{
+#if LINEAR_DEPTH
+    return textureLod(depth_tex, uv, 0.0).r;
+#else
+    float z_ndc = textureLod(depth_tex, uv, 0.0).r * 2.0 - 1.0;
+    return 2.0 * cameraNear * cameraFar / (cameraFar + cameraNear - z_ndc * (cameraFar - cameraNear));
+#endif
+}
+
+vec3 viewPosition(vec2 uv)
+{
+    // OpenGL view space, the camera looks down -Z
+    float depth = linearDepth(uv);
+    vec2 ndc = uv * 2.0 - 1.0;
+    return vec3((ndc - proj_params.zw) * depth / proj_params.xy, -depth);
+}
+
+vec2 projectView(vec3 view_pos)
+{
+    vec2 ndc = view_pos.xy * proj_params.xy / -view_pos.z + proj_params.zw;
+    return ndc * 0.5 + 0.5;
+}
+
+float interleavedGradientNoise(vec2 pixel)
+{
+    return fract(52.9829189 * fract(dot(pixel, vec2(0.06711056, 0.00583715))));
+}
+
+vec3 unpackViewNormal(vec4 packed_normal)
+{
+    // octahedral, 16 bits per axis split over two channels like the velocity
+    vec2 q = floor(packed_normal.xz * 255.0 + 0.5) * 256.0 + floor(packed_normal.yw * 255.0 + 0.5);
+    vec3 n = vec3(q / 65535.0 * 2.0 - 1.0, 0.0);
+    n.z = 1.0 - abs(n.x) - abs(n.y);
+    n.xy -= max(-n.z, 0.0) * vec2(n.x >= 0.0 ? 1.0 : -1.0, n.y >= 0.0 ? 1.0 : -1.0);
+    return normalize(n);
+}
+
+void main()
+{
+    vec3 P = viewPosition(texcoord);
+    vec3 N;
+    vec4 packed_normal = textureLod(normal_tex, texcoord, 0.0);
+
+    if (packed_normal != vec4(0.0)) {
+        N = unpackViewNormal(packed_normal);
+    }
+    else {
+        // no shading normal where geometry without the ibl shader drew,
+        // one from the closer depth neighbor on each axis keeps silhouettes clean
+        vec2 texel = 1.0 / vec2(textureSize(depth_tex, 0));
+        vec3 px0 = viewPosition(texcoord - vec2(texel.x, 0.0));
+        vec3 px1 = viewPosition(texcoord + vec2(texel.x, 0.0));
+        vec3 py0 = viewPosition(texcoord - vec2(0.0, texel.y));
+        vec3 py1 = viewPosition(texcoord + vec2(0.0, texel.y));
+        vec3 dx = abs(px1.z - P.z) < abs(P.z - px0.z) ? px1 - P : P - px0;
+        vec3 dy = abs(py1.z - P.z) < abs(P.z - py0.z) ? py1 - P : P - py0;
+        N = normalize(cross(dx, dy));
+    }
+
+    // per-pixel rotation of a golden angle spiral kernel, the blur pass removes the pattern
+    float noise = interleavedGradientNoise(gl_FragCoord.xy + 5.588238 * float(frame_index % 64));
+    float rotation = noise * 2.0 * PI;
+    vec3 helper = abs(N.z) < 0.999 ? vec3(0.0, 0.0, 1.0) : vec3(1.0, 0.0, 0.0);
+    vec3 T = normalize(cross(helper, N));
+    vec3 B = cross(N, T);
+
+    float occlusion = 0.0;
+    int sample_count = max(ssao_samples, 1);
+
+    for (int i = 0; i < sample_count; ++i) {
+        float t = (float(i) + noise) / float(sample_count);
+        float phi = float(i) * 2.39996323 + rotation;
+        float cos_theta = sqrt(1.0 - t);
+        float sin_theta = sqrt(t);
+        vec3 direction = T * (cos(phi) * sin_theta) + B * (sin(phi) * sin_theta) + N * cos_theta;
+        // more samples close to the surface
+        float scale = mix(0.1, 1.0, t * t);
+        vec3 sample_pos = P + direction * ssao_radius * scale;
+
+        vec2 sample_uv = projectView(sample_pos);
+        float scene_depth = linearDepth(sample_uv);
+        float range_check = smoothstep(0.0, 1.0, ssao_radius / max(abs(-P.z - scene_depth), 0.0001));
+        occlusion += (scene_depth <= -sample_pos.z - ssao_bias ? 1.0 : 0.0) * range_check;
+    }
+
+    float ao = clamp(1.0 - occlusion / float(sample_count) * ssao_intensity, 0.0, 1.0);
+    o_color = vec4(ao, -P.z, N.xy);
+}
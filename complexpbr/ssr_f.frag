@@ -0,0 +1,166 @@
+#version 430
+
+// hierarchical-Z screenspace reflections at a fraction of the window resolution
+// writes the premultiplied reflection color and its blend weight for min_f.frag to upsample
+
+uniform sampler2D scene_tex;
+uniform sampler2D hiz_tex;  // (min, max) depth mip chain, see HiZPyramid in complexpbr/screenspace.py
+uniform int hiz_levels;
+uniform sampler2D normal_tex;  // packed by ibl_f.frag
+uniform vec4 proj_params;  // see camera_projection_params() in complexpbr/screenspace.py
+uniform float cameraNear;
+uniform float cameraFar;
+
+uniform int ssr_samples;  // ray march step budget
+uniform float ssr_thickness;
+uniform float ssr_max_distance;
+uniform float ssr_fresnel_pow;
+uniform int frame_index;  // varies the ray start every frame for the temporal accumulation
+
+in vec2 texcoord;
+
+out vec4 o_color;
+
+float linearDepth(float depth)
+{
+    float z_ndc = depth * 2.0 - 1.0;
+    return 2.0 * cameraNear * cameraFar / (cameraFar + cameraNear - z_ndc * (cameraFar - cameraNear));
+}
+
+float rawDepth(float linear_depth)
+{
+    float z_ndc = (cameraFar + cameraNear - 2.0 * cameraNear * cameraFar / linear_depth) / (cameraFar - cameraNear);
+    return z_ndc * 0.5 + 0.5;
+}
+
+vec3 viewPosition(vec2 uv)
+{
+    // OpenGL view space, the camera looks down -Z
+    float depth = linearDepth(textureLod(hiz_tex, uv, 0.0).r);
+    vec2 ndc = uv * 2.0 - 1.0;
+    return vec3((ndc - proj_params.zw) * depth / proj_params.xy, -depth);
+}
+
+vec3 projectView(vec3 view_pos)
+{
+    // (uv, depth buffer value), both of which are linear along a ray in screen space
+    vec2 ndc = view_pos.xy * proj_params.xy / -view_pos.z + proj_params.zw;
+    return vec3(ndc * 0.5 + 0.5, rawDepth(-view_pos.z));
+}
+
+float interleavedGradientNoise(vec2 pixel)
+{
+    return fract(52.9829189 * fract(dot(pixel, vec2(0.06711056, 0.00583715))));
+}
+
+vec3 unpackViewNormal(vec4 packed_normal)
+{
+    // octahedral, 16 bits per axis split over two channels like the velocity
+    vec2 q = floor(packed_normal.xz * 255.0 + 0.5) * 256.0 + floor(packed_normal.yw * 255.0 + 0.5);
+    vec3 n = vec3(q / 65535.0 * 2.0 - 1.0, 0.0);
+    n.z = 1.0 - abs(n.x) - abs(n.y);
+    n.xy -= max(-n.z, 0.0) * vec2(n.x >= 0.0 ? 1.0 : -1.0, n.y >= 0.0 ? 1.0 : -1.0);
+    return normalize(n);
+}
+
+float rayToBoundary(float origin, float direction, float boundary)
+{
+    return abs(direction) > 1e-8 ? (boundary - origin) / direction : 1e8;
+}
+
+void main()
+{
+    o_color = vec4(0.0);
+    vec2 texel = 1.0 / vec2(textureSize(hiz_tex, 0));
+
+    if (textureLod(hiz_tex, texcoord, 0.0).r >= 1.0) {
+        return;
+    }
+
+    vec3 P = viewPosition(texcoord);
+    vec3 N;
+    vec4 packed_normal = textureLod(normal_tex, texcoord, 0.0);
+
+    if (packed_normal != vec4(0.0)) {
+        N = unpackViewNormal(packed_normal);
+    }
+    else {
+        // no shading normal where geometry without the ibl shader drew, one from the closer depth neighbor on each axis
+        vec3 px0 = viewPosition(texcoord - vec2(texel.x, 0.0));
+        vec3 px1 = viewPosition(texcoord + vec2(texel.x, 0.0));
+        vec3 py0 = viewPosition(texcoord - vec2(0.0, texel.y));
+        vec3 py1 = viewPosition(texcoord + vec2(0.0, texel.y));
+        vec3 dx = abs(px1.z - P.z) < abs(P.z - px0.z) ? px1 - P : P - px0;
+        vec3 dy = abs(py1.z - P.z) < abs(P.z - py0.z) ? py1 - P : P - py0;
+        N = normalize(cross(dx, dy));
+    }
+    vec3 V = normalize(P);
+    vec3 R = reflect(V, N);
+
+    // the ray ends at ssr_max_distance or just before the near plane, whichever is closer
+    float ray_length = ssr_max_distance;
+    if (R.z > 0.0) {
+        ray_length = min(ray_length, (-cameraNear * 1.01 - P.z) / R.z);
+    }
+
+    vec3 start = projectView(P + N * 0.01 * -P.z * texel.x);
+    vec3 ray = projectView(P + R * ray_length) - start;
+
+    // clip the ray to the screen
+    float t_max = 1.0;
+    t_max = min(t_max, rayToBoundary(start.x, ray.x, ray.x > 0.0 ? 1.0 : 0.0));
+    t_max = min(t_max, rayToBoundary(start.y, ray.y, ray.y > 0.0 ? 1.0 : 0.0));
+
+    vec2 cell_step = step(0.0, ray.xy);
+    int level = 0;
+    // leave the starting texel before looking for hits, a little further on some pixels and frames
+    float jitter = interleavedGradientNoise(gl_FragCoord.xy + 5.588238 * float(frame_index % 64));
+    float t = (2.0 + jitter) / max(max(abs(ray.x), abs(ray.y)) * max(1.0 / texel.x, 1.0 / texel.y), 1e-8);
+    float t_hit = -1.0;
+
+    for (int i = 0; i < ssr_samples && t < t_max; ++i) {
+        vec3 pos = start + ray * t;
+        vec2 level_size = vec2(textureSize(hiz_tex, level));
+        vec2 cell = floor(pos.xy * level_size);
+        vec2 depth_range = texelFetch(hiz_tex, ivec2(cell), level).rg;
+
+        vec2 boundary = (cell + cell_step) / level_size;
+        float t_exit = min(rayToBoundary(start.x, ray.x, boundary.x), rayToBoundary(start.y, ray.y, boundary.y));
+        // a hundredth of a texel past the edge, so the next step lands in the neighbouring cell
+        float t_cross = min(t_exit, t_max) + 0.01 / max(max(abs(ray.x) * level_size.x, abs(ray.y) * level_size.y), 1e-8);
+        float ray_far = max(pos.z, start.z + ray.z * min(t_exit, t_max));
+
+        if (ray_far < depth_range.x) {
+            // the ray passes in front of everything in this cell, skip it and try a coarser level
+            t = t_cross;
+            level = min(level + 1, hiz_levels - 1);
+        }
+        else if (level > 0) {
+            // something in this cell may be hit, advance to the cell's nearest depth and refine
+            if (ray.z > 0.0) {
+                t = max(t, (depth_range.x - start.z) / ray.z);
+            }
+            level--;
+        }
+        else {
+            float t_surface = ray.z > 0.0 ? max(t, (depth_range.x - start.z) / ray.z) : t;
+            if (linearDepth(start.z + ray.z * t_surface) - linearDepth(depth_range.y) < ssr_thickness) {
+                t_hit = t_surface;
+                break;
+            }
+            // the ray passes behind this texel
+            t = t_cross;
+        }
+    }
+
+    if (t_hit < 0.0 || t_hit > t_max) {
+        return;
+    }
+
+    vec2 hit_uv = (start + ray * t_hit).xy;
+    vec2 edge = smoothstep(0.0, 0.1, hit_uv) * smoothstep(0.0, 0.1, 1.0 - hit_uv);
+    float fresnel = pow(1.0 - max(dot(N, -V), 0.0), ssr_fresnel_pow);
+    float weight = fresnel * edge.x * edge.y * (1.0 - smoothstep(0.8, 1.0, t_hit));
+
+    o_color = vec4(textureLod(scene_tex, hit_uv, 0.0).rgb * weight, weight);
+}
@@ -0,0 +1,68 @@
+#version 430
+
+// temporal anti-aliasing resolve of the jittered scene, see TemporalAA in complexpbr/screenspace.py
+
+uniform sampler2D scene_tex;
+uniform sampler2D depth_tex;
+uniform sampler2D history_tex;
+uniform sampler2D velocity_tex;  // packed by ibl_f.frag
+uniform float history_blend;
+
+in vec2 texcoord;
+
+out vec4 o_color;
+
+vec2 unpackVelocity(vec4 packed_velocity)
+{
+    vec2 q = floor(packed_velocity.xz * 255.0 + 0.5) * 256.0 + floor(packed_velocity.yw * 255.0 + 0.5);
+    return q / 65535.0 * 2.0 - 1.0;
+}
+
+vec3 rgbToYCoCg(vec3 color)
+{
+    return vec3(dot(color, vec3(0.25, 0.5, 0.25)), dot(color, vec3(0.5, 0.0, -0.5)), dot(color, vec3(-0.25, 0.5, -0.25)));
+}
+
+vec3 yCoCgToRgb(vec3 color)
+{
+    return vec3(color.x + color.y - color.z, color.x + color.z, color.x - color.y - color.z);
+}
+
+void main()
+{
+    ivec2 size = textureSize(scene_tex, 0);
+    ivec2 pixel = clamp(ivec2(texcoord * vec2(size)), ivec2(0), size - 1);
+    vec3 current = texelFetch(scene_tex, pixel, 0).rgb;
+
+    // neighborhood color range in YCoCg, and the closest depth so edges follow the foreground's motion
+    vec3 low = rgbToYCoCg(current);
+    vec3 high = low;
+    ivec2 closest = pixel;
+    float closest_depth = texelFetch(depth_tex, pixel, 0).r;
+
+    for (int y = -1; y <= 1; ++y) {
+        for (int x = -1; x <= 1; ++x) {
+            ivec2 tap_pixel = clamp(pixel + ivec2(x, y), ivec2(0), size - 1);
+            vec3 tap = rgbToYCoCg(texelFetch(scene_tex, tap_pixel, 0).rgb);
+            low = min(low, tap);
+            high = max(high, tap);
+
+            float depth = texelFetch(depth_tex, tap_pixel, 0).r;
+            if (depth < closest_depth) {
+                closest_depth = depth;
+                closest = tap_pixel;
+            }
+        }
+    }
+
+    vec2 velocity = unpackVelocity(texelFetch(velocity_tex, closest, 0));
+    vec2 history_uv = texcoord - velocity;
+    vec3 history = yCoCgToRgb(clamp(rgbToYCoCg(textureLod(history_tex, history_uv, 0.0).rgb), low, high));
+
+    float blend = history_blend;
+    if (any(lessThan(history_uv, vec2(0.0))) || any(greaterThan(history_uv, vec2(1.0)))) {
+        blend = 0.0;
+    }
+
+    o_color = vec4(mix(current, history, blend), 1.0);
+}
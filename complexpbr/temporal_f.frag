@@ -0,0 +1,53 @@
+#version 430
+
+// blends a screenspace pass with its reprojected history, see TemporalPass in complexpbr/screenspace.py
+
+uniform sampler2D current_tex;
+uniform sampler2D history_tex;
+uniform sampler2D velocity_tex;  // packed by ibl_f.frag
+uniform vec4 accumulate_mask;  // channels blended with the history, the others pass through
+uniform float history_blend;
+uniform int reject_depth;  // the y channel holds linear depth, as in the SSAO pass
+
+in vec2 texcoord;
+
+out vec4 o_color;
+
+vec2 unpackVelocity(vec4 packed_velocity)
+{
+    vec2 q = floor(packed_velocity.xz * 255.0 + 0.5) * 256.0 + floor(packed_velocity.yw * 255.0 + 0.5);
+    return q / 65535.0 * 2.0 - 1.0;
+}
+
+void main()
+{
+    vec2 texel = 1.0 / vec2(textureSize(current_tex, 0));
+    vec4 current = textureLod(current_tex, texcoord, 0.0);
+
+    // the history only counts within the range of the current neighborhood, which rejects most stale samples
+    vec4 low = current;
+    vec4 high = current;
+    for (int y = -1; y <= 1; ++y) {
+        for (int x = -1; x <= 1; ++x) {
+            vec4 tap = textureLod(current_tex, texcoord + vec2(x, y) * texel, 0.0);
+            low = min(low, tap);
+            high = max(high, tap);
+        }
+    }
+
+    ivec2 velocity_size = textureSize(velocity_tex, 0);
+    vec2 velocity = unpackVelocity(texelFetch(velocity_tex, ivec2(texcoord * vec2(velocity_size)), 0));
+    vec2 history_uv = texcoord - velocity;
+    vec4 history = textureLod(history_tex, history_uv, 0.0);
+
+    float blend = history_blend;
+    if (any(lessThan(history_uv, vec2(0.0))) || any(greaterThan(history_uv, vec2(1.0)))) {
+        blend = 0.0;
+    }
+    if (reject_depth > 0 && abs(history.y - current.y) > 0.1 * current.y) {
+        blend = 0.0;
+    }
+
+    vec4 accumulated = mix(current, clamp(history, low, high), blend);
+    o_color = mix(current, accumulated, accumulate_mask);
+}
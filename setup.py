@@ -5,6 +5,6 @@ setup(
     version='0.6.6',
     packages=['complexpbr'],
     package_data={
-       "": ["*.txt","*.vert","*.frag","*.png"],
+       "": ["*.txt","*.vert","*.frag","*.comp","*.png"],
        }
     )